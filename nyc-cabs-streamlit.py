@@ -1,14 +1,23 @@
 '''
 Streamlit application
 '''
+import hashlib
+import time
+
 import streamlit as st
 import pandas as pd
-import numpy as np
-from joblib import load
 
 from src.data.preprocess import (NYC_MIN_LON, NYC_MAX_LON, NYC_MIN_LAT, NYC_MAX_LAT)
-from src.features import features_cols, compute_trip_distance, get_features
-from src.models.predict import make_predictions
+from src.models.cache import load_cached_predictor, preload_cached_predictor
+
+MODEL_FPATH = 'models/best_estimator.joblib'
+PL_FPATH = 'models/preprocessing_affine.npz'
+# seconds from the heatmap button to the rendered image (scoring, drawing, png encoding)
+HEATMAP_RENDER_BUDGET = 2.0
+
+# the model is loaded in a background thread while the page renders
+# (once per server process, the script itself is rerun on every interaction)
+preload_cached_predictor(MODEL_FPATH, PL_FPATH)
 
 # Header
 st.write('''
@@ -23,50 +32,101 @@ Training data is from **NYC Trip Duration** [Kaggle competition](https://www.kag
 
 ''')
 
+mode = st.sidebar.radio('Mode', ['Single trip', 'Travel time heatmap', 'Bulk CSV'])
+
 
 # Get user input
-def user_input():
+def pickup_input():
     pickup_date = st.date_input('Pickup date')
     pickup_time = st.time_input('Pickup time')
     # Default pickup at Columbia University
     pickup_lat = st.number_input('pickup latitude', min_value=NYC_MIN_LAT, max_value=NYC_MAX_LAT, value=40.8075)
     pickup_lon = st.number_input('pickup longitude', min_value=NYC_MIN_LON, max_value=NYC_MAX_LON, value=-73.9626)
+    return pickup_date, pickup_time, pickup_lat, pickup_lon
+
+def user_input():
+    pickup_date, pickup_time, pickup_lat, pickup_lon = pickup_input()
     # Default dropoff at Time square
     dropoff_lat = st.number_input('dropoff latitude', min_value=NYC_MIN_LAT, max_value=NYC_MAX_LAT, value=40.7589)
     dropoff_lon = st.number_input('dropoff longitude', min_value=NYC_MIN_LON, max_value=NYC_MAX_LAT, value=-73.9851)
 
     # for making predictions
-    input_df = pd.DataFrame(columns=features_cols()[0]) 
-
-    input_df['pickup_datetime_date'] = [pickup_date.day]
-    input_df['pickup_datetime_day_of_week'] = [pickup_date.weekday()]
-    input_df['pickup_datetime_hour'] = [pickup_time.hour]
-    input_df['pickup_latitude'] = [pickup_lat]
-    input_df['pickup_longitude'] = [pickup_lon]
-    input_df['dropoff_latitude'] = [dropoff_lat]
-    input_df['dropoff_longitude'] = [dropoff_lon]
-    input_df = compute_trip_distance(input_df, 'pickup_latitude','dropoff_latitude','pickup_longitude','dropoff_longitude')
+    trip = dict(
+        pickup_lat=pickup_lat,
+        pickup_lon=pickup_lon,
+        dropoff_lat=dropoff_lat,
+        dropoff_lon=dropoff_lon,
+        day=pickup_date.day,
+        day_of_week=pickup_date.weekday(),
+        hour=pickup_time.hour,
+    )
 
     # for showing trip on map
     trip_df = pd.DataFrame({'lat':[pickup_lat, dropoff_lat], 'lon':[pickup_lon,dropoff_lon]})
-    return input_df, trip_df
-
-input_df, trip_df = user_input()
-
-# Show trip on map
-st.map(trip_df)
-
-# Extract features from input data using our trained features pipeline
-X = get_features(input_df)
-X_df = pd.DataFrame(X, columns=features_cols()[0])
-
-# Use trained model to predict
-if st.button('Estimate trip duration'):
-    # Load model
-    model = load('models/best_estimator.joblib')
-    # Predict using input data --> log scale
-    predictions = make_predictions(model, X_df)
-    # Convert predictions to minutes (rounded up)
-    predicted_duration = int(predictions[0] // 60 + 1)
-    st.write(f'Your trip will take about {predicted_duration} minutes')
-    
\ No newline at end of file
+    return trip, trip_df
+
+if mode == 'Single trip':
+    trip, trip_df = user_input()
+
+    # Show trip on map
+    st.map(trip_df)
+
+    # Use trained features pipeline and model to predict
+    # (both are loaded once per process, repeated routes are answered from the prediction cache)
+    if st.button('Estimate trip duration'):
+        predictor = load_cached_predictor(MODEL_FPATH, PL_FPATH)
+        predicted_seconds = predictor.predict_trip(**trip)
+        # Convert predictions to minutes (rounded up)
+        predicted_duration = int(predicted_seconds // 60 + 1)
+        st.write(f'Your trip will take about {predicted_duration} minutes')
+
+elif mode == 'Travel time heatmap':
+    # imported here so that the app start doesn't pay for matplotlib
+    from src.visualization.travel_time import dropoff_grid, render_travel_time_heatmap
+
+    pickup_date, pickup_time, pickup_lat, pickup_lon = pickup_input()
+    cells_per_degree = st.select_slider('Grid cells per degree', options=[50, 100, 150, 200], value=100)
+    grid = dropoff_grid(NYC_MIN_LAT, NYC_MAX_LAT, NYC_MIN_LON, NYC_MAX_LON, cells_per_degree)
+
+    # every dropoff of the grid is scored in one batch, grids are cached per (pickup cell, date, hour)
+    if st.button(f'Draw travel time heatmap ({grid.n_lat * grid.n_lon} dropoffs)'):
+        start = time.perf_counter()
+        predictor = load_cached_predictor(MODEL_FPATH, PL_FPATH)
+        png, timings = render_travel_time_heatmap(predictor, grid, pickup_lat, pickup_lon,
+            pickup_date.day, pickup_date.weekday(), pickup_time.hour)
+        st.image(png)
+        total = time.perf_counter() - start
+        st.caption(f"Rendered in {total:.2f} s (scoring {timings['score_s']:.2f} s, drawing "
+            f"{timings['draw_s'] + timings['encode_s']:.2f} s), budget {HEATMAP_RENDER_BUDGET:.1f} s")
+        if total > HEATMAP_RENDER_BUDGET:
+            st.warning('The heatmap took longer than its render budget, try fewer grid cells')
+
+else:
+    from src.models.batch_predict import score_csv_chunks
+
+    st.write('Upload trips in the test.csv layout (id, pickup_datetime, pickup/dropoff latitude and longitude)')
+    uploaded = st.file_uploader('Trips csv', type='csv')
+    if uploaded is not None:
+        # the script reruns on every interaction (e.g. the download click), an upload is only
+        # scored once per session, its predictions (or error) are kept in the session state
+        upload_key = (uploaded.name, hashlib.sha256(uploaded.getvalue()).hexdigest())
+        if st.session_state.get('scored_upload', (None,))[0] != upload_key:
+            predictor = load_cached_predictor(MODEL_FPATH, PL_FPATH).predictor
+            progress = st.empty()
+            results = []
+            try:
+                # featurized and scored chunk by chunk, only the predictions are kept
+                for chunk in score_csv_chunks(predictor, uploaded):
+                    results.append(chunk)
+                    progress.text(f'Scored {sum(len(r) for r in results)} trips....')
+            except (ValueError, KeyError) as e:
+                st.session_state['scored_upload'] = (upload_key, None, f'Could not score {uploaded.name}: {e}')
+            else:
+                st.session_state['scored_upload'] = (upload_key, pd.concat(results, ignore_index=True), None)
+        _, predictions, error = st.session_state['scored_upload']
+        if error:
+            st.error(error)
+        else:
+            st.dataframe(predictions.head(100))
+            st.download_button('Download predictions', predictions.to_csv(index=False), file_name='predictions.csv',
+                mime='text/csv')
@@ -0,0 +1,254 @@
+'''
+Module for benchmarking every pipeline stage on synthetic data (results --> reports/benchmarks)
+
+For each size (10k/100k/1M/10M rows) the stages below are timed (best of --repeat runs) and
+their peak traced memory is measured in a separate run with tracemalloc (it slows the code
+down, so it is not part of the timings). Results are written to JSON, compare flags the
+stages that got slower or use more memory than in a stored baseline.
+
+Can be run as a script (To be run from main directory only)
+    python src/benchmarks/bench.py run --sizes 10k 100k --output reports/benchmarks/latest.json
+    python src/benchmarks/bench.py compare reports/benchmarks/latest.json reports/benchmarks/baseline.json
+'''
+import gc
+import json
+import os
+import platform
+import time
+import tracemalloc
+from functools import lru_cache
+
+
+DEFAULT_OUTPUT = 'reports/benchmarks/latest.json'
+DEFAULT_BASELINE = 'reports/benchmarks/baseline.json'
+DEFAULT_SIZES = ['10k', '100k', '1M']
+# relative slowdown (or memory increase) reported as a regression
+DEFAULT_THRESHOLD = 0.1
+SINGLE_ROW_CALLS = 1000
+
+def measure(func, n_rows, repeat=3, memory=True):
+    '''
+    Best wall time of repeat calls of func() and peak traced memory of one more call
+
+    returns dict with seconds, rows_per_sec and peak_mb (None without memory)
+    '''
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+
+    peak_mb = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    return {'seconds': seconds, 'rows_per_sec': n_rows / seconds if seconds else None, 'peak_mb': peak_mb}
+
+def stage_benchmarks(n_rows, tmp_dir, seed=0):
+    '''
+    List of (stage name, function, rows processed, fixtures) for n_rows synthetic trips
+
+    Fixtures (raw csv, cleaned and featurized data, fitted pl and model) are functions that
+    build them on their first call, run_benchmarks calls the fixtures of a stage before timing
+    it: each function only runs its own stage and only the selected stages pay for theirs.
+    '''
+    from joblib import dump, load
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    from src.benchmarks.synthetic import generate_trips, write_raw_csv
+    from src.data.read import read_raw_data
+    from src.data.preprocess import drop_zero_records, drop_statistical_outliers
+    from src.features import (
+        compute_trip_distance,
+        decompose_pickup_datetime_features,
+        decompose_dropoff_datetime_features,
+        compile_preprocessing_pl,
+        create_preprocessing_pl,
+        features_cols,
+        get_features,
+        get_target,
+    )
+    from src.models.predictor import TripDurationPredictor
+
+    clean_cols = ['passenger_count', 'trip_duration']
+    X_cols = features_cols()[0]
+    trip = dict(pickup_lat=40.8075, pickup_lon=-73.9626, dropoff_lat=40.7589, dropoff_lon=-73.9851,
+        day=15, day_of_week=2, hour=18)
+
+    @lru_cache(maxsize=None)
+    def csv_fpath():
+        return write_raw_csv(os.path.join(tmp_dir, f'train_{n_rows}.csv'), n_rows, seed)
+
+    @lru_cache(maxsize=None)
+    def df():
+        return generate_trips(n_rows, seed)
+
+    @lru_cache(maxsize=None)
+    def features_df():
+        return decompose_pickup_datetime_features(compute_trip_distance(df()))
+
+    @lru_cache(maxsize=None)
+    def pl_fpath():
+        fpath = os.path.join(tmp_dir, 'preprocessing_pl.joblib')
+        dump(create_preprocessing_pl(features_df()[X_cols], features_cols()), fpath)
+        return fpath
+
+    @lru_cache(maxsize=None)
+    def compiled():
+        return compile_preprocessing_pl(load(pl_fpath()))
+
+    @lru_cache(maxsize=None)
+    def compiled_fpath():
+        fpath = os.path.join(tmp_dir, 'preprocessing_affine.npz')
+        compiled().save(fpath)
+        return fpath
+
+    @lru_cache(maxsize=None)
+    def X():
+        return compiled().transform(features_df()[X_cols])
+
+    @lru_cache(maxsize=None)
+    def y():
+        return get_target(df())
+
+    def fit():
+        return HistGradientBoostingRegressor(max_leaf_nodes=300, max_iter=100, early_stopping=False).fit(X(), y())
+
+    @lru_cache(maxsize=None)
+    def model():
+        return fit()
+
+    @lru_cache(maxsize=None)
+    def predictor():
+        return TripDurationPredictor(model(), compiled())
+
+    def single_row_inference():
+        predict_trip = predictor().predict_trip
+        for _ in range(SINGLE_ROW_CALLS):
+            predict_trip(**trip)
+
+    return [
+        ('read_raw_data', lambda: read_raw_data(csv_fpath()), n_rows, [csv_fpath]),
+        ('drop_zero_records', lambda: drop_zero_records(df(), clean_cols), n_rows, [df]),
+        ('drop_statistical_outliers', lambda: drop_statistical_outliers(df(), clean_cols), n_rows, [df]),
+        ('compute_trip_distance', lambda: compute_trip_distance(df()), n_rows, [df]),
+        ('decompose_pickup_datetime_features', lambda: decompose_pickup_datetime_features(df()), n_rows, [df]),
+        ('decompose_dropoff_datetime_features', lambda: decompose_dropoff_datetime_features(df()), n_rows, [df]),
+        ('get_features (sklearn pl)', lambda: get_features(features_df(), pl_fpath()), n_rows, [features_df, pl_fpath]),
+        ('get_features (compiled)', lambda: get_features(features_df(), compiled_fpath()), n_rows,
+            [features_df, compiled_fpath]),
+        ('hgb_fit', fit, n_rows, [X, y]),
+        ('hgb_predict', lambda: model().predict(X()), n_rows, [X, model]),
+        ('single_row_inference', single_row_inference, SINGLE_ROW_CALLS, [predictor]),
+    ]
+
+def environment():
+    import numpy
+    import pandas
+    import sklearn
+    return {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'pandas': pandas.__version__,
+        'sklearn': sklearn.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def run_benchmarks(sizes, repeat=3, memory=True, stages=None, tmp_dir=None):
+    '''
+    sizes: list
+        - size names from synthetic.SIZES (e.g. '100k') or row counts
+    stages: list
+        - stage names to run, all by default
+    '''
+    import tempfile
+    from src.benchmarks.synthetic import SIZES
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        for size in sizes:
+            n_rows = SIZES.get(size) or int(size)
+            print(f'Preparing {n_rows} synthetic trips....')
+            for name, func, n_items, fixtures in stage_benchmarks(n_rows, tmp):
+                if stages and name not in stages:
+                    continue
+                for fixture in fixtures:
+                    fixture()
+                result = measure(func, n_items, repeat, memory)
+                results[f'{name}@{size}'] = dict(result, stage=name, size=size, rows=n_items)
+                peak = f"{result['peak_mb']:9.1f} MB" if result['peak_mb'] is not None else ''
+                print(f"{name:<38} {size:>5} {result['seconds']:10.4f} s {result['rows_per_sec']:>14,.0f} rows/sec {peak}")
+    return {'environment': environment(), 'results': results}
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    '''
+    Regressions of results against baseline (both as written by run_benchmarks)
+
+    returns list of (key, metric, baseline value, new value, relative change)
+    '''
+    regressions = []
+    for key, new in results['results'].items():
+        old = baseline['results'].get(key)
+        if old is None:
+            continue
+        for metric in ('seconds', 'peak_mb'):
+            if new.get(metric) is None or not old.get(metric):
+                continue
+            change = new[metric] / old[metric] - 1
+            if change > threshold:
+                regressions.append((key, metric, old[metric], new[metric], change))
+    return regressions
+
+def main():
+    import argparse
+    import shutil
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic trips')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='run the benchmarks and write the results')
+    run_parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help='10k, 100k, 1M, 10M or row counts')
+    run_parser.add_argument('--stages', nargs='*', default=None)
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc runs')
+    run_parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    run_parser.add_argument('--save-baseline', action='store_true', help=f'also copy the results to {DEFAULT_BASELINE}')
+    compare_parser = subparsers.add_parser('compare', help='flag regressions against a baseline')
+    compare_parser.add_argument('results', nargs='?', default=DEFAULT_OUTPUT)
+    compare_parser.add_argument('baseline', nargs='?', default=DEFAULT_BASELINE)
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run_benchmarks(args.sizes, args.repeat, not args.no_memory, args.stages)
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        print(f'Saving results to {args.output}....')
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        if args.save_baseline:
+            shutil.copyfile(args.output, DEFAULT_BASELINE)
+    else:
+        with open(args.results) as f:
+            results = json.load(f)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for key, metric, old, new, change in regressions:
+            print(f'REGRESSION {key:<45} {metric:<8} {old:10.4f} -> {new:10.4f} ({change:+.0%})')
+        print(f'{len(regressions)} regression(s) above {args.threshold:.0%}')
+        if regressions:
+            sys.exit(1)
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''
+Module for generating synthetic trips in the raw train.csv format (for benchmarks)
+
+Pickups and dropoffs are mostly around Midtown/Downtown Manhattan, some are spread over the
+NYC bounding box. Durations grow with the distance and depend on the hour, with a few zero
+and outlying records so that the cleaning steps have something to drop.
+'''
+import numpy as np
+import pandas as pd
+
+from ..data.preprocess import NYC_MIN_LON, NYC_MAX_LON, NYC_MIN_LAT, NYC_MAX_LAT
+
+
+MANHATTAN_LAT, MANHATTAN_LON = 40.754, -73.984
+SIZES = {'10k': 10_000, '100k': 100_000, '1M': 1_000_000, '10M': 10_000_000}
+
+def _coordinates(rng, n_rows, spread=0.03, uniform_frac=0.1):
+    lat = rng.normal(MANHATTAN_LAT, spread, n_rows)
+    lon = rng.normal(MANHATTAN_LON, spread, n_rows)
+    uniform = rng.random(n_rows) < uniform_frac
+    lat[uniform] = rng.uniform(NYC_MIN_LAT, NYC_MAX_LAT, uniform.sum())
+    lon[uniform] = rng.uniform(NYC_MIN_LON, NYC_MAX_LON, uniform.sum())
+    return lat, lon
+
+def generate_trips(n_rows, seed=0, test=False):
+    '''
+    DataFrame of n_rows synthetic trips with the columns of data/raw/train.csv
+
+    test: bool
+        - columns of data/raw/test.csv instead (no dropoff_datetime and trip_duration)
+    '''
+    rng = np.random.default_rng(seed)
+    pickup_lat, pickup_lon = _coordinates(rng, n_rows)
+    dropoff_lat, dropoff_lon = _coordinates(rng, n_rows)
+
+    start = np.datetime64('2016-01-01T00:00:00')
+    seconds_in_half_year = 182 * 24 * 3600
+    pickup_datetime = start + rng.integers(0, seconds_in_half_year, n_rows).astype('timedelta64[s]')
+    hour = (pickup_datetime - pickup_datetime.astype('datetime64[D]')).astype('timedelta64[h]').astype(np.int64)
+
+    # ~25 km/h on the manhattan distance, slower in the rush hours
+    km = 111 * (np.abs(dropoff_lat - pickup_lat) + 0.76 * np.abs(dropoff_lon - pickup_lon))
+    speed = 25 - 8 * np.exp(-((hour - 17.5)**2) / 8)
+    trip_duration = np.maximum(60 + 3600 * km / speed * rng.lognormal(0, 0.3, n_rows), 1).astype(np.int64)
+    # a few zero passenger counts and very long trips for the cleaning steps
+    passenger_count = rng.choice([0, 1, 1, 1, 1, 2, 2, 3, 5, 6], n_rows)
+    long_trips = rng.random(n_rows) < 0.002
+    trip_duration[long_trips] = rng.integers(86_400, 10 * 86_400, long_trips.sum())
+
+    df = pd.DataFrame({
+        'id': np.char.add('id', np.arange(n_rows).astype(str)),
+        'vendor_id': rng.integers(1, 3, n_rows),
+        'pickup_datetime': pickup_datetime,
+        'dropoff_datetime': pickup_datetime + trip_duration.astype('timedelta64[s]'),
+        'passenger_count': passenger_count,
+        'pickup_longitude': pickup_lon,
+        'pickup_latitude': pickup_lat,
+        'dropoff_longitude': dropoff_lon,
+        'dropoff_latitude': dropoff_lat,
+        'store_and_fwd_flag': np.where(rng.random(n_rows) < 0.005, 'Y', 'N'),
+        'trip_duration': trip_duration,
+    })
+    if test:
+        df = df.drop(columns=['dropoff_datetime', 'trip_duration'])
+    return df
+
+def write_raw_csv(fpath, n_rows, seed=0, test=False, chunksize=1_000_000):
+    # written in chunks so that 10M rows don't need the whole DataFrame as strings at once
+    for i, start in enumerate(range(0, n_rows, chunksize)):
+        df = generate_trips(min(chunksize, n_rows - start), seed + i, test)
+        df['id'] = 'id' + (df.index + start).astype(str)
+        df.to_csv(fpath, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+    return fpath
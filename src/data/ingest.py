@@ -0,0 +1,116 @@
+'''
+Module for reading the raw csv files with an explicit schema (raw csv --> typed DataFrame)
+
+Columns are parsed straight into the dtypes of TRAIN_SCHEMA / TEST_SCHEMA in preprocess.py
+(float32 coordinates, uint8 counts, categorical flags) instead of being inferred as
+int64/float64/object, and datetimes are parsed with their fixed format (DATETIME_FORMAT).
+
+Parsing is done by pyarrow's csv reader: the file is split into byte range blocks on line
+boundaries that are parsed in parallel by its thread pool, and datetimes never go through
+python strings (in pd.read_csv, reading them as strings is most of the load time).
+'''
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+
+from .preprocess import DATETIME_FORMAT
+
+
+# uncompressed bytes per block parsed by one thread
+DEFAULT_BLOCK_SIZE = 16 << 20
+
+def _arrow_type(dtype):
+    if isinstance(dtype, pd.CategoricalDtype):
+        return pa.dictionary(pa.int32(), pa.string())
+    if str(dtype).startswith('datetime64'):
+        return pa.timestamp('ns')
+    if str(dtype) == 'object':
+        return pa.string()
+    return pa.from_numpy_dtype(dtype)
+
+def _options(schema, columns, n_jobs, block_size):
+    read_options = pv.ReadOptions(use_threads=n_jobs != 1, block_size=block_size)
+    convert_options = pv.ConvertOptions(
+        column_types={col:_arrow_type(schema[col]) for col in columns},
+        include_columns=columns,
+        timestamp_parsers=[DATETIME_FORMAT],
+    )
+    return read_options, convert_options
+
+def _to_pandas(table, schema):
+    df = table.to_pandas()
+    # categories of the dictionary are in order of appearance, fixed to the schema categories
+    categorical = {col:schema[col] for col in df.columns if isinstance(schema[col], pd.CategoricalDtype)}
+    return df.astype(categorical) if categorical else df
+
+def _columns(schema, columns):
+    # selected columns in file order
+    return [col for col in schema if col in columns] if columns else list(schema)
+
+def read_csv_typed(fname, schema, columns=None, n_jobs=-1, block_size=DEFAULT_BLOCK_SIZE):
+    '''
+    Read a raw csv file with the dtypes of schema
+
+    schema: dict
+        - column -> dtype, in file order (e.g. TRAIN_SCHEMA from preprocess.py)
+    columns: list
+        - only parse these columns
+    n_jobs: int
+        - 1 parses the blocks in the calling thread, anything else uses pyarrow's thread pool
+    '''
+    columns = _columns(schema, columns)
+    read_options, convert_options = _options(schema, columns, n_jobs, block_size)
+    table = pv.read_csv(fname, read_options=read_options, convert_options=convert_options)
+    return _to_pandas(table, schema)
+
+def byte_ranges(fname, n_ranges=None, range_size=None):
+    '''
+    (start, stop) byte offsets splitting the rows of fname (after the header) into n_ranges
+    parts or parts of about range_size bytes, every range starts at the beginning of a line
+    '''
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        f.readline()
+        bounds = [f.tell()]
+        n_ranges = n_ranges or max(1, -(-(size - bounds[0]) // range_size))
+        for i in range(1, n_ranges):
+            f.seek(max(bounds[0] + (size - bounds[0]) * i // n_ranges, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def read_csv_range(fname, schema, start, stop, columns=None):
+    '''
+    Typed DataFrame of the rows in bytes [start, stop) of fname (a range from byte_ranges),
+    lets separate processes each parse their own part of a file
+    '''
+    columns = _columns(schema, columns)
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        data = f.read(stop - start)
+    read_options, convert_options = _options(schema, columns, 1, DEFAULT_BLOCK_SIZE)
+    read_options.column_names = list(schema)
+    table = pv.read_csv(pa.BufferReader(data), read_options=read_options, convert_options=convert_options)
+    return _to_pandas(table, schema)
+
+def read_csv_typed_chunks(fname, schema, chunksize, columns=None, block_size=DEFAULT_BLOCK_SIZE):
+    '''
+    Iterate over a raw csv file as typed DataFrames of chunksize rows (the last one may be shorter)
+    '''
+    columns = _columns(schema, columns)
+    read_options, convert_options = _options(schema, columns, -1, block_size)
+    reader = pv.open_csv(fname, read_options=read_options, convert_options=convert_options)
+    pending, n_pending = [], 0
+    for batch in reader:
+        pending.append(batch)
+        n_pending += batch.num_rows
+        while n_pending >= chunksize:
+            table = pa.Table.from_batches(pending)
+            yield _to_pandas(table.slice(0, chunksize), schema)
+            rest = table.slice(chunksize)
+            pending, n_pending = rest.to_batches(), rest.num_rows
+    if n_pending:
+        yield _to_pandas(pa.Table.from_batches(pending), schema)
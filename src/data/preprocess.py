@@ -9,70 +9,289 @@ import numpy as np
 
 NYC_MIN_LON, NYC_MAX_LON = -74.4, -73.4 # approx from google map
 NYC_MIN_LAT, NYC_MAX_LAT = float(40.0), 41.6
+DEFAULT_CHUNKSIZE = 500_000
+
+# raw csv layouts (column order of the files) and the dtypes they are read with (see ingest.py)
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+TRAIN_SCHEMA = {
+    'id': 'object',
+    'vendor_id': 'uint8',
+    'pickup_datetime': 'datetime64[ns]',
+    'dropoff_datetime': 'datetime64[ns]',
+    'passenger_count': 'uint8',
+    'pickup_longitude': 'float32',
+    'pickup_latitude': 'float32',
+    'dropoff_longitude': 'float32',
+    'dropoff_latitude': 'float32',
+    'store_and_fwd_flag': pd.CategoricalDtype(['N', 'Y']),
+    'trip_duration': 'uint32',
+}
+TEST_SCHEMA = {col:dtype for col, dtype in TRAIN_SCHEMA.items() if col not in ('dropoff_datetime', 'trip_duration')}
 
 def train_data_df_format():
     # returns empty df with the correct column names for training data
-    raise NotImplementedError
+    return pd.DataFrame({col:pd.Series(dtype=dtype) for col, dtype in TRAIN_SCHEMA.items()})
 
 def test_data_df_format():
     # returns empty df with the correct column names for test data
-    raise NotImplementedError
+    return pd.DataFrame({col:pd.Series(dtype=dtype) for col, dtype in TEST_SCHEMA.items()})
 
 def drop_zero_records(df, cols:list=None):
     # return read_raw_data()
-    # drop records with 0 in the columns specified 
+    # drop records with 0 (or missing values) in the columns specified
     if not cols:
         cols = df.select_dtypes('number').columns
-    temp_df = df.copy()
-    dtypes = dict(df.dtypes)
-    for col in cols:
-        temp_df.loc[temp_df[col]==0, [col]] = np.nan
-        temp_df.dropna(axis=0, subset=[col], inplace=True)
-    return temp_df.astype(dtypes) # int cols will get converted to float when replacing nulls
+    values = df[cols]
+    return df[(values.ne(0) & values.notna()).all(axis=1)]
 
-def drop_statistical_outliers(df, cols:list=None):
+def drop_statistical_outliers(df, cols:list=None, col_stats:dict=None):
     # drop records with outlying values in the columns specified
     # outliers are further than 3 SDs from the mean
+    # col_stats maps col -> (mean, std), e.g. from RunningStats, otherwise computed from df
     if not cols:
-        cols = df.select_dtypes('number').columns
-    temp_df = df.copy()
-    col_stats = {col:(temp_df[col].mean(), temp_df[col].std()) for col in cols}
+        cols = list(col_stats) if col_stats else df.select_dtypes('number').columns
+    if col_stats is None:
+        col_stats = {col:(df[col].mean(), df[col].std()) for col in cols}
+    mask = np.ones(len(df), dtype=bool)
     for col in cols:
         col_lower = col_stats[col][0] - 3*col_stats[col][1] 
         col_upper = col_stats[col][0] + 3*col_stats[col][1] 
-        temp_df = temp_df[(temp_df[col] < col_upper) & (temp_df[col] > col_lower)]
-    return temp_df
+        mask &= (df[col] < col_upper).to_numpy() & (df[col] > col_lower).to_numpy()
+    return df[mask]
 
 def drop_minmax(df, col, min_to_keep, max_to_keep):
     # drop values above max_to_keep or below min_to_keep
     return df[(df[col] <= max_to_keep) & (df[col] >= min_to_keep)]
 
+def drop_nyc_minmax(df):
+    # drop trips with pickup or dropoff outside of the NYC bounding box
+    df = drop_minmax(df, 'pickup_latitude', NYC_MIN_LAT, NYC_MAX_LAT)
+    df = drop_minmax(df, 'pickup_longitude', NYC_MIN_LON, NYC_MAX_LON)
+    df = drop_minmax(df, 'dropoff_latitude', NYC_MIN_LAT, NYC_MAX_LAT)
+    df = drop_minmax(df, 'dropoff_longitude', NYC_MIN_LON, NYC_MAX_LON)
+    return df
+
+class RunningStats:
+    '''
+    Single-pass mean/std accumulator (Welford), updated one chunk at a time
+
+    Chunks are merged with the parallel form of Welford's algorithm so the result matches
+    df[col].mean() / df[col].std() over the concatenated chunks (NaNs are skipped like pandas).
+    '''
+    def __init__(self, cols):
+        self.cols = list(cols)
+        self.n = np.zeros(len(self.cols))
+        self.mean = np.zeros(len(self.cols))
+        self.m2 = np.zeros(len(self.cols))
+
+    def update(self, df):
+        return self.update_values(df[self.cols].to_numpy(dtype=np.float64))
+
+    def update_values(self, values):
+        # values: (n_rows, len(cols)) float array
+        n_chunk = np.sum(~np.isnan(values), axis=0)
+        seen = n_chunk > 0
+        if not seen.any():
+            return self
+        mean_chunk = np.zeros(len(self.cols))
+        mean_chunk[seen] = np.nanmean(values[:, seen], axis=0)
+        m2_chunk = np.nansum((values - mean_chunk)**2, axis=0)
+
+        n = self.n + n_chunk
+        delta = mean_chunk - self.mean
+        weight = np.divide(n_chunk, n, out=np.zeros_like(n), where=n > 0)
+        self.mean += delta * weight
+        self.m2 += m2_chunk + delta**2 * self.n * weight
+        self.n = n
+        return self
+
+    @property
+    def std(self):
+        # sample standard deviation (ddof=1) like pandas
+        return np.sqrt(self.m2 / np.maximum(self.n - 1, 1))
+
+    def col_stats(self):
+        return {col:(mean, std) for col, mean, std in zip(self.cols, self.mean, self.std)}
+
+class OutlierFilter:
+    '''
+    Drop outlying rows with per column bounds that are fitted once and then reused
+
+    nonzero_cols: list
+        - drop rows with 0 or missing values in these columns
+    minmax: dict
+        - col -> (min_to_keep, max_to_keep), fixed bounds such as the NYC geofence
+    sigma_cols: list
+        - drop rows further than n_sigma SDs from the mean, defaults to all numeric columns
+          (pass [] to disable), statistics come from the rows that pass the fixed rules above
+    quantile_cols: list
+        - drop rows outside of the quantiles range of these columns (needs fit on the full data)
+
+    All bounds are kept in bounds_ and applied with a single vectorized mask, so the fitted
+    filter can be applied to new chunks or served data without recomputing statistics.
+    '''
+    def __init__(self, nonzero_cols=None, minmax=None, sigma_cols=None, n_sigma=3, quantile_cols=None, quantiles=(0.001, 0.999)):
+        self.nonzero_cols = list(nonzero_cols or [])
+        self.minmax = dict(minmax or {})
+        self.sigma_cols = sigma_cols
+        self.n_sigma = n_sigma
+        self.quantile_cols = list(quantile_cols or [])
+        self.quantiles = quantiles
+        self.reset()
+
+    def reset(self):
+        self._stats = None
+        self._quantile_bounds = {}
+        self.bounds_ = self._merge_bounds()
+        return self
+
+    @staticmethod
+    def _inclusive(lower, upper, exclusive):
+        # all bounds are stored as inclusive [lower, upper]
+        if exclusive:
+            return np.nextafter(lower, np.inf), np.nextafter(upper, -np.inf)
+        return float(lower), float(upper)
+
+    def _merge_bounds(self, include_fitted=True):
+        # intersection of every rule per column
+        rules = [(col, *self._inclusive(lower, upper, False)) for col, (lower, upper) in self.minmax.items()]
+        if include_fitted:
+            if self._stats is not None:
+                for col, (mean, std) in self._stats.col_stats().items():
+                    rules.append((col, *self._inclusive(mean - self.n_sigma*std, mean + self.n_sigma*std, True)))
+            rules += [(col, lower, upper) for col, (lower, upper) in self._quantile_bounds.items()]
+        bounds = {}
+        for col, lower, upper in rules:
+            prev_lower, prev_upper = bounds.get(col, (-np.inf, np.inf))
+            bounds[col] = (max(prev_lower, lower), min(prev_upper, upper))
+        return bounds
+
+    def _mask(self, df, bounds):
+        mask = np.ones(len(df), dtype=bool)
+        if self.nonzero_cols:
+            values = df[self.nonzero_cols].to_numpy(dtype=np.float64)
+            mask &= ((values != 0) & ~np.isnan(values)).all(axis=1)
+        if bounds:
+            cols = list(bounds)
+            lower, upper = np.array([bounds[col] for col in cols]).T
+            values = df[cols].to_numpy(dtype=np.float64)
+            # NaN fails both comparisons and is dropped like in drop_minmax
+            mask &= ((values >= lower) & (values <= upper)).all(axis=1)
+        return mask
+
+    def _sigma_cols(self, df):
+        if self.sigma_cols is None:
+            return list(df.select_dtypes('number').columns)
+        return list(self.sigma_cols)
+
+    def partial_fit(self, df):
+        '''
+        Update the mean/std of sigma_cols with a chunk (RunningStats), for streaming data
+        '''
+        if self.quantile_cols:
+            raise ValueError('quantile bounds need fit() on the full data')
+        fixed_mask = self._mask(df, self._merge_bounds(include_fitted=False))
+        if self._stats is None:
+            self._stats = RunningStats(self._sigma_cols(df))
+        self._stats.update_values(df[self._stats.cols].to_numpy(dtype=np.float64)[fixed_mask])
+        self.bounds_ = self._merge_bounds()
+        return self
+
+    def fit(self, df):
+        self.reset()
+        fixed_mask = self._mask(df, self._merge_bounds(include_fitted=False))
+        sigma_cols = self._sigma_cols(df)
+        if sigma_cols:
+            self._stats = RunningStats(sigma_cols)
+            self._stats.update_values(df[sigma_cols].to_numpy(dtype=np.float64)[fixed_mask])
+        for col in self.quantile_cols:
+            lower, upper = np.nanquantile(df[col].to_numpy(dtype=np.float64)[fixed_mask], self.quantiles)
+            self._quantile_bounds[col] = (lower, upper)
+        self.bounds_ = self._merge_bounds()
+        return self
+
+    def mask(self, df):
+        # boolean array, True for the rows to keep
+        return self._mask(df, self.bounds_)
+
+    def transform(self, df):
+        return df[self.mask(df)]
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+def nyc_outlier_filter():
+    # the cleaning rules of main(): passenger_count > 0, NYC bounding box, 3 SDs on numeric columns
+    return OutlierFilter(
+        nonzero_cols=['passenger_count'],
+        minmax={
+            'pickup_latitude': (NYC_MIN_LAT, NYC_MAX_LAT),
+            'pickup_longitude': (NYC_MIN_LON, NYC_MAX_LON),
+            'dropoff_latitude': (NYC_MIN_LAT, NYC_MAX_LAT),
+            'dropoff_longitude': (NYC_MIN_LON, NYC_MAX_LON),
+        },
+    )
+
+def preprocess_streaming(chunks_factory, outlier_filter=None):
+    '''
+    Clean raw data chunk by chunk with memory bounded by the chunk size
+
+    chunks_factory: callable
+        - returns a fresh iterator of raw data chunks, it is called twice
+          (e.g. lambda: read_raw_data_chunks(fname, chunksize))
+    outlier_filter: OutlierFilter
+        - defaults to nyc_outlier_filter()
+
+    Pass 1 accumulates the mean/std of every numeric column over the rows that pass the
+    zero and minmax filters. Pass 2 applies all the fitted bounds and yields the cleaned chunks.
+    '''
+    outlier_filter = outlier_filter or nyc_outlier_filter()
+    outlier_filter.reset()
+    for chunk in chunks_factory():
+        outlier_filter.partial_fit(chunk)
+
+    for chunk in chunks_factory():
+        yield outlier_filter.transform(chunk)
+
 def main():
     # import inside main() to prevent error when notebook imports function from this module
     # from notebook it doesn't see the correct path
     # but when we execute this script it will import read raw data
-    from read import read_raw_data 
-
-    print('Reading raw data....')
-    df = read_raw_data() # must be executed from main directory for the default filepath to work
+    import argparse
+    import os
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from src.data.read import read_raw_data, read_raw_data_chunks
+    from src.data.storage import ParquetChunkWriter, write_parquet
+    from src.instrument import span
 
-    print('Dropping zero records....')
-    df = drop_zero_records(df, ['passenger_count'])
+    parser = argparse.ArgumentParser(description='Clean raw data (raw --> interim)')
+    parser.add_argument('--chunksize', type=int, default=None,
+        help=f'stream the raw csv in chunks of this many rows (e.g. {DEFAULT_CHUNKSIZE})')
+    args = parser.parse_args()
 
-    print('Dropping outliers by minmax values....')
-    df = drop_minmax(df, 'pickup_latitude', NYC_MIN_LAT, NYC_MAX_LAT)
-    df = drop_minmax(df, 'pickup_longitude', NYC_MIN_LON, NYC_MAX_LON)
-    df = drop_minmax(df, 'dropoff_latitude', NYC_MIN_LAT, NYC_MAX_LAT)
-    df = drop_minmax(df, 'dropoff_longitude', NYC_MIN_LON, NYC_MAX_LON)
+    if args.chunksize:
+        print(f'Cleaning raw data in chunks of {args.chunksize} rows, saving to data/interim/train.parquet....')
+        chunks = preprocess_streaming(lambda: read_raw_data_chunks(chunksize=args.chunksize))
+        with span('preprocess.streaming', chunksize=args.chunksize) as record, \
+                ParquetChunkWriter('data/interim/train.parquet') as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+            record['rows'] = writer.n_rows
+    else:
+        print('Reading raw data....')
+        df = read_raw_data() # must be executed from main directory for the default filepath to work
 
-    print('Dropping statistical outliers....')
-    df = drop_statistical_outliers(df)
+        print('Dropping zero records, outliers by minmax values and statistical outliers....')
+        with span('preprocess.clean', len(df)):
+            df = nyc_outlier_filter().fit_transform(df)
 
-    print('Saving data to data/interim/train.pkl')
-    # df.to_csv('data/interim/train.csv', index=False)
-    df.to_pickle('data/interim/train.pkl')
+        print('Saving data to data/interim/train.parquet')
+        # sorted by pickup time so that month filters can skip row groups
+        with span('preprocess.write', len(df)):
+            write_parquet(df, 'data/interim/train.parquet', sort_by='pickup_datetime')
 
     print('DONE')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,21 +1,39 @@
 '''
 Module for reading data.
 '''
-import pandas as pd
+from .ingest import read_csv_typed, read_csv_typed_chunks
+from .preprocess import TRAIN_SCHEMA, TEST_SCHEMA
+from .storage import read_table_file
+from ..instrument import instrumented
 
 
-def read_raw_data(fname='data/raw/train.csv'):
-    return pd.read_csv(fname, parse_dates=['pickup_datetime', 'dropoff_datetime'])
+# raw csv files are parsed with the schemas of preprocess.py (see ingest.py),
+# blocks of the file are parsed in parallel unless n_jobs=1
 
-def read_test_data(fname='data/raw/test.csv'):
-    return pd.read_csv(fname, parse_dates=['pickup_datetime'])
+@instrumented(rows='output')
+def read_raw_data(fname='data/raw/train.csv', columns=None, n_jobs=-1):
+    return read_csv_typed(fname, TRAIN_SCHEMA, columns, n_jobs)
+
+def read_raw_data_chunks(fname='data/raw/train.csv', chunksize=500_000, columns=None):
+    # iterator of DataFrames with chunksize rows each
+    return read_csv_typed_chunks(fname, TRAIN_SCHEMA, chunksize, columns)
+
+@instrumented(rows='output')
+def read_test_data(fname='data/raw/test.csv', columns=None, n_jobs=-1):
+    return read_csv_typed(fname, TEST_SCHEMA, columns, n_jobs)
     
-def read_interim_data(fname='data/interim/train.pkl'):
-    return pd.read_pickle(fname)
+# interim/processed readers take optional column projection and pyarrow filters
+# (see storage.read_parquet), legacy .pkl files are still accepted
+
+@instrumented(rows='output')
+def read_interim_data(fname='data/interim/train.parquet', columns=None, filters=None):
+    return read_table_file(fname, columns, filters)
 
-def read_processed_data(fname='data/processed/train.pkl'):
-    return pd.read_pickle(fname)
+@instrumented(rows='output')
+def read_processed_data(fname='data/processed/train.parquet', columns=None, filters=None):
+    return read_table_file(fname, columns, filters)
  
-def read_processed_test_data(fname='data/processed/test.pkl'):
-    return pd.read_pickle(fname)
+@instrumented(rows='output')
+def read_processed_test_data(fname='data/processed/test.parquet', columns=None, filters=None):
+    return read_table_file(fname, columns, filters)
 
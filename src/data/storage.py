@@ -0,0 +1,160 @@
+'''
+Module for columnar storage of interim and processed data (Parquet via pyarrow)
+
+Files are compressed and split into row groups, so readers can load only the columns
+they need and skip row groups that a filter rules out (e.g. other pickup months).
+'''
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+DEFAULT_ROW_GROUP_SIZE = 250_000
+DEFAULT_COMPRESSION = 'zstd'
+
+# dtypes used on disk for the known integer/string columns, float columns are stored as float32
+COLUMN_DTYPES = {
+    'vendor_id': 'uint8',
+    'passenger_count': 'uint8',
+    'pickup_latitude': 'float32',
+    'pickup_longitude': 'float32',
+    'dropoff_latitude': 'float32',
+    'dropoff_longitude': 'float32',
+    'store_and_fwd_flag': 'category',
+    'trip_duration': 'uint32',
+    'trip_distance': 'float32',
+    'pickup_datetime_date': 'uint8',
+    'pickup_datetime_day_of_week': 'uint8',
+    'pickup_datetime_hour': 'uint8',
+    'dropoff_datetime_date': 'uint8',
+    'dropoff_datetime_day_of_week': 'uint8',
+    'dropoff_datetime_hour': 'uint8',
+    'interim_row': 'uint32',
+}
+
+def downcast_dtypes(df):
+    '''
+    Return df with compact dtypes (float32 coords, uint8 counts/hours/days, categorical flags)
+
+    The mapping is fixed per column rather than inferred from the values so that chunks
+    of the same dataset always end up with the same schema. Integer dtypes are only applied
+    to integer columns, processed (scaled) features share the names but stay float32.
+    '''
+    dtypes = {}
+    for col in df.columns:
+        kind = df[col].dtype.kind
+        if kind == 'f':
+            dtypes[col] = 'float32'
+        elif col in COLUMN_DTYPES and (kind in 'iu' or COLUMN_DTYPES[col] == 'category'):
+            dtypes[col] = COLUMN_DTYPES[col]
+    return df.astype(dtypes)
+
+def _to_table(df, schema=None):
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+def write_parquet(df, fname, sort_by=None, downcast=True, row_group_size=DEFAULT_ROW_GROUP_SIZE, compression=DEFAULT_COMPRESSION,
+        metadata=None):
+    '''
+    Write df to a parquet file
+
+    sort_by: str
+        - optional column to sort by before writing, sorting by pickup_datetime makes
+          row group statistics selective for month filters
+    metadata: dict
+        - optional str -> str key values stored in the file schema, see read_parquet_metadata
+    '''
+    if sort_by:
+        df = df.sort_values(sort_by, kind='mergesort')
+    if downcast:
+        df = downcast_dtypes(df)
+    table = _to_table(df)
+    if metadata:
+        table = table.replace_schema_metadata({**table.schema.metadata,
+            **{key.encode(): value.encode() for key, value in metadata.items()}})
+    pq.write_table(table, fname, row_group_size=row_group_size, compression=compression)
+
+def read_parquet_metadata(fname):
+    # str -> str key values of write_parquet(metadata=...), without the pandas metadata
+    metadata = pq.read_schema(fname).metadata or {}
+    return {key.decode(): value.decode() for key, value in metadata.items() if key != b'pandas'}
+
+class ParquetChunkWriter:
+    '''
+    Append DataFrame chunks to a single parquet file as they arrive
+
+    The schema is taken from the first chunk. Use as a context manager:
+
+        with ParquetChunkWriter('data/interim/train.parquet') as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    '''
+    def __init__(self, fname, downcast=True, row_group_size=DEFAULT_ROW_GROUP_SIZE, compression=DEFAULT_COMPRESSION):
+        self.fname = fname
+        self.downcast = downcast
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.n_rows = 0
+        self._schema = None
+        self._writer = None
+
+    def write(self, df):
+        if self.downcast:
+            df = downcast_dtypes(df)
+        if self._writer is None:
+            table = _to_table(df)
+            self._schema = table.schema
+            self._writer = pq.ParquetWriter(self.fname, self._schema, compression=self.compression)
+        else:
+            table = _to_table(df, schema=self._schema)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        self.n_rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_parquet(fname, columns=None, filters=None):
+    '''
+    Read a parquet file into a DataFrame
+
+    columns: list
+        - only these columns are read from disk
+    filters: list
+        - pyarrow filters, e.g. [('pickup_datetime', '>=', pd.Timestamp('2016-03-01'))],
+          row groups whose statistics don't match are skipped
+    '''
+    return pq.read_table(fname, columns=columns, filters=filters).to_pandas()
+
+def read_parquet_chunks(fname, chunksize=DEFAULT_ROW_GROUP_SIZE, columns=None):
+    '''
+    Iterate over a parquet file as DataFrames of up to chunksize rows (bounded memory)
+    '''
+    parquet_file = pq.ParquetFile(fname)
+    for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+        yield batch.to_pandas()
+
+def month_filter(months, year=2016, col='pickup_datetime'):
+    '''
+    Filters selecting rows with col in any of the given months (1-12) of year
+    '''
+    filters = []
+    for month in sorted(set(months)):
+        start = pd.Timestamp(year=year, month=month, day=1)
+        filters.append([(col, '>=', start), (col, '<', start + pd.offsets.MonthBegin(1))])
+    return filters
+
+def read_table_file(fname, columns=None, filters=None):
+    # read a .parquet file (columns/filters pushed down) or a legacy .pkl file
+    if str(fname).endswith('.pkl'):
+        if filters:
+            raise ValueError('filters are only supported for parquet files')
+        df = pd.read_pickle(fname)
+        return df[columns] if columns else df
+    return read_parquet(fname, columns, filters)
@@ -0,0 +1,333 @@
+'''
+Module for monitoring the drift of the scored trips against the training data
+
+A reference profile (models/drift_reference.npz, saved by train.py from the training data
+profile of features_train.py) holds, for each raw feature and for the predictions (log
+seconds), the bin edges of its training distribution (quantiles, or midpoints between the
+values of discrete features) and the training counts. While serving, get_features,
+make_predictions and the predictor add the scored rows to per-window histograms of the same
+bins, and drift_scores() compares the last windows with the reference (PSI and a binned KS
+statistic).
+
+Memory is constant (n_windows x n_series x (n_bins + 1) counters, windows are reused in a
+ring). Single trips and small batches are copied into a buffer of rows that is binned when
+full, larger batches are binned directly (subsampled with a stride above max_rows). Nothing
+is monitored unless enabled, with enable() or the environment variables:
+
+    NYC_CABS_DRIFT=models/drift_reference.npz     reference profile, enables the monitor
+    NYC_CABS_DRIFT_WINDOW=3600                    seconds per window (default 1 hour)
+    NYC_CABS_DRIFT_WINDOWS=24                     windows kept (default 24, the last day)
+    NYC_CABS_DRIFT_LOG=reports/drift.jsonl        append the scores when a window is closed
+
+Can be run as a script to score a file of trips against the reference (To be run from main directory only)
+    python src/drift.py data/raw/test.csv
+'''
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+
+DEFAULT_N_BINS = 20
+DEFAULT_WINDOW_SECONDS = 3600
+DEFAULT_N_WINDOWS = 24
+DEFAULT_MAX_ROWS = 10_000
+DEFAULT_BUFFER_ROWS = 256
+PREDICTION = 'prediction'
+# usual PSI rule of thumb: < 0.1 stable, 0.1 - 0.2 moderate shift, > 0.2 major shift
+PSI_THRESHOLDS = (0.1, 0.2)
+# added to the bin proportions so that empty bins don't make PSI infinite
+PSI_EPSILON = 1e-4
+
+def reference_edges(values, n_bins=DEFAULT_N_BINS):
+    '''
+    n_bins - 1 inner bin edges of values: quantiles, or midpoints between the distinct values
+    when there are at most n_bins of them (padded with inf, the bins above are then empty)
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    distinct = np.unique(values)
+    if len(distinct) <= n_bins:
+        inner = (distinct[1:] + distinct[:-1]) / 2
+    else:
+        inner = np.unique(np.quantile(values, np.linspace(0, 1, n_bins + 1)[1:-1]))
+    return np.concatenate([inner, np.full(n_bins - 1 - len(inner), np.inf)])
+
+class DriftProfile:
+    '''
+    Bin edges and counts of a set of series (feature columns and the predictions)
+
+    names: list
+        - series names, features in the order of the columns observed, then PREDICTION
+    edges: np.ndarray
+        - (n_series, n_bins - 1) inner edges, bin i holds edges[i - 1] <= x < edges[i]
+    counts: np.ndarray
+        - (n_series, n_bins + 1) counts, the last bin counts NaNs
+    '''
+    def __init__(self, names, edges, counts=None):
+        self.names = list(names)
+        self.edges = np.asarray(edges, dtype=np.float64)
+        n_bins = self.edges.shape[1] + 1
+        self.counts = np.zeros((len(self.names), n_bins + 1), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+    @property
+    def feature_names(self):
+        return [name for name in self.names if name != PREDICTION]
+
+    @classmethod
+    def from_data(cls, features_df, log_durations, n_bins=DEFAULT_N_BINS):
+        '''
+        Profile of the raw features (all columns of features_df) and of log(trip_duration),
+        the prediction counts can later be replaced with set_predictions
+        '''
+        names = list(features_df.columns) + [PREDICTION]
+        series = [features_df[col].to_numpy(dtype=np.float64) for col in features_df.columns]
+        series.append(np.asarray(log_durations, dtype=np.float64))
+        profile = cls(names, np.stack([reference_edges(values, n_bins) for values in series]))
+        for i, values in enumerate(series):
+            profile.counts[i] = profile.bin_counts(values[:, None], [i])[0]
+        return profile
+
+    def set_predictions(self, log_predictions):
+        # reference of the predictions from the model predictions (e.g. on validation data)
+        i = self.names.index(PREDICTION)
+        self.counts[i] = self.bin_counts(np.asarray(log_predictions, dtype=np.float64)[:, None], [i])[0]
+
+    def bin_counts(self, X, series):
+        '''
+        (len(series), n_bins + 1) counts of the columns of X (n_rows, len(series)) in the bins
+        of the given series indices
+        '''
+        edges = self.edges[series]
+        n_series, n_bins = edges.shape[0], edges.shape[1] + 1
+        # bin = number of inner edges <= x, NaN in the last bin
+        bins = np.sum(edges[None, :, :] <= X[:, :, None], axis=2)
+        bins[np.isnan(X)] = n_bins
+        flat = bins + np.arange(n_series) * (n_bins + 1)
+        return np.bincount(flat.ravel(), minlength=n_series * (n_bins + 1)).reshape(n_series, n_bins + 1)
+
+    def save(self, fpath):
+        np.savez(fpath, names=np.array(self.names), edges=self.edges, counts=self.counts)
+
+    @classmethod
+    def load(cls, fpath):
+        with np.load(fpath) as arrays:
+            return cls(arrays['names'].tolist(), arrays['edges'], arrays['counts'])
+
+def drift_statistics(reference_counts, counts):
+    '''
+    PSI and binned KS statistic (max difference of the CDFs at the bin edges) of each row
+    of counts against the same row of reference_counts
+    '''
+    p = reference_counts / np.maximum(reference_counts.sum(axis=1, keepdims=True), 1)
+    q = counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+    psi = np.sum((q - p) * np.log((q + PSI_EPSILON) / (p + PSI_EPSILON)), axis=1)
+    ks = np.max(np.abs(np.cumsum(q, axis=1) - np.cumsum(p, axis=1)), axis=1)
+    return psi, ks
+
+class DriftMonitor:
+    '''
+    Rolling window histograms of the observed features and predictions (thread safe)
+
+    reference: DriftProfile
+        - bins and training counts
+    window_seconds, n_windows: int
+        - the scores cover the last n_windows windows of window_seconds
+    max_rows: int
+        - larger batches are subsampled to about max_rows rows
+    buffer_rows: int
+        - small batches are copied into a buffer of buffer_rows rows, binned when it is full
+    log_fpath: str
+        - jsonl file the scores are appended to when a window is closed
+    '''
+    def __init__(self, reference, window_seconds=DEFAULT_WINDOW_SECONDS, n_windows=DEFAULT_N_WINDOWS,
+            max_rows=DEFAULT_MAX_ROWS, buffer_rows=DEFAULT_BUFFER_ROWS, log_fpath=None, clock=time.time):
+        n_features = len(reference.feature_names)
+        if reference.names[n_features:] != [PREDICTION]:
+            raise ValueError(f'the last series of the reference must be {PREDICTION!r}')
+        self.reference = reference
+        self.window_seconds = window_seconds
+        self.max_rows = max_rows
+        self.log_fpath = log_fpath
+        self.clock = clock
+        self._counts = np.zeros((n_windows,) + reference.counts.shape, dtype=np.int64)
+        self._window_ids = np.full(n_windows, -1, dtype=np.int64)
+        self._current = None
+        self._lock = threading.Lock()
+        # series of the features and of the predictions, each with a buffer of rows not binned yet
+        self._series = [slice(0, n_features), slice(n_features, n_features + 1)]
+        self._buffers = [np.empty((buffer_rows, n_features)), np.empty((buffer_rows, 1))]
+        self._filled = [0, 0]
+        # column index of the profile features in a given column order (None if the same), cached per order
+        self._col_orders = {}
+
+    def _flush(self, i):
+        # bin the buffered rows of series set i into the current window
+        if self._filled[i]:
+            series = self._series[i]
+            self._counts[self._current, series] += self.reference.bin_counts(self._buffers[i][:self._filled[i]], series)
+            self._filled[i] = 0
+
+    def _slot(self, now):
+        # ring slot of the current window, reset when it held an older window
+        window_id = int(now // self.window_seconds)
+        slot = window_id % len(self._window_ids)
+        if self._window_ids[slot] != window_id:
+            if self._current is not None:
+                for i in range(len(self._series)):
+                    self._flush(i)
+                if self.log_fpath:
+                    self._log(int(self._window_ids[self._current]))
+            self._counts[slot] = 0
+            self._window_ids[slot] = window_id
+        self._current = slot
+        return slot
+
+    def _log(self, closed_window_id):
+        record = {'window_end': (closed_window_id + 1) * self.window_seconds, 'scores': self._scores(closed_window_id)}
+        with open(self.log_fpath, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def _observe(self, X, i):
+        if len(X) > self.max_rows:
+            X = X[::-(-len(X) // self.max_rows)]
+        buffer = self._buffers[i]
+        # batches that don't fit in the buffer are binned outside of the lock
+        counts = self.reference.bin_counts(X, self._series[i]) if len(X) > len(buffer) else None
+        with self._lock:
+            slot = self._slot(self.clock())
+            if counts is not None:
+                self._counts[slot, self._series[i]] += counts
+                return
+            if self._filled[i] + len(X) > len(buffer):
+                self._flush(i)
+            buffer[self._filled[i]:self._filled[i] + len(X)] = X
+            self._filled[i] += len(X)
+
+    def observe_features(self, X, cols=None):
+        '''
+        X: pd.DataFrame with the profile features, or array (n_rows, len(cols)) with the columns cols
+        '''
+        if hasattr(X, 'columns'):
+            X = X[self.reference.feature_names].to_numpy(dtype=np.float64)
+        else:
+            X = np.asarray(X, dtype=np.float64).reshape(-1, len(cols))
+            cols = tuple(cols)
+            if cols not in self._col_orders:
+                order = [cols.index(name) for name in self.reference.feature_names]
+                self._col_orders[cols] = None if order == list(range(len(cols))) else order
+            order = self._col_orders[cols]
+            if order is not None:
+                X = X[:, order]
+        self._observe(X, 0)
+
+    def observe_predictions(self, predictions):
+        # predictions in seconds, monitored as log seconds like the model output
+        self._observe(np.log(np.asarray(predictions, dtype=np.float64)).reshape(-1, 1), 1)
+
+    def _scores(self, last_window_id):
+        live = (self._window_ids > last_window_id - len(self._window_ids)) & (self._window_ids <= last_window_id)
+        counts = self._counts[live].sum(axis=0)
+        psi, ks = drift_statistics(self.reference.counts, counts)
+        scores = {}
+        for name, n, psi_i, ks_i in zip(self.reference.names, counts.sum(axis=1), psi, ks):
+            if not n:
+                scores[name] = {'n': 0, 'psi': None, 'ks': None, 'status': 'no data'}
+                continue
+            status = 'stable' if psi_i < PSI_THRESHOLDS[0] else 'moderate' if psi_i < PSI_THRESHOLDS[1] else 'major'
+            scores[name] = {'n': int(n), 'psi': float(psi_i), 'ks': float(ks_i), 'status': status}
+        return scores
+
+    def scores(self):
+        '''
+        {series: {'n', 'psi', 'ks', 'status'}} over the last n_windows windows
+        '''
+        with self._lock:
+            now = self._window_ids[self._slot(self.clock())]
+            for i in range(len(self._series)):
+                self._flush(i)
+            return self._scores(int(now))
+
+_monitor = None
+_enable_lock = threading.Lock()
+
+def enable(reference_fpath, **kwargs):
+    '''
+    Monitor the calls of the hooks below with a DriftMonitor of the saved profile (kwargs as in DriftMonitor)
+    '''
+    global _monitor
+    with _enable_lock:
+        _monitor = DriftMonitor(DriftProfile.load(reference_fpath), **kwargs)
+    return _monitor
+
+def disable():
+    global _monitor
+    _monitor = None
+
+def get_monitor():
+    return _monitor
+
+if os.environ.get('NYC_CABS_DRIFT'):
+    enable(
+        os.environ['NYC_CABS_DRIFT'],
+        window_seconds=float(os.environ.get('NYC_CABS_DRIFT_WINDOW', DEFAULT_WINDOW_SECONDS)),
+        n_windows=int(os.environ.get('NYC_CABS_DRIFT_WINDOWS', DEFAULT_N_WINDOWS)),
+        log_fpath=os.environ.get('NYC_CABS_DRIFT_LOG'),
+    )
+
+# hooks called from the scoring code, a no-op unless the monitor is enabled
+# (rows without the profile features, e.g. other column sets, are not monitored)
+
+def observe_features(X, cols=None):
+    if _monitor is not None:
+        try:
+            _monitor.observe_features(X, cols)
+        except (KeyError, ValueError, TypeError):
+            pass
+
+def observe_predictions(predictions):
+    if _monitor is not None:
+        _monitor.observe_predictions(predictions)
+
+def drift_scores():
+    return _monitor.scores() if _monitor is not None else None
+
+def main():
+    import argparse
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from src.models.predictor import load_predictor
+    from src.data.read import read_interim_data, read_test_data
+    from src.features import TripFeatureBuilder
+    # the scoring code calls the hooks of src.drift, not of this script module
+    from src import drift
+
+    parser = argparse.ArgumentParser(description='Drift scores of a file of trips against the training reference')
+    parser.add_argument('input', help='raw test .csv or interim .parquet')
+    parser.add_argument('--reference', default='models/drift_reference.npz')
+    parser.add_argument('--model', default='models/best_estimator.joblib')
+    parser.add_argument('--preprocessing', default='models/preprocessing_affine.npz')
+    args = parser.parse_args()
+
+    monitor = drift.enable(args.reference, max_rows=sys.maxsize)
+    print(f'Reading {args.input}....')
+    df = read_test_data(args.input) if args.input.endswith('.csv') else read_interim_data(args.input)
+
+    print('Scoring trips....')
+    predictor = load_predictor(args.model, args.preprocessing)
+    features_df = TripFeatureBuilder(cols=predictor.cols).transform_df(df)
+    predictor.predict_features(features_df[predictor.cols].to_numpy())
+
+    print(f"{'series':<30} {'n':>9} {'psi':>8} {'ks':>7}  status")
+    for name, score in monitor.scores().items():
+        if score['n']:
+            print(f"{name:<30} {score['n']:>9} {score['psi']:>8.4f} {score['ks']:>7.4f}  {score['status']}")
+        else:
+            print(f"{name:<30} {0:>9} {'':>8} {'':>7}  {score['status']}")
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,44 @@
-from .features import (
-    features_cols,
-    get_target,
-    get_features,
-    decompose_pickup_datetime_features,
-    decompose_dropoff_datetime_features,
-    compute_trip_distance,
-    combine_features_target,
-)
-
-from .features_train import create_preprocessing_pl
\ No newline at end of file
+'''
+Feature engineering package
+
+Submodules are imported on first access of one of their names (PEP 562 module __getattr__),
+so e.g. the compiled preprocessing used by the app doesn't import sklearn or the training code.
+'''
+import importlib
+
+
+# exported name -> submodule defining it
+_EXPORTS = {
+    'features_cols': 'features',
+    'get_target': 'features',
+    'get_features': 'features',
+    'decompose_pickup_datetime_features': 'features',
+    'decompose_dropoff_datetime_features': 'features',
+    'compute_trip_distance': 'features',
+    'combine_features_target': 'features',
+    'haversine': 'distance',
+    'manhattan': 'distance',
+    'bearing': 'distance',
+    'trip_distance_chunked': 'distance',
+    'TripFeatureBuilder': 'builder',
+    'CompiledPreprocessing': 'compiled',
+    'compile_preprocessing_pl': 'compiled',
+    'check_equivalence': 'compiled',
+    'check_fingerprint': 'compiled',
+    'create_preprocessing_pl': 'features_train',
+    'StratifiedSampler': 'sampling',
+    'load_sample': 'sampling',
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_EXPORTS[name]}', __name__), name)
+    # cached so that __getattr__ is only called once per name
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
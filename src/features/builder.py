@@ -0,0 +1,140 @@
+'''
+Module for building model features in a single pass (interim/test --> raw feature matrix)
+
+TripFeatureBuilder computes only the columns of features_cols() and writes them directly
+into a preallocated float32 matrix, without copying the input DataFrame.
+'''
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from .distance import haversine, DEFAULT_CHUNKSIZE
+from .features import features_cols, SPATIAL_COLS
+from ..instrument import instrumented
+
+
+def _datetime_parts(values, out_date=None, out_day_of_week=None, out_hour=None):
+    # day of month, day of week (Monday is 0) and hour of datetime64 values, float outputs,
+    # NaT gives NaN (as .dt.day/.dt.hour) so that the imputer fills it
+    days = values.astype('datetime64[D]')
+    nat = np.isnat(values)
+    parts = []
+    if out_date is not None:
+        out_date[:] = (days - days.astype('datetime64[M]')).astype(np.int64) + 1
+        parts.append(out_date)
+    if out_day_of_week is not None:
+        # 1970-01-01 was a Thursday
+        out_day_of_week[:] = (days.astype(np.int64) + 3) % 7
+        parts.append(out_day_of_week)
+    if out_hour is not None:
+        out_hour[:] = (values - days).astype('timedelta64[h]').astype(np.int64)
+        parts.append(out_hour)
+    if nat.any():
+        for out in parts:
+            out[nat] = np.nan
+
+class TripFeatureBuilder(BaseEstimator, TransformerMixin):
+    '''
+    sklearn transformer from trips (interim/test DataFrame) to the raw features_cols() matrix
+
+    cols: list
+        - feature columns to build, defaults to features_cols()[0]
+    chunksize: int
+        - rows per chunk, bounds the temporary memory used for distances and datetime parts
+    od_table: ODPriorTable
+        - fitted zone-to-zone priors (spatial.py), needed for the features_cols(spatial=True) columns
+
+    Same features as decompose_pickup_datetime_features + compute_trip_distance, but the
+    result is a float32 array of shape (n_rows, len(cols)) instead of a copy of the input.
+    Trips without a pickup datetime column (e.g. the synthetic trips of a heatmap grid) can
+    give the pickup_datetime_* columns directly.
+    '''
+    def __init__(self, cols=None, pickup_datetime_col='pickup_datetime', chunksize=DEFAULT_CHUNKSIZE, od_table=None):
+        self.cols = cols
+        self.pickup_datetime_col = pickup_datetime_col
+        self.chunksize = chunksize
+        self.od_table = od_table
+
+    def get_feature_names_out(self, input_features=None):
+        return np.array(self.cols or features_cols()[0], dtype=object)
+
+    def fit(self, X, y=None):
+        # stateless, kept for the sklearn API
+        return self
+
+    @instrumented()
+    def transform(self, X, out=None):
+        '''
+        X: pd.DataFrame
+            - trips with pickup/dropoff coordinates and pickup datetime (or pickup_datetime_* columns)
+        out: np.ndarray
+            - optional preallocated array of shape (len(X), len(cols)), float32 unless given
+        '''
+        cols = list(self.get_feature_names_out())
+        n_rows = len(X)
+        if out is None:
+            out = np.empty((n_rows, len(cols)), dtype=np.float32)
+        elif out.shape != (n_rows, len(cols)):
+            raise ValueError(f'out has shape {out.shape}, expected {(n_rows, len(cols))}')
+        col_idx = {col:i for i, col in enumerate(cols)}
+
+        datetime_parts = {
+            'pickup_datetime_date': 'out_date',
+            'pickup_datetime_day_of_week': 'out_day_of_week',
+            'pickup_datetime_hour': 'out_hour',
+        }
+        needs_spatial = any(col in col_idx for col in SPATIAL_COLS)
+        if needs_spatial and self.od_table is None:
+            raise ValueError(f'od_table is needed to build {SPATIAL_COLS}')
+        # without a pickup datetime, its parts are taken as is from X
+        has_datetime = self.pickup_datetime_col in X
+        needs_datetime = has_datetime and (needs_spatial or any(col in col_idx for col in datetime_parts))
+        if needs_datetime:
+            pickup_datetime = pd.to_datetime(X[self.pickup_datetime_col]).to_numpy()
+        if needs_spatial and not has_datetime:
+            hours = X['pickup_datetime_hour'].to_numpy(dtype=np.float64)
+        if 'trip_distance' in col_idx or needs_spatial:
+            coords = [X[col].to_numpy() for col in ('pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude')]
+
+        for start in range(0, n_rows, self.chunksize):
+            stop = min(start + self.chunksize, n_rows)
+            block = out[start:stop]
+            if 'trip_distance' in col_idx:
+                block[:, col_idx['trip_distance']] = haversine(*[c[start:stop] for c in coords])
+            if needs_datetime:
+                _datetime_parts(pickup_datetime[start:stop], **{
+                    arg:block[:, col_idx[col]] for col, arg in datetime_parts.items() if col in col_idx
+                })
+            if needs_spatial:
+                if has_datetime:
+                    block_hours = np.empty(stop - start)
+                    _datetime_parts(pickup_datetime[start:stop], out_hour=block_hours)
+                else:
+                    block_hours = hours[start:stop]
+                self._spatial_features(block, col_idx, [c[start:stop] for c in coords], block_hours)
+
+        # everything else is taken as is from X (coordinates)
+        for col, i in col_idx.items():
+            if col != 'trip_distance' and not (has_datetime and col in datetime_parts) and col not in SPATIAL_COLS:
+                out[:, i] = X[col].to_numpy()
+        return out
+
+    def _spatial_features(self, block, col_idx, coords, hours):
+        # cell ids and the (pickup cell, dropoff cell, hour) prior, both plain array lookups
+        grid = self.od_table.grid
+        pickup_cells = grid.cell_ids(coords[0], coords[1])
+        dropoff_cells = grid.cell_ids(coords[2], coords[3])
+        if 'pickup_cell' in col_idx:
+            block[:, col_idx['pickup_cell']] = pickup_cells
+        if 'dropoff_cell' in col_idx:
+            block[:, col_idx['dropoff_cell']] = dropoff_cells
+        if 'od_log_duration_prior' in col_idx:
+            # no prior without a pickup hour, NaN is filled by the imputer
+            missing = np.isnan(hours)
+            prior = self.od_table.lookup(pickup_cells, dropoff_cells, np.where(missing, 0, hours).astype(np.int64))
+            prior[missing] = np.nan
+            block[:, col_idx['od_log_duration_prior']] = prior
+
+    def transform_df(self, X):
+        # same as transform, wrapped in a DataFrame (no copy) for the saved preprocessing pl
+        return pd.DataFrame(self.transform(X), columns=self.get_feature_names_out(), copy=False)
@@ -0,0 +1,113 @@
+'''
+Module for compiling the fitted preprocessing pl into a compact affine transform
+
+create_preprocessing_pl only fits a median SimpleImputer and a StandardScaler, so the whole
+pipeline is equivalent to filling NaNs per column and one multiply-add per column:
+
+    X_out = fillna(X, fill) * scale + offset    (scale = 1 / std, offset = -mean / std)
+
+The compiled artifact is a small .npz file (column names, fill, scale and offset arrays).
+Its fingerprint is stored with the processed data and the samples built from it, so that
+data scaled by another (e.g. incrementally updated, see incremental.py) pl is detected.
+'''
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+class CompiledPreprocessing:
+    '''
+    Affine equivalent of the fitted preprocessing pl
+
+    cols: list
+        - feature columns in output order
+    fill, scale, offset: np.ndarray
+        - per column NaN fill value, multiplier and offset
+    '''
+    def __init__(self, cols, fill, scale, offset):
+        self.cols = list(cols)
+        self.fill = np.asarray(fill, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+
+    def transform(self, X, out=None, dtype=np.float64):
+        '''
+        X: pd.DataFrame or np.ndarray
+            - DataFrame with self.cols, or array with the columns already in self.cols order
+        out: np.ndarray
+            - optional preallocated (n_rows, n_cols) buffer, X may be passed as out to work in place
+        dtype:
+            - dtype of out when it is allocated here, keep float64: for coordinates the offset
+              is ~1e3 times the scaled value and float32 would lose the small differences
+        '''
+        if isinstance(X, pd.DataFrame):
+            X = X[self.cols].to_numpy()
+        if out is None:
+            out = np.array(X, dtype=dtype, ndmin=2)
+        elif out is not X:
+            np.copyto(out, X, casting='same_kind')
+        np.copyto(out, self.fill.astype(out.dtype), where=np.isnan(out))
+        out *= self.scale
+        out += self.offset
+        return out
+
+    def fingerprint(self):
+        # short sha256 of the columns and the fill, scale and offset values
+        digest = hashlib.sha256('\n'.join(self.cols).encode())
+        for values in (self.fill, self.scale, self.offset):
+            digest.update(values.tobytes())
+        return digest.hexdigest()[:16]
+
+    def save(self, fpath):
+        np.savez(fpath, cols=np.array(self.cols), fill=self.fill, scale=self.scale, offset=self.offset)
+
+    @classmethod
+    def load(cls, fpath):
+        with np.load(fpath) as arrays:
+            return cls(arrays['cols'].tolist(), arrays['fill'], arrays['scale'], arrays['offset'])
+
+def compile_preprocessing_pl(preprocessing_pl):
+    '''
+    Fold the fitted pl from create_preprocessing_pl into a CompiledPreprocessing
+    '''
+    column_transformer = preprocessing_pl.named_steps['column_transformer']
+    transformers = [t for t in column_transformer.transformers_ if t[0] != 'remainder']
+    if len(transformers) != 1:
+        raise ValueError('Expected a single numeric transformer in the preprocessing pipeline')
+    _, num_pipeline, cols = transformers[0]
+    imputer = num_pipeline.named_steps['median_imputer']
+    scaler = num_pipeline.named_steps['standard_scaler']
+
+    n_cols = len(cols)
+    mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(n_cols)
+    std = scaler.scale_ if scaler.scale_ is not None else np.ones(n_cols)
+    return CompiledPreprocessing(cols, imputer.statistics_, 1 / std, -mean / std)
+
+def check_equivalence(preprocessing_pl, compiled, df, rtol=1e-6, atol=1e-9):
+    '''
+    Raise AssertionError if compiled.transform(df) differs from preprocessing_pl.transform(df)
+
+    Compared on float64 input since the sklearn pl keeps float32 input in float32.
+    '''
+    df = df.astype(np.float64)
+    expected = preprocessing_pl.transform(df)
+    actual = compiled.transform(df)
+    if expected.shape != actual.shape or not np.allclose(expected, actual, rtol=rtol, atol=atol):
+        max_diff = np.max(np.abs(expected - actual)) if expected.shape == actual.shape else None
+        raise AssertionError(f'Compiled preprocessing differs from the sklearn pipeline (max abs diff {max_diff})')
+
+def check_fingerprint(fingerprint, fpath='models/preprocessing_affine.npz', data='data/processed/train.parquet'):
+    '''
+    Raise ValueError if data was scaled by another preprocessing than the one saved at fpath
+
+    fingerprint: str
+        - CompiledPreprocessing.fingerprint() stored with data, None (data written before
+          fingerprints were stored) is not checked
+    '''
+    if fingerprint is None:
+        return
+    expected = CompiledPreprocessing.load(fpath).fingerprint()
+    if fingerprint != expected:
+        raise ValueError(f'{data} was scaled by another preprocessing pl than {fpath} ({fingerprint} != {expected}), '
+                         'rerun src/features/features_train.py (and src/features/sampling.py for the samples)')
@@ -0,0 +1,232 @@
+'''
+Module for computing trip distances with numpy ufuncs
+
+All functions take coordinates in degrees as float32 or float64 arrays and
+return results in the same dtype. They can write into a preallocated `out` buffer.
+
+Can be run as a script to benchmark against the previous np.vectorize implementation
+(To be run from main directory only)
+'''
+import numpy as np
+
+
+# Radius of earth in kilometers. Use 3956 for miles
+EARTH_RADIUS_KM = 6371
+DEFAULT_CHUNKSIZE = 1_000_000
+
+
+def _as_float_arrays(*arrays):
+    # float32 stays float32, everything else is computed in float64
+    arrays = [np.asarray(a) for a in arrays]
+    dtype = np.result_type(*arrays)
+    if dtype != np.float32:
+        dtype = np.dtype(np.float64)
+    return [a.astype(dtype, copy=False) for a in arrays], dtype
+
+def _prepare_out(out, shape, dtype):
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.shape != shape:
+        raise ValueError(f'out has shape {out.shape}, expected {shape}')
+    return out
+
+def haversine(lat1, lon1, lat2, lon2, out=None):
+    '''
+    Great circle distance in km between (lat1, lon1) and (lat2, lon2)
+
+    Same formula as the original compute_trip_distance, computed with two scratch buffers
+    instead of a temporary per operation.
+    '''
+    (lat1, lon1, lat2, lon2), dtype = _as_float_arrays(lat1, lon1, lat2, lon2)
+    shape = np.broadcast(lat1, lon1, lat2, lon2).shape
+    out = _prepare_out(out, shape, dtype)
+    half_rad = np.pi / 360
+    tmp = np.empty(shape, dtype=dtype)
+    scratch = np.empty(shape, dtype=dtype)
+
+    # sin(dlat / 2)**2
+    np.subtract(lat2, lat1, out=out)
+    out *= half_rad
+    np.sin(out, out=out)
+    np.square(out, out=out)
+
+    # cos(lat1) * cos(lat2) * sin(dlon / 2)**2
+    np.subtract(lon2, lon1, out=tmp)
+    tmp *= half_rad
+    np.sin(tmp, out=tmp)
+    np.square(tmp, out=tmp)
+    np.multiply(lat1, 2 * half_rad, out=scratch)
+    tmp *= np.cos(scratch, out=scratch)
+    np.multiply(lat2, 2 * half_rad, out=scratch)
+    tmp *= np.cos(scratch, out=scratch)
+
+    out += tmp
+    # rounding can push a slightly above 1 for antipodal points
+    np.minimum(out, 1, out=out)
+    np.sqrt(out, out=out)
+    np.arcsin(out, out=out)
+    out *= 2 * EARTH_RADIUS_KM
+    return out
+
+def manhattan(lat1, lon1, lat2, lon2, out=None):
+    '''
+    Manhattan (L1) distance in km, i.e. north-south leg plus east-west leg
+
+    The east-west leg is measured at the mean latitude of the trip.
+    '''
+    (lat1, lon1, lat2, lon2), dtype = _as_float_arrays(lat1, lon1, lat2, lon2)
+    shape = np.broadcast(lat1, lon1, lat2, lon2).shape
+    out = _prepare_out(out, shape, dtype)
+    km_per_deg = np.pi / 180 * EARTH_RADIUS_KM
+    tmp = np.empty(shape, dtype=dtype)
+
+    # east-west leg
+    np.add(lat1, lat2, out=tmp)
+    tmp *= np.pi / 360
+    np.cos(tmp, out=tmp)
+    np.subtract(lon2, lon1, out=out)
+    np.abs(out, out=out)
+    out *= tmp
+
+    # north-south leg
+    np.subtract(lat2, lat1, out=tmp)
+    np.abs(tmp, out=tmp)
+    out += tmp
+    out *= km_per_deg
+    return out
+
+def bearing(lat1, lon1, lat2, lon2, out=None):
+    '''
+    Initial bearing in degrees from (lat1, lon1) to (lat2, lon2)
+
+    0 is north, 90 is east. Result is in [0, 360).
+    '''
+    (lat1, lon1, lat2, lon2), dtype = _as_float_arrays(lat1, lon1, lat2, lon2)
+    shape = np.broadcast(lat1, lon1, lat2, lon2).shape
+    out = _prepare_out(out, shape, dtype)
+    rad = np.pi / 180
+    lat1_rad = np.empty(shape, dtype=dtype)
+    lat2_rad = np.empty(shape, dtype=dtype)
+    dlon = np.empty(shape, dtype=dtype)
+    y = np.empty(shape, dtype=dtype)
+    np.multiply(lat1, rad, out=lat1_rad)
+    np.multiply(lat2, rad, out=lat2_rad)
+    np.subtract(lon2, lon1, out=dlon)
+    dlon *= rad
+
+    # y = sin(dlon) * cos(lat2)
+    np.sin(dlon, out=y)
+    y *= np.cos(lat2_rad)
+    # x = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dlon)
+    np.cos(dlon, out=dlon)
+    dlon *= np.cos(lat2_rad)
+    dlon *= np.sin(lat1_rad)
+    x = np.sin(lat2_rad, out=lat2_rad)
+    x *= np.cos(lat1_rad, out=lat1_rad)
+    x -= dlon
+
+    np.arctan2(y, x, out=out)
+    np.degrees(out, out=out)
+    out += 360
+    np.mod(out, 360, out=out)
+    return out
+
+METRICS = {
+    'haversine': haversine,
+    'manhattan': manhattan,
+    'bearing': bearing,
+}
+
+def trip_distance_chunked(df, metric='haversine', lat1='pickup_latitude', lat2='dropoff_latitude',
+        lon1='pickup_longitude', lon2='dropoff_longitude', chunksize=DEFAULT_CHUNKSIZE, out=None):
+    '''
+    Compute metric over the rows of df in chunks of chunksize rows
+
+    Scratch memory is bounded by chunksize regardless of the size of df.
+
+    df: pd.DataFrame
+        - dataframe with lat1, lat2, lon1, lon2 columns (in degrees)
+    metric: str
+        - one of METRICS
+    out: np.ndarray
+        - optional preallocated 1d buffer of len(df)
+    '''
+    func = METRICS[metric]
+    n_rows = len(df)
+    cols = [df[col].to_numpy() for col in (lat1, lon1, lat2, lon2)]
+    _, dtype = _as_float_arrays(*[c[:0] for c in cols])
+    out = _prepare_out(out, (n_rows,), dtype)
+    for start in range(0, n_rows, chunksize):
+        stop = min(start + chunksize, n_rows)
+        func(*[c[start:stop] for c in cols], out=out[start:stop])
+    return out
+
+
+def _compute_trip_distance_np_vectorize(df, lat1='pickup_latitude', lat2='dropoff_latitude', lon1='pickup_longitude', lon2='dropoff_longitude'):
+    # previous implementation of compute_trip_distance, kept for benchmarking
+    import math
+    lat1_rad = np.vectorize(math.radians)(df[lat1])
+    lat2_rad = np.vectorize(math.radians)(df[lat2])
+    lon1_rad = np.vectorize(math.radians)(df[lon1])
+    lon2_rad = np.vectorize(math.radians)(df[lon2])
+    dlon = lon2_rad - lon1_rad
+    dlat = lat2_rad - lat1_rad
+    a = np.vectorize(math.sin)(dlat / 2)**2 + \
+        np.vectorize(math.cos)(lat1_rad) * np.vectorize(math.cos)(lat2_rad) * np.vectorize(math.sin)(dlon / 2)**2
+    c = 2 * np.vectorize(math.asin)(np.sqrt(a))
+    return c * EARTH_RADIUS_KM
+
+def _random_trips(n_rows, seed=0):
+    import os
+    import sys
+    import pandas as pd
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from src.data.preprocess import NYC_MIN_LON, NYC_MAX_LON, NYC_MIN_LAT, NYC_MAX_LAT
+
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'pickup_latitude': rng.uniform(NYC_MIN_LAT, NYC_MAX_LAT, n_rows),
+        'pickup_longitude': rng.uniform(NYC_MIN_LON, NYC_MAX_LON, n_rows),
+        'dropoff_latitude': rng.uniform(NYC_MIN_LAT, NYC_MAX_LAT, n_rows),
+        'dropoff_longitude': rng.uniform(NYC_MIN_LON, NYC_MAX_LON, n_rows),
+    })
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Benchmark trip distance computation')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--legacy-rows', type=int, default=100_000,
+        help='rows for the np.vectorize implementation (it is much slower)')
+    args = parser.parse_args()
+
+    def rows_per_sec(func, df):
+        start = time.perf_counter()
+        func(df)
+        return len(df) / (time.perf_counter() - start)
+
+    df = _random_trips(args.rows)
+    df32 = df.astype(np.float32)
+    legacy_df = df.iloc[:args.legacy_rows]
+
+    expected = _compute_trip_distance_np_vectorize(legacy_df)
+    assert np.allclose(haversine(*[legacy_df[c] for c in ('pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude')]), expected), \
+        'haversine does not match the np.vectorize implementation'
+
+    print(f'Benchmarking on {args.rows} rows ({args.legacy_rows} for np.vectorize)....')
+    results = {
+        'np.vectorize (float64)': rows_per_sec(_compute_trip_distance_np_vectorize, legacy_df),
+        'haversine (float64)': rows_per_sec(trip_distance_chunked, df),
+        'haversine (float32)': rows_per_sec(trip_distance_chunked, df32),
+        'manhattan (float64)': rows_per_sec(lambda d: trip_distance_chunked(d, 'manhattan'), df),
+        'bearing (float64)': rows_per_sec(lambda d: trip_distance_chunked(d, 'bearing'), df),
+    }
+    baseline = results['np.vectorize (float64)']
+    for name, rate in results.items():
+        print(f'{name:<24} {rate:>14,.0f} rows/sec  ({rate / baseline:,.1f}x)')
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,18 @@ import pandas as pd
 import numpy as np
 from joblib import load
 
-def features_cols():
+from .distance import trip_distance_chunked
+from .compiled import CompiledPreprocessing
+from ..instrument import instrumented
+from ..drift import observe_features
+
+SPATIAL_COLS = ['pickup_cell', 'dropoff_cell', 'od_log_duration_prior']
+# row of the interim data every row of data/processed/train.parquet was built from (not a feature)
+INTERIM_ROW_COL = 'interim_row'
+
+def features_cols(spatial=False):
     # returns correct column names for features
+    # spatial=True adds grid cell ids and the zone-to-zone prior (needs an ODPriorTable, see spatial.py)
     X_cols_num = [
         'trip_distance',
         'pickup_datetime_date',
@@ -18,27 +28,41 @@ def features_cols():
         'dropoff_latitude',
         'dropoff_longitude',
     ]
+    if spatial:
+        X_cols_num = X_cols_num + SPATIAL_COLS
 
     X_cols_cat = []
     X_cols = X_cols_num + X_cols_cat
     return X_cols, X_cols_num, X_cols_cat
 
+def kept_trips(trip_distance):
+    # mask of the trips used for training, zero and missing distances are dropped (as drop_zero_records)
+    trip_distance = np.asarray(trip_distance)
+    return (trip_distance != 0) & ~np.isnan(trip_distance)
+
 def get_target(df):
     # Get target variable (y) from df
     return np.log(df['trip_duration']).ravel()
 
+@instrumented()
 def get_features(df, pl_fpath='models/preprocessing_pl.joblib'):
     # Get features (X) from df via a saved preprocessing pl
+    # a .npz path loads the compiled affine version (see compiled.py) instead of the sklearn pl
+    # (the two round differently, after an incremental update only the .npz keeps old splits exact)
+    observe_features(df)
+    if str(pl_fpath).endswith('.npz'):
+        return CompiledPreprocessing.load(pl_fpath).transform(df)
     loaded_pl = load(pl_fpath)
     return loaded_pl.transform(df)
 
 def combine_features_target(X, y, cols):
-    # Combine X and y to df to be saved as data/processed/train.pkl
+    # Combine X and y to df to be saved as data/processed/train.parquet
     assert X.shape[0] == y.shape[0], 'Number of rows are not equal'
     preprocessed = pd.DataFrame(data=X, columns=cols[:-1])
     preprocessed[cols[-1]] = y
     return preprocessed
 
+@instrumented()
 def decompose_pickup_datetime_features(df, pickup_datetime_col='pickup_datetime'):
     '''
     Decompose pickup datetime features into features (date, day of week, hour)
@@ -54,6 +78,7 @@ def decompose_pickup_datetime_features(df, pickup_datetime_col='pickup_datetime'
 
     return temp_df
 
+@instrumented()
 def decompose_dropoff_datetime_features(df, dropoff_datetime_col='dropoff_datetime'):
     '''
     Decompose dropoff datetime features into features (date, day of week, hour)
@@ -70,11 +95,12 @@ def decompose_dropoff_datetime_features(df, dropoff_datetime_col='dropoff_dateti
     return temp_df
 
 
+@instrumented()
 def compute_trip_distance(df, lat1='pickup_latitude', lat2='dropoff_latitude', lon1='pickup_longitude', lon2='dropoff_longitude'):
     '''
     Calculate trip_distance column
     
-    Using the haversine formula assuming angle is so small since we are only in new york city
+    Using the haversine formula from the distance module (numpy ufuncs, computed in chunks)
     
     lat1, lat2, lon1, lon2 are col names in df
     returns distance in km
@@ -82,23 +108,5 @@ def compute_trip_distance(df, lat1='pickup_latitude', lat2='dropoff_latitude', l
     # prevent mutating original df
     temp_df = df.copy()
 
-    # Convert to radians
-    lat1_rad = np.vectorize(np.math.radians)(df[lat1])
-    lat2_rad = np.vectorize(np.math.radians)(df[lat2])
-    lon1_rad = np.vectorize(np.math.radians)(df[lon1])
-    lon2_rad = np.vectorize(np.math.radians)(df[lon2])
-
-    # Haversine formula
-    dlon = lon2_rad - lon1_rad
-    dlat = lat2_rad - lat1_rad
-    a = np.vectorize(np.math.sin)(dlat / 2)**2 + \
-        np.vectorize(np.math.cos)(lat1_rad) * np.vectorize(np.math.cos)(lat2_rad) * np.vectorize(np.math.sin)(dlon / 2)**2
- 
-    c = 2 * np.vectorize(np.math.asin)(np.sqrt(a))
-    
-    # Radius of earth in kilometers. Use 3956 for miles
-    r = 6371
-
-    # calculate the result
-    temp_df['trip_distance'] = c*r 
+    temp_df['trip_distance'] = trip_distance_chunked(df, 'haversine', lat1, lat2, lon1, lon2)
     return temp_df
\ No newline at end of file
@@ -12,25 +12,30 @@ def main():
     import sys
     sys.path.append(os.path.abspath(os.getcwd()))
     from src.data.read import read_test_data
+    from src.data.storage import write_parquet
+    from src.instrument import span
     from src.features import (
-        decompose_pickup_datetime_features,
-        compute_trip_distance,
+        CompiledPreprocessing,
+        TripFeatureBuilder,
         get_features,
-        features_cols
     )
+    from src.features.features import SPATIAL_COLS
+    from src.features.spatial import ODPriorTable
 
     print('Reading raw test data....')
     df = read_test_data()
     
     print('Applying feature engineering....')
-    df = decompose_pickup_datetime_features(df)
-    df = compute_trip_distance(df)
-
+    # same columns as the training data, the zone-to-zone prior if it was built with features_train.py --spatial
+    X_cols = CompiledPreprocessing.load('models/preprocessing_affine.npz').cols
+    od_table = ODPriorTable.load('models/od_prior.npz') if set(SPATIAL_COLS) & set(X_cols) else None
+    features_df = TripFeatureBuilder(cols=X_cols, od_table=od_table).transform_df(df)
 
     print('Extracting features....')
-    X = get_features(df, 'models/preprocessing_pl.joblib')
+    X = get_features(features_df, 'models/preprocessing_affine.npz')
 
-    pd.DataFrame(data=X, columns=features_cols()[0]).to_pickle('data/processed/test.pkl')
+    with span('features_predict.write', len(X)):
+        write_parquet(pd.DataFrame(data=X, columns=X_cols), 'data/processed/test.parquet')
 
     print('Done')
 
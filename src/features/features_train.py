@@ -2,8 +2,10 @@
 Module for creating features for training the model (interim --> processed)
 
 Can be run as a script to generate preprocessing pipeline and processed data from interim data for model training
-(To be run from main directory only)
+(To be run from main directory only), --spatial adds the grid cells and the out of fold zone-to-zone prior
+(spatial.py) to the features and saves the prior table of all the trips as models/od_prior.npz
 '''
+import numpy as np
 import pandas as pd
 from sklearn.pipeline import Pipeline
 from sklearn.impute import SimpleImputer
@@ -41,45 +43,83 @@ def create_preprocessing_pl(df, features_cols):
     return preprocessing_pl
 
 def main():
+    import argparse
     import os
     import sys
     sys.path.append(os.path.abspath(os.getcwd()))
     from src.data.read import read_interim_data
-    from src.data.preprocess import drop_zero_records
+    from src.data.storage import write_parquet
+    from src.instrument import span
+    from src.drift import DriftProfile
+    from src.data.preprocess import NYC_MIN_LAT, NYC_MAX_LAT, NYC_MIN_LON, NYC_MAX_LON
+    from src.features.features import INTERIM_ROW_COL, SPATIAL_COLS, kept_trips
+    from src.features.spatial import ODPriorTable, SpatialGrid, out_of_fold_priors, trip_keys
     from src.features import (
-        decompose_pickup_datetime_features,
-        decompose_dropoff_datetime_features,
-        compute_trip_distance,
+        TripFeatureBuilder,
+        compile_preprocessing_pl,
+        check_equivalence,
         get_features,
         get_target,
         features_cols,
         combine_features_target
     )
     from joblib import dump
+
+    parser = argparse.ArgumentParser(description='Create the preprocessing pl and the processed training data')
+    parser.add_argument('--spatial', action='store_true', help='add the grid cells and the zone-to-zone prior features')
+    parser.add_argument('--od-prior', default='models/od_prior.npz')
+    args = parser.parse_args()
+    X_cols = features_cols(args.spatial)[0]
     
     print('Reading interim data....')
-    df = read_interim_data()
+    df = read_interim_data(columns=['pickup_datetime', 'pickup_latitude', 'pickup_longitude',
+        'dropoff_latitude', 'dropoff_longitude', 'trip_duration'])
     
     print('Applying feature engineering....')
-    df = decompose_pickup_datetime_features(df)
-    df = decompose_dropoff_datetime_features(df)
-    df = compute_trip_distance(df)
-    df = drop_zero_records(df, ['trip_distance'])
+    features_df = TripFeatureBuilder().transform_df(df)
+    # drop zero (and missing) distance trips
+    keep = kept_trips(features_df['trip_distance'])
+    features_df = features_df[keep].reset_index(drop=True)
+
+    if args.spatial:
+        print('Building zone-to-zone priors....')
+        grid = SpatialGrid.from_cells_per_degree(NYC_MIN_LAT, NYC_MAX_LAT, NYC_MIN_LON, NYC_MAX_LON)
+        keys = trip_keys(grid, df[keep])
+        table = ODPriorTable(grid).update(*keys)
+        table.save(args.od_prior)
+        spatial_df = TripFeatureBuilder(cols=SPATIAL_COLS, od_table=table).transform_df(df[keep])
+        # the table of all the trips has each trip's own duration in its prior
+        spatial_df['od_log_duration_prior'] = out_of_fold_priors(grid, *keys)
+        features_df = pd.concat([features_df, spatial_df], axis=1)
 
     print('Training preprocessing pipeline....')
-    preprocessing_pl = create_preprocessing_pl(df, features_cols())
+    with span('features_train.fit_pl', len(features_df)):
+        preprocessing_pl = create_preprocessing_pl(features_df, features_cols(args.spatial))
     dump(preprocessing_pl, 'models/preprocessing_pl.joblib') 
 
+    print('Compiling preprocessing pipeline....')
+    compiled_pl = compile_preprocessing_pl(preprocessing_pl)
+    check_equivalence(preprocessing_pl, compiled_pl, features_df.iloc[:100_000])
+    compiled_pl.save('models/preprocessing_affine.npz')
+
     print('Extracting features and target....')
-    X = get_features(df, 'models/preprocessing_pl.joblib')
-    y = get_target(df)
+    X = get_features(features_df, 'models/preprocessing_affine.npz')
+    y = get_target(df)[keep]
 
     # print('Saving features....')
     # print('Saving target....')
+    print('Saving drift profile....')
+    # the prediction bins start as the target, train.py sets them from the model predictions
+    # and saves the reference used while serving (models/drift_reference.npz)
+    DriftProfile.from_data(features_df[X_cols], y).save('data/processed/drift_profile.npz')
+
     print('Saving training data....')
-    X_cols = features_cols()[0]
     preprocessed = combine_features_target(X, y, X_cols+['log_trip_duration'])
-    preprocessed.to_pickle('data/processed/train.pkl')
+    # joins the processed rows back to the interim trips (e.g. pickup datetime for sampling.py)
+    preprocessed[INTERIM_ROW_COL] = np.flatnonzero(keep)
+    with span('features_train.write', len(preprocessed)):
+        # the fingerprint of the pl is checked by train.py, an incremental update changes the pl
+        write_parquet(preprocessed, 'data/processed/train.parquet', metadata={'preprocessing': compiled_pl.fingerprint()})
 
     print('Done')
 
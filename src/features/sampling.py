@@ -0,0 +1,239 @@
+'''
+Module for building reproducible stratified samples of the training data for quick experiments
+(interim + processed --> data/samples)
+
+Trips picked up before the holdout start (by default the first day of the last month of the
+data) are the training pool, the later ones are the time based holdout. Samples of the pool
+are stratified by pickup zone (SpatialGrid cell), day of week and hour: every stratum keeps
+the same share of its trips, rounded up or down at random so that the expected share is
+exactly the sampled fraction. Rows are taken in the order of one random permutation, so a
+smaller sample is a subset of the larger ones and a seed always gives the same samples.
+
+Samples and the holdout are saved as .npz of float32 arrays (processed features X, target y
+and the row numbers in data/processed/train.parquet), see load_sample. The manifest
+(data/samples/manifest.json) has the fingerprint of the pl that scaled them. The report
+(data/samples/report.json) has the holdout RMSE of the train.py model fitted on every
+sample next to the one fitted on the full pool, i.e. how well a sample tracks the full data.
+
+Can be run as a script (To be run from main directory only)
+    python src/features/sampling.py --fractions 0.01 0.05 0.2
+'''
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_FRACTIONS = (0.01, 0.02, 0.05, 0.2)
+DEFAULT_SEED = 0
+DEFAULT_SAMPLES_DIR = 'data/samples'
+# pickup zones, cells of a grid over the NYC bounding box (50 per degree is ~2.2 km x 1.7 km)
+DEFAULT_ZONES_PER_DEGREE = 50
+TARGET_COL = 'log_trip_duration'
+
+def sample_fpath(fraction, samples_dir=DEFAULT_SAMPLES_DIR):
+    return os.path.join(samples_dir, f'sample_{fraction:g}.npz')
+
+def holdout_fpath(samples_dir=DEFAULT_SAMPLES_DIR):
+    return os.path.join(samples_dir, 'holdout.npz')
+
+def strata_keys(pickup_datetime, pickup_zones):
+    # one int64 key per (pickup zone, day of week, hour)
+    pickup_datetime = pd.Series(pickup_datetime)
+    day_of_week = pickup_datetime.dt.dayofweek.to_numpy(dtype=np.int64)
+    hour = pickup_datetime.dt.hour.to_numpy(dtype=np.int64)
+    return (np.asarray(pickup_zones, dtype=np.int64) * 7 + day_of_week) * 24 + hour
+
+def time_holdout(pickup_datetime, holdout_start=None):
+    '''
+    (boolean mask of the holdout trips, holdout start), the holdout is every trip picked up at
+    or after holdout_start, by default the first day of the last month of the data
+    '''
+    pickup_datetime = pd.Series(pickup_datetime)
+    if holdout_start is None:
+        holdout_start = pickup_datetime.max().to_period('M').to_timestamp()
+    holdout_start = pd.Timestamp(holdout_start)
+    return (pickup_datetime >= holdout_start).to_numpy(), holdout_start
+
+class StratifiedSampler:
+    '''
+    Nested stratified samples of rows
+
+    strata: np.ndarray
+        - int stratum key of every row
+    seed: int
+        - seed of the row order and of the rounding of the per stratum sizes
+    '''
+    def __init__(self, strata, seed=DEFAULT_SEED):
+        strata = np.asarray(strata)
+        rng = np.random.default_rng(seed)
+        # rows grouped by stratum, in a random order within each stratum
+        order = np.lexsort((rng.random(len(strata)), strata))
+        sorted_strata = strata[order]
+        starts = np.flatnonzero(np.r_[True, sorted_strata[1:] != sorted_strata[:-1]])
+        sizes = np.diff(np.r_[starts, len(strata)])
+        self.n_strata = len(sizes)
+        self._rank = np.empty(len(strata), dtype=np.int64)
+        self._rank[order] = np.arange(len(strata)) - np.repeat(starts, sizes)
+        self._size = np.empty(len(strata), dtype=np.int64)
+        self._size[order] = np.repeat(sizes, sizes)
+        # one uniform per stratum, floor(fraction * size + u) rows of the stratum are kept
+        self._rounding = np.empty(len(strata))
+        self._rounding[order] = np.repeat(rng.random(len(sizes)), sizes)
+        self._strata = strata
+
+    def sample(self, fraction):
+        # sorted row indices of the sample
+        return np.flatnonzero(self._rank < np.floor(fraction * self._size + self._rounding))
+
+    def n_strata_in(self, rows):
+        return len(np.unique(self._strata[rows]))
+
+def save_sample(fpath, X, y, rows):
+    # X: processed features DataFrame, y: target, rows: row numbers in the processed data
+    np.savez(fpath, X=X.to_numpy(dtype=np.float32), y=np.asarray(y, dtype=np.float32),
+        rows=np.asarray(rows, dtype=np.int64), cols=np.array(list(X.columns)))
+
+def load_sample(fpath):
+    '''
+    (X, y) of a saved sample or holdout, X is a DataFrame of the processed features
+    '''
+    with np.load(fpath) as arrays:
+        return pd.DataFrame(arrays['X'], columns=arrays['cols'].tolist()), arrays['y']
+
+def build_samples(processed_df, pickup_datetime, pickup_zones, fractions=DEFAULT_FRACTIONS, holdout_start=None,
+        seed=DEFAULT_SEED, samples_dir=DEFAULT_SAMPLES_DIR, preprocessing=None):
+    '''
+    Save the holdout and a stratified sample of the pool per fraction, returns the manifest
+    (also saved as samples_dir/manifest.json)
+
+    processed_df: pd.DataFrame
+        - processed features and TARGET_COL (data/processed/train.parquet)
+    pickup_datetime, pickup_zones: np.ndarray
+        - pickup datetime and zone of every row of processed_df
+    preprocessing: str
+        - fingerprint of the pl that scaled processed_df (see compiled.check_fingerprint)
+    '''
+    os.makedirs(samples_dir, exist_ok=True)
+    X = processed_df.drop(columns=[TARGET_COL])
+    y = processed_df[TARGET_COL].to_numpy()
+    is_holdout, holdout_start = time_holdout(pickup_datetime, holdout_start)
+    pool = np.flatnonzero(~is_holdout)
+    holdout = np.flatnonzero(is_holdout)
+    save_sample(holdout_fpath(samples_dir), X.iloc[holdout], y[holdout], holdout)
+
+    sampler = StratifiedSampler(strata_keys(pickup_datetime[pool], pickup_zones[pool]), seed)
+    manifest = {
+        'seed': seed,
+        'preprocessing': preprocessing,
+        'holdout_start': str(holdout_start),
+        'pool_rows': len(pool),
+        'pool_strata': sampler.n_strata,
+        'holdout': {'fpath': holdout_fpath(samples_dir), 'rows': len(holdout)},
+        'samples': [],
+    }
+    for fraction in sorted(fractions):
+        rows = sampler.sample(fraction)
+        fpath = sample_fpath(fraction, samples_dir)
+        save_sample(fpath, X.iloc[pool[rows]], y[pool[rows]], pool[rows])
+        manifest['samples'].append({'fraction': fraction, 'fpath': fpath, 'rows': len(rows),
+            'strata': sampler.n_strata_in(rows)})
+    with open(os.path.join(samples_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def tracking_report(make_model, manifest, X_pool=None, y_pool=None):
+    '''
+    Holdout RMSE and fit time of make_model() fitted on every sample of the manifest, and on
+    the full pool if given (rmse_diff is the difference with the full pool RMSE)
+    '''
+    import time
+
+    X_holdout, y_holdout = load_sample(manifest['holdout']['fpath'])
+    datasets = [(sample['fraction'], sample['rows'], lambda fpath=sample['fpath']: load_sample(fpath))
+        for sample in manifest['samples']]
+    if X_pool is not None:
+        datasets.append((1.0, len(X_pool), lambda: (X_pool, y_pool)))
+
+    report = []
+    for fraction, n_rows, load in datasets:
+        start = time.perf_counter()
+        X, y = load()
+        loaded = time.perf_counter()
+        model = make_model().fit(X, y)
+        fitted = time.perf_counter()
+        rmse = float(np.sqrt(np.mean((model.predict(X_holdout) - y_holdout)**2)))
+        report.append({'fraction': fraction, 'rows': n_rows, 'load_s': loaded - start, 'fit_s': fitted - loaded,
+            'rmse': rmse})
+    if X_pool is not None:
+        for record in report:
+            record['rmse_diff'] = record['rmse'] - report[-1]['rmse']
+    return report
+
+def main():
+    import argparse
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    from src.data.read import read_interim_data, read_processed_data
+    from src.data.storage import read_parquet_metadata
+    from src.data.preprocess import NYC_MIN_LAT, NYC_MAX_LAT, NYC_MIN_LON, NYC_MAX_LON
+    from src.features.features import INTERIM_ROW_COL
+    from src.features.spatial import SpatialGrid
+    from src.instrument import span
+
+    parser = argparse.ArgumentParser(description='Build stratified samples and a time holdout of the training data')
+    parser.add_argument('--fractions', type=float, nargs='+', default=list(DEFAULT_FRACTIONS))
+    parser.add_argument('--holdout-start', default=None, help='e.g. 2016-06-01, defaults to the last month')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--zones-per-degree', type=int, default=DEFAULT_ZONES_PER_DEGREE,
+        help='pickup zones per degree of latitude/longitude')
+    parser.add_argument('--samples-dir', default=DEFAULT_SAMPLES_DIR)
+    parser.add_argument('--no-report', action='store_true', help="don't fit the model on the samples and the full pool")
+    args = parser.parse_args()
+
+    print('Reading interim and processed data....')
+    df = read_interim_data(columns=['pickup_datetime', 'pickup_latitude', 'pickup_longitude',
+        'dropoff_latitude', 'dropoff_longitude'])
+    processed_df = read_processed_data()
+    # processed rows are joined to the interim trips they were built from
+    if INTERIM_ROW_COL not in processed_df:
+        raise ValueError(f'processed data has no {INTERIM_ROW_COL} column, rerun src/features/features_train.py')
+    interim_rows = processed_df[INTERIM_ROW_COL].to_numpy()
+    if len(interim_rows) and interim_rows.max() >= len(df):
+        raise ValueError('processed data does not match the interim data, rerun src/features/features_train.py')
+    df = df.iloc[interim_rows]
+    processed_df = processed_df.drop(columns=[INTERIM_ROW_COL])
+
+    print(f'Building samples {args.fractions} in {args.samples_dir}....')
+    grid = SpatialGrid.from_cells_per_degree(NYC_MIN_LAT, NYC_MAX_LAT, NYC_MIN_LON, NYC_MAX_LON, args.zones_per_degree)
+    zones = grid.cell_ids(df['pickup_latitude'].to_numpy(), df['pickup_longitude'].to_numpy())
+    with span('sampling.build_samples', len(processed_df)):
+        manifest = build_samples(processed_df, df['pickup_datetime'].to_numpy(), zones, args.fractions,
+            args.holdout_start, args.seed, args.samples_dir,
+            read_parquet_metadata('data/processed/train.parquet').get('preprocessing'))
+    print(f"Pool of {manifest['pool_rows']} trips in {manifest['pool_strata']} strata, "
+          f"{manifest['holdout']['rows']} holdout trips from {manifest['holdout_start']}")
+    for sample in manifest['samples']:
+        print(f"{sample['fpath']}: {sample['rows']} trips, {sample['strata']} strata")
+
+    if not args.no_report:
+        print('Fitting the model on every sample and on the full pool....')
+        pool = ~time_holdout(df['pickup_datetime'].to_numpy(), manifest['holdout_start'])[0]
+        X_pool = processed_df.drop(columns=[TARGET_COL])[pool]
+        y_pool = processed_df[TARGET_COL].to_numpy()[pool]
+        # same model as train.py
+        make_model = lambda: HistGradientBoostingRegressor(max_leaf_nodes=300, random_state=args.seed)
+        with span('sampling.tracking_report', len(X_pool)):
+            report = tracking_report(make_model, manifest, X_pool, y_pool)
+        for record in report:
+            print(f"fraction {record['fraction']:<5g} {record['rows']:>9} trips  load {record['load_s']:.3f} s  "
+                  f"fit {record['fit_s']:>7.2f} s  holdout rmse {record['rmse']:.4f} ({record['rmse_diff']:+.4f})")
+        with open(os.path.join(args.samples_dir, 'report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
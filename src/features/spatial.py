@@ -0,0 +1,248 @@
+'''
+Module for a fixed spatial grid over NYC and zone-to-zone travel time priors
+
+SpatialGrid snaps coordinates to cell ids (~1 km cells by default). ODPriorTable keeps, per
+(pickup cell, dropoff cell, hour), a sparse histogram of log(trip_duration) and the sorted
+keys and medians of the observed keys, so features are vectorized lookups. New data (e.g. a
+new month) is added to the histograms with update(), without going over the old data again.
+
+The od_log_duration_prior feature of the training data is computed out of fold (see
+out_of_fold_priors), features_train.py --spatial trains on it. Predictions use the table of
+all the training trips (models/od_prior.npz).
+
+Can be run as a script to build or update models/od_prior.npz from interim data
+(To be run from main directory only)
+'''
+import numpy as np
+
+
+N_HOURS = 24
+# log(trip_duration) histogram bins: 0 (1 sec) to 12 (~45 hours)
+LOG_DURATION_EDGES = np.linspace(0, 12, 121)
+# grid cells per degree of latitude/longitude (100 is ~1.1 km x 0.85 km in NYC, 160 x 100 cells)
+DEFAULT_CELLS_PER_DEGREE = 100
+DEFAULT_N_FOLDS = 5
+
+class SpatialGrid:
+    '''
+    Regular n_lat x n_lon grid over a bounding box (e.g. NYC_MIN_LAT..NYC_MAX_LON in preprocess.py)
+
+    Coordinates outside of the box are snapped to the nearest edge cell.
+    '''
+    def __init__(self, min_lat, max_lat, min_lon, max_lon, n_lat, n_lon):
+        self.min_lat, self.max_lat = min_lat, max_lat
+        self.min_lon, self.max_lon = min_lon, max_lon
+        self.n_lat, self.n_lon = n_lat, n_lon
+
+    @classmethod
+    def from_cells_per_degree(cls, min_lat, max_lat, min_lon, max_lon, cells_per_degree=DEFAULT_CELLS_PER_DEGREE):
+        n_lat = max(int(round((max_lat - min_lat) * cells_per_degree)), 1)
+        n_lon = max(int(round((max_lon - min_lon) * cells_per_degree)), 1)
+        return cls(min_lat, max_lat, min_lon, max_lon, n_lat, n_lon)
+
+    @property
+    def n_cells(self):
+        return self.n_lat * self.n_lon
+
+    def params(self):
+        return np.array([self.min_lat, self.max_lat, self.min_lon, self.max_lon, self.n_lat, self.n_lon])
+
+    @classmethod
+    def from_params(cls, params):
+        min_lat, max_lat, min_lon, max_lon, n_lat, n_lon = params
+        return cls(min_lat, max_lat, min_lon, max_lon, int(n_lat), int(n_lon))
+
+    def _index(self, values, low, high, n):
+        idx = np.floor((np.asarray(values, dtype=np.float64) - low) * (n / (high - low)))
+        np.clip(idx, 0, n - 1, out=idx)
+        return idx.astype(np.int32)
+
+    def cell_ids(self, lat, lon):
+        # row major cell id, lat index * n_lon + lon index
+        return self._index(lat, self.min_lat, self.max_lat, self.n_lat) * np.int32(self.n_lon) + \
+            self._index(lon, self.min_lon, self.max_lon, self.n_lon)
+
+    def cell_centers(self, cell_ids):
+        # (lat, lon) of the center of each cell
+        cell_ids = np.asarray(cell_ids)
+        lat_idx, lon_idx = np.divmod(cell_ids, self.n_lon)
+        lat = self.min_lat + (lat_idx + 0.5) * (self.max_lat - self.min_lat) / self.n_lat
+        lon = self.min_lon + (lon_idx + 0.5) * (self.max_lon - self.min_lon) / self.n_lon
+        return lat, lon
+
+def _sparse_medians(keys, bins, counts, edges):
+    '''
+    (keys, totals, medians) of sparse histograms, one per distinct key
+
+    keys, bins, counts: np.ndarray
+        - one entry per non empty bin, sorted by key then bin
+    '''
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    run = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(keys)]))
+    cum = np.cumsum(counts, dtype=np.int64)
+    cum -= np.r_[0, cum[starts[1:] - 1]][run]
+    totals = cum[np.r_[starts[1:], len(keys)] - 1]
+    half = totals / 2
+    # first bin of each key where the cumulative count reaches half (linear interpolation inside it)
+    first = np.minimum.reduceat(np.where(cum >= half[run], np.arange(len(keys)), len(keys)), starts)
+    idx = bins[first]
+    before = cum[first] - counts[first]
+    width = edges[1:] - edges[:-1]
+    return keys[starts], totals, edges[idx] + (half - before) / counts[first] * width[idx]
+
+def _sparse_lookup(keys, values, query):
+    # values of query in sorted keys, NaN where missing (binary search, the keys are sparse)
+    if not len(keys):
+        return np.full(len(query), np.nan)
+    idx = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where(keys[idx] == query, values[idx], np.nan)
+
+class ODPriorTable:
+    '''
+    Median log(trip_duration) per (pickup cell, dropoff cell, hour) with fallbacks
+
+    Keys with fewer than min_count trips fall back to the median of the same cells over all
+    hours, then to the global median. Only the non empty histogram bins of the observed
+    (pickup cell, dropoff cell, hour) keys are stored, and the medians are kept as sorted keys
+    and values: memory scales with the trips, not with n_cells**2 * 24 (~6e9 keys for the
+    default grid). lookup() is a vectorized binary search in them.
+    '''
+    def __init__(self, grid, min_count=10, edges=LOG_DURATION_EDGES):
+        self.grid = grid
+        self.min_count = min_count
+        self.edges = np.asarray(edges, dtype=np.float64)
+        # sparse histograms: sorted (od * 24 + hour) * n_bins + bin keys and their counts
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.uint32)
+        self._refresh()
+
+    def _keys(self, pickup_cells, dropoff_cells, hours):
+        od = np.asarray(pickup_cells, dtype=np.int64) * self.grid.n_cells + np.asarray(dropoff_cells, dtype=np.int64)
+        return od * N_HOURS + np.asarray(hours, dtype=np.int64)
+
+    def update(self, pickup_cells, dropoff_cells, hours, log_durations):
+        '''
+        Add trips to the histograms and refresh the medians
+        '''
+        n_bins = len(self.edges) - 1
+        bins = np.clip(np.searchsorted(self.edges, log_durations, side='right') - 1, 0, n_bins - 1)
+        keys = np.concatenate([self.keys, self._keys(pickup_cells, dropoff_cells, hours) * n_bins + bins])
+        weights = np.concatenate([self.counts, np.ones(len(bins), dtype=np.uint32)])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=weights, minlength=len(self.keys)).astype(np.uint32)
+        self._refresh()
+        return self
+
+    def _refresh(self):
+        n_bins = len(self.edges) - 1
+        keys, bins = np.divmod(self.keys, n_bins)
+        if not len(keys):
+            self.global_median_ = np.nan
+            self.key_medians_ = self.od_medians_ = (np.empty(0, dtype=np.int64), np.empty(0))
+            return
+        bin_totals = np.bincount(bins, weights=self.counts, minlength=n_bins)
+        self.global_median_ = _sparse_medians(np.zeros(n_bins, dtype=np.int64), np.arange(n_bins), bin_totals,
+            self.edges)[2][0]
+
+        key_ids, totals, medians = _sparse_medians(keys, bins, self.counts, self.edges)
+        enough = totals >= self.min_count
+        self.key_medians_ = (key_ids[enough], medians[enough])
+
+        # od over all hours, the keys are sorted by hour within an od so the bins are merged again
+        od_bins, inverse = np.unique(keys // N_HOURS * n_bins + bins, return_inverse=True)
+        od_counts = np.bincount(inverse, weights=self.counts, minlength=len(od_bins))
+        od_ids, totals, medians = _sparse_medians(od_bins // n_bins, od_bins % n_bins, od_counts, self.edges)
+        enough = totals >= self.min_count
+        self.od_medians_ = (od_ids[enough], medians[enough])
+
+    def lookup(self, pickup_cells, dropoff_cells, hours):
+        # prior median log(trip_duration) for each trip
+        keys = self._keys(pickup_cells, dropoff_cells, hours)
+        prior = _sparse_lookup(*self.key_medians_, keys)
+        missing = np.isnan(prior)
+        prior[missing] = _sparse_lookup(*self.od_medians_, keys[missing] // N_HOURS)
+        prior[np.isnan(prior)] = self.global_median_
+        return prior
+
+    def lookup_coords(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, hours):
+        return self.lookup(self.grid.cell_ids(pickup_lat, pickup_lon), self.grid.cell_ids(dropoff_lat, dropoff_lon), hours)
+
+    def update_from_df(self, df):
+        # interim data with coordinates, pickup_datetime and trip_duration
+        self.update(*trip_keys(self.grid, df))
+        return self
+
+    def save(self, fpath):
+        np.savez_compressed(fpath, grid=self.grid.params(), min_count=self.min_count,
+            edges=self.edges, keys=self.keys, counts=self.counts)
+
+    @classmethod
+    def load(cls, fpath):
+        with np.load(fpath) as arrays:
+            table = cls(SpatialGrid.from_params(arrays['grid']), int(arrays['min_count']), arrays['edges'])
+            table.keys, table.counts = arrays['keys'], arrays['counts']
+        table._refresh()
+        return table
+
+def trip_keys(grid, df):
+    # (pickup cells, dropoff cells, hours, log durations) of interim trips
+    return (
+        grid.cell_ids(df['pickup_latitude'], df['pickup_longitude']),
+        grid.cell_ids(df['dropoff_latitude'], df['dropoff_longitude']),
+        df['pickup_datetime'].dt.hour.to_numpy(),
+        np.log(df['trip_duration'].to_numpy(dtype=np.float64)),
+    )
+
+def out_of_fold_priors(grid, pickup_cells, dropoff_cells, hours, log_durations, n_folds=DEFAULT_N_FOLDS,
+        min_count=10, random_state=0):
+    '''
+    Prior of every trip from a table built on the other folds, the training value of the
+    od_log_duration_prior feature (the table of all trips would leak each trip's own duration)
+    '''
+    folds = np.random.default_rng(random_state).integers(n_folds, size=len(log_durations))
+    prior = np.empty(len(log_durations))
+    for fold in range(n_folds):
+        held_out = folds == fold
+        rest = ~held_out
+        table = ODPriorTable(grid, min_count).update(pickup_cells[rest], dropoff_cells[rest], hours[rest],
+            log_durations[rest])
+        prior[held_out] = table.lookup(pickup_cells[held_out], dropoff_cells[held_out], hours[held_out])
+    return prior
+
+def main():
+    import argparse
+    import os
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from src.data.preprocess import NYC_MIN_LON, NYC_MAX_LON, NYC_MIN_LAT, NYC_MAX_LAT
+    from src.data.read import read_interim_data
+
+    parser = argparse.ArgumentParser(description='Build the zone-to-zone travel time prior table')
+    parser.add_argument('--interim', default='data/interim/train.parquet')
+    parser.add_argument('--output', default='models/od_prior.npz')
+    parser.add_argument('--update', action='store_true',
+        help='add --interim (e.g. a new month) to the existing table instead of rebuilding it')
+    parser.add_argument('--cells-per-degree', type=int, default=DEFAULT_CELLS_PER_DEGREE)
+    args = parser.parse_args()
+
+    if args.update and os.path.exists(args.output):
+        print(f'Loading {args.output}....')
+        table = ODPriorTable.load(args.output)
+    else:
+        grid = SpatialGrid.from_cells_per_degree(NYC_MIN_LAT, NYC_MAX_LAT, NYC_MIN_LON, NYC_MAX_LON, args.cells_per_degree)
+        table = ODPriorTable(grid)
+
+    print('Reading interim data....')
+    df = read_interim_data(args.interim, columns=['pickup_datetime', 'pickup_latitude', 'pickup_longitude',
+        'dropoff_latitude', 'dropoff_longitude', 'trip_duration'])
+
+    print('Updating zone-to-zone priors....')
+    table.update_from_df(df)
+
+    print(f'Saving {len(table.key_medians_[0])} (origin, destination, hour) medians to {args.output}....')
+    table.save(args.output)
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
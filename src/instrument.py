@@ -0,0 +1,191 @@
+'''
+Module for lightweight instrumentation of the pipeline functions and scripts
+
+span() (context manager) and instrumented() (decorator) record wall time, CPU time, rows
+processed, rows/sec and the peak RSS of the process so far. Nothing is recorded unless one
+of the environment variables below is set, so the decorated hot paths (e.g. single trip
+predictions in the streamlit app) only pay for one flag check:
+
+    NYC_CABS_TRACE=reports/trace.jsonl    append one JSON record per span to this file
+    NYC_CABS_LOG=1                        log the records (JSON) with the logging module
+    NYC_CABS_PROFILE=reports/profile.txt  sample the stacks of all threads every
+                                          NYC_CABS_PROFILE_INTERVAL seconds (default 0.005)
+                                          and write them in collapsed format (flamegraph.pl,
+                                          speedscope) at exit
+'''
+import atexit
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then not recorded
+    resource = None
+
+
+TRACE_FPATH = os.environ.get('NYC_CABS_TRACE')
+LOG_RECORDS = bool(os.environ.get('NYC_CABS_LOG'))
+ENABLED = bool(TRACE_FPATH or LOG_RECORDS)
+
+logger = logging.getLogger(__name__)
+_trace_lock = threading.Lock()
+_local = threading.local()
+
+def max_rss_mb():
+    # peak resident set size of the process so far (ru_maxrss is in KB on Linux, bytes on macOS)
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+def emit(record):
+    '''
+    Write a finished span record to the trace file and/or the log
+    '''
+    line = json.dumps(record, default=str)
+    if TRACE_FPATH:
+        with _trace_lock, open(TRACE_FPATH, 'a') as f:
+            f.write(line + '\n')
+    if LOG_RECORDS:
+        logger.info(line)
+
+@contextmanager
+def span(name, rows=None, **fields):
+    '''
+    Record the wall/CPU time, rows and peak RSS of the block
+
+    rows: int
+        - rows processed, can also be set in the block with record['rows'] = ...
+    fields:
+        - extra values stored in the record
+
+        with span('features_train.read', path=fname) as record:
+            df = read_interim_data(fname)
+            record['rows'] = len(df)
+    '''
+    record = dict(fields, name=name, rows=rows)
+    if not ENABLED:
+        yield record
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    record['parent'] = stack[-1] if stack else None
+    stack.append(name)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    record['start'] = time.time()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        stack.pop()
+        record['wall_s'] = time.perf_counter() - start_wall
+        # process CPU time: includes the other threads (e.g. OpenMP in HGB), can exceed wall time
+        record['cpu_s'] = time.process_time() - start_cpu
+        record['rows_per_sec'] = record['rows'] / record['wall_s'] if record['rows'] and record['wall_s'] else None
+        record['max_rss_mb'] = max_rss_mb()
+        record['pid'] = os.getpid()
+        record['thread'] = threading.current_thread().name
+        emit(record)
+
+def _n_rows(value):
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+def instrumented(name=None, rows='input'):
+    '''
+    Decorator recording a span around every call of the function
+
+    name: str
+        - span name, defaults to module.function
+    rows: str, int or callable
+        - 'input' counts the rows of the first argument (after self), 'output' the rows of the
+          result, an int is a fixed count (e.g. 1 for single trip predictions), a callable
+          gets the call arguments and returns the count, None for none
+    '''
+    def decorator(func):
+        span_name = name or f'{func.__module__}.{func.__qualname__}'
+        # methods count the rows of the argument after self
+        arg_idx = 1 if '.' in func.__qualname__ and '<locals>' not in func.__qualname__ else 0
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            n_rows = rows if isinstance(rows, int) else None
+            if rows == 'input' and len(args) > arg_idx:
+                n_rows = _n_rows(args[arg_idx])
+            elif callable(rows):
+                n_rows = rows(*args, **kwargs)
+            with span(span_name, n_rows) as record:
+                result = func(*args, **kwargs)
+                if rows == 'output':
+                    record['rows'] = _n_rows(result)
+            return result
+        return wrapper
+    return decorator
+
+class SamplingProfiler:
+    '''
+    Sample the python stacks of all threads in a background thread
+
+    Stacks are counted in collapsed format (outermost frame first, frames joined by ';'),
+    one line per stack with its number of samples.
+    '''
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def write(self, fpath):
+        with open(fpath, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f'{stack} {count}\n')
+
+def _start_profiler_from_env():
+    fpath = os.environ.get('NYC_CABS_PROFILE')
+    if not fpath:
+        return None
+    profiler = SamplingProfiler(float(os.environ.get('NYC_CABS_PROFILE_INTERVAL', 0.005))).start()
+    atexit.register(lambda: profiler.stop().write(fpath))
+    return profiler
+
+profiler = _start_profiler_from_env()
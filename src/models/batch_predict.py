@@ -0,0 +1,203 @@
+'''
+Module for scoring large test sets in shards on all cores (raw/processed --> predictions)
+
+The input is split into shards (byte ranges of a raw csv, row groups of a parquet file)
+that are featurized and scored in a process pool. Every worker loads the model with
+joblib mmap_mode='r', so the tree arrays are mapped from the same file instead of being
+copied into each process, and limits OpenMP to one thread so that the processes don't
+oversubscribe the cores. At most 2 shards per worker are in flight and the predictions are
+written in input order as shards finish, so memory is bounded by the shard size.
+
+Inputs:
+    .csv      raw test layout (id, pickup_datetime, coordinates, ...)
+    .parquet  raw/interim columns (featurized like the csv) or processed features
+              (already scaled, features_cols() only, rows are identified by row number)
+
+score_csv_chunks scores smaller files (e.g. uploads to the app) chunk by chunk in the calling process.
+
+Can be run as a script (To be run from main directory only)
+    python src/models/batch_predict.py data/raw/test.csv models/predictions.csv --n-jobs 8
+'''
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_SHARD_BYTES = 64 << 20
+DEFAULT_UPLOAD_CHUNKSIZE = 50_000
+RAW_COLS = ['id', 'pickup_datetime', 'pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude']
+
+# model, preprocessing and helpers of a worker process, set by _init_worker
+_worker = {}
+
+def _init_worker(root, model_fpath, pl_fpath, threads):
+    import sys
+    import warnings
+    sys.path.append(root)
+    from joblib import load
+    from threadpoolctl import threadpool_limits
+    from src.features import CompiledPreprocessing, TripFeatureBuilder
+    from src.models.predict import make_predictions
+
+    _worker['limits'] = threadpool_limits(limits=threads)
+    # the model was fitted on a DataFrame, the column order is guaranteed by the preprocessing cols
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+    # arrays of the model (the tree nodes) are memory mapped and shared between workers
+    _worker['model'] = load(model_fpath, mmap_mode='r')
+    _worker['preprocessing'] = CompiledPreprocessing.load(pl_fpath)
+    _worker['builder'] = TripFeatureBuilder(cols=_worker['preprocessing'].cols)
+    _worker['make_predictions'] = make_predictions
+
+def _read_shard(fpath, shard):
+    from src.data.ingest import read_csv_range
+    from src.data.preprocess import TEST_SCHEMA
+    import pyarrow.parquet as pq
+
+    kind, start, stop = shard
+    if kind == 'csv':
+        return read_csv_range(fpath, TEST_SCHEMA, start, stop, RAW_COLS)
+    parquet_file = pq.ParquetFile(fpath)
+    columns = [col for col in RAW_COLS if col in parquet_file.schema_arrow.names] if kind == 'raw_parquet' else None
+    return parquet_file.read_row_group(start, columns=columns).to_pandas()
+
+def _score_shard(fpath, shard):
+    '''
+    Predicted durations (seconds) of one shard with the trip ids (or row numbers)
+    '''
+    df = _read_shard(fpath, shard)
+    preprocessing = _worker['preprocessing']
+    if shard[0] == 'processed_parquet':
+        X = df[preprocessing.cols].to_numpy(dtype=np.float64)
+        ids = pd.Series(np.arange(shard[2], shard[2] + len(df)), name='row')
+    else:
+        X = preprocessing.transform(_worker['builder'].transform(df))
+        ids = df['id'] if 'id' in df else pd.Series(np.arange(shard[2], shard[2] + len(df)), name='row')
+    predictions = _worker['make_predictions'](_worker['model'], X)
+    return pd.DataFrame({ids.name: ids.to_numpy(), 'trip_duration': predictions})
+
+def plan_shards(fpath, preprocessing_cols, shard_bytes=DEFAULT_SHARD_BYTES):
+    '''
+    List of (kind, start, stop) shards of the input file
+
+    csv shards are byte ranges, parquet shards are (kind, row group, first row number)
+    '''
+    if fpath.endswith('.csv'):
+        from src.data.ingest import byte_ranges
+        return [('csv', start, stop) for start, stop in byte_ranges(fpath, range_size=shard_bytes)]
+
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(fpath)
+    names = parquet_file.schema_arrow.names
+    kind = 'raw_parquet' if 'pickup_datetime' in names else 'processed_parquet'
+    if kind == 'processed_parquet' and not set(preprocessing_cols) <= set(names):
+        raise ValueError(f'{fpath} has neither raw columns nor the processed features {preprocessing_cols}')
+    shards, first_row = [], 0
+    for i in range(parquet_file.num_row_groups):
+        shards.append((kind, i, first_row))
+        first_row += parquet_file.metadata.row_group(i).num_rows
+    return shards
+
+class PredictionWriter:
+    '''
+    Append prediction DataFrames to a .csv or .parquet file
+    '''
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.n_rows = 0
+        self._parquet = None
+        if fpath.endswith('.parquet'):
+            from src.data.storage import ParquetChunkWriter
+            self._parquet = ParquetChunkWriter(fpath, downcast=False)
+        elif os.path.exists(fpath):
+            os.remove(fpath)
+
+    def write(self, df):
+        if self._parquet is not None:
+            self._parquet.write(df)
+        else:
+            df.to_csv(self.fpath, mode='a', header=self.n_rows == 0, index=False)
+        self.n_rows += len(df)
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+
+def score_file(fpath, output_fpath, model_fpath='models/best_estimator.joblib', pl_fpath='models/preprocessing_affine.npz',
+        n_jobs=None, shard_bytes=DEFAULT_SHARD_BYTES, root='.'):
+    '''
+    Score every trip of fpath into output_fpath, returns the number of rows written
+    '''
+    from src.features import CompiledPreprocessing
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    shards = plan_shards(fpath, CompiledPreprocessing.load(pl_fpath).cols, shard_bytes)
+    print(f'Scoring {len(shards)} shards of {fpath} with {n_jobs} processes....')
+
+    writer = PredictionWriter(output_fpath)
+    try:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker,
+                initargs=(os.path.abspath(root), model_fpath, pl_fpath, 1)) as executor:
+            pending = deque()
+            shards = iter(shards)
+            for shard in shards:
+                pending.append(executor.submit(_score_shard, fpath, shard))
+                if len(pending) >= 2 * n_jobs:
+                    break
+            while pending:
+                # written in input order, a new shard is submitted for every finished one
+                writer.write(pending.popleft().result())
+                shard = next(shards, None)
+                if shard is not None:
+                    pending.append(executor.submit(_score_shard, fpath, shard))
+    finally:
+        writer.close()
+    return writer.n_rows
+
+def score_csv_chunks(predictor, fpath_or_buffer, chunksize=DEFAULT_UPLOAD_CHUNKSIZE):
+    '''
+    Score a raw test layout csv in the calling process, chunk by chunk (e.g. a file uploaded
+    to the app), yields a DataFrame of ids (or row numbers) and predicted durations per chunk
+
+    predictor: TripDurationPredictor
+    fpath_or_buffer: str or file-like
+        - csv with pickup_datetime and the pickup/dropoff coordinates, id is optional
+    '''
+    from src.features import TripFeatureBuilder
+
+    builder = TripFeatureBuilder(cols=predictor.cols)
+    first_row = 0
+    for chunk in pd.read_csv(fpath_or_buffer, chunksize=chunksize, usecols=lambda col: col in RAW_COLS):
+        missing = [col for col in RAW_COLS[1:] if col not in chunk]
+        if missing:
+            raise ValueError(f'missing columns {missing}')
+        ids = chunk['id'] if 'id' in chunk else pd.Series(np.arange(first_row, first_row + len(chunk)), name='row')
+        predictions = predictor.predict_features(builder.transform(chunk))
+        yield pd.DataFrame({ids.name: ids.to_numpy(), 'trip_duration': predictions})
+        first_row += len(chunk)
+
+def main():
+    import argparse
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from src.instrument import span
+
+    parser = argparse.ArgumentParser(description='Score a large test set in shards on all cores')
+    parser.add_argument('input', nargs='?', default='data/raw/test.csv', help='raw .csv or raw/processed .parquet')
+    parser.add_argument('output', nargs='?', default='models/predictions.csv', help='.csv or .parquet')
+    parser.add_argument('--model', default='models/best_estimator.joblib')
+    parser.add_argument('--preprocessing', default='models/preprocessing_affine.npz')
+    parser.add_argument('--n-jobs', type=int, default=None)
+    parser.add_argument('--shard-mb', type=int, default=DEFAULT_SHARD_BYTES >> 20, help='csv shard size')
+    args = parser.parse_args()
+
+    with span('batch_predict.score_file', input=args.input, n_jobs=args.n_jobs) as record:
+        record['rows'] = score_file(args.input, args.output, args.model, args.preprocessing, args.n_jobs, args.shard_mb << 20)
+    print(f"Saved {record['rows']} predictions to {args.output}")
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
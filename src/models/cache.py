@@ -0,0 +1,245 @@
+'''
+Module for memoizing trip predictions (used by the streamlit app and batch callers)
+
+Trips are keyed on their pickup/dropoff coordinates rounded to a few decimals (3 decimals is
+~100 m) plus the day of month, day of week and hour (all model features), so repeated queries for popular routes skip feature
+extraction and model evaluation. Heatmaps of the durations from a pickup to a grid of
+dropoffs are keyed on the grid, the pickup cell, day of month, day of week and hour. The
+cache is an LRU with a size cap and a TTL, and it is cleared (and the model reloaded) when
+the model file changes.
+'''
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+
+DEFAULT_MAXSIZE = 100_000
+# heatmap grids are arrays of up to ~100k durations, fewer of them are kept
+DEFAULT_GRID_MAXSIZE = 256
+DEFAULT_TTL = 3600
+# 3 decimals of a degree is ~110 m of latitude and ~85 m of longitude in NYC
+DEFAULT_PRECISION = 3
+# trip scored once after a preload so that the first request doesn't pay for lazy setup
+WARMUP_TRIP = dict(pickup_lat=40.8075, pickup_lon=-73.9626, dropoff_lat=40.7589, dropoff_lon=-73.9851,
+    day=1, day_of_week=0, hour=12)
+
+_load_lock = threading.Lock()
+
+def file_hash(fpath, block_size=1 << 20):
+    # sha256 of the file contents
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class PredictionCache:
+    '''
+    Thread safe LRU cache with a size cap, a TTL and hit/miss counters
+
+    maxsize: int
+        - number of entries, the least recently used entry is evicted above it
+    ttl: float
+        - seconds an entry is valid for, None to keep entries until evicted
+    '''
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        # cached value or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[1] < self.ttl):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        n_requests = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / n_requests if n_requests else 0.0,
+        }
+
+class CachedTripPredictor:
+    '''
+    TripDurationPredictor behind a PredictionCache, reloaded when the model file changes
+
+    Predictions are computed on the rounded coordinates and the keys hold every other
+    feature, so a cached value does not depend on which query filled it.
+
+    model_fpath, pl_fpath: str
+        - artifacts as in TripDurationPredictor.from_files
+    precision: int
+        - decimals the coordinates are rounded to
+    grid_maxsize: int
+        - number of heatmap grids cached (see predict_dropoff_grid)
+    '''
+    def __init__(self, model_fpath='models/best_estimator.joblib', pl_fpath='models/preprocessing_affine.npz',
+            maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL, precision=DEFAULT_PRECISION, grid_maxsize=DEFAULT_GRID_MAXSIZE):
+        self.model_fpath = model_fpath
+        self.pl_fpath = pl_fpath
+        self.precision = precision
+        self.cache = PredictionCache(maxsize, ttl)
+        self.grid_cache = PredictionCache(grid_maxsize, ttl)
+        self._reload_lock = threading.Lock()
+        self._stat = None
+        self.model_hash = None
+        self.predictor = None
+        self._check_model()
+
+    def _check_model(self):
+        # os.stat on every call is cheap, the file is only hashed when its size or mtime changed
+        stat = os.stat(self.model_fpath)
+        stat = (stat.st_size, stat.st_mtime_ns)
+        if stat == self._stat:
+            return
+        with self._reload_lock:
+            if stat == self._stat:
+                return
+            model_hash = file_hash(self.model_fpath)
+            if model_hash != self.model_hash:
+                # imported here so that importing this module (at app start) stays cheap
+                from .predictor import TripDurationPredictor
+                self.predictor = TripDurationPredictor.from_files(self.model_fpath, self.pl_fpath)
+                self.cache.clear()
+                self.grid_cache.clear()
+                self.model_hash = model_hash
+            self._stat = stat
+
+    def key(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, day, day_of_week, hour):
+        scale = 10**self.precision
+        return (
+            round(pickup_lat * scale), round(pickup_lon * scale),
+            round(dropoff_lat * scale), round(dropoff_lon * scale),
+            int(day), int(day_of_week), int(hour),
+        )
+
+    def _rounded(self, key):
+        scale = 10**self.precision
+        return [value / scale for value in key[:4]]
+
+    def predict_trip(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, day, day_of_week, hour):
+        '''
+        Predict the duration in seconds of one trip (arguments as in TripDurationPredictor.trip_features)
+        '''
+        self._check_model()
+        key = self.key(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, day, day_of_week, hour)
+        value = self.cache.get(key)
+        if value is None:
+            value = self.predictor.predict_trip(*self._rounded(key), *key[4:])
+            self.cache.put(key, value)
+        else:
+            # hits are served traffic too
+            self.predictor.observe_trips([(*self._rounded(key), *key[4:])], [value])
+        return value
+
+    def predict_trips(self, trips):
+        '''
+        Predict durations in seconds of a list of trip dicts, the misses are scored in one batch
+        '''
+        self._check_model()
+        keys = [self.key(t['pickup_lat'], t['pickup_lon'], t['dropoff_lat'], t['dropoff_lon'],
+            t['day'], t['day_of_week'], t['hour']) for t in trips]
+        values = np.empty(len(trips))
+        misses = {}
+        hits = []
+        for i, key in enumerate(keys):
+            value = self.cache.get(key)
+            if value is None:
+                # the same key can be missed more than once in a batch, it is scored once
+                misses.setdefault(key, []).append(i)
+            else:
+                values[i] = value
+                hits.append(i)
+        if hits:
+            self.predictor.observe_trips([(*self._rounded(keys[i]), *keys[i][4:]) for i in hits], values[hits])
+
+        if misses:
+            X = np.empty((len(misses), len(self.predictor.cols)))
+            for row, key in zip(X, misses):
+                self.predictor.trip_features(*self._rounded(key), *key[4:], out=row)
+            for value, (key, idx) in zip(self.predictor.predict_features(X), misses.items()):
+                values[idx] = value
+                self.cache.put(key, float(value))
+            # repeats of a missed key in the batch were scored once, they are counted as hits
+            repeats = [i for idx in misses.values() for i in idx[1:]]
+            if repeats:
+                self.predictor.observe_trips([(*self._rounded(keys[i]), *keys[i][4:]) for i in repeats], values[repeats])
+        return values
+
+    def predict_dropoff_grid(self, pickup_lat, pickup_lon, day, day_of_week, hour, grid):
+        '''
+        Predicted durations in seconds from a pickup to the center of every cell of grid
+        (features.spatial.SpatialGrid), as an array of shape (grid.n_lat, grid.n_lon)
+
+        The pickup is snapped to the center of its cell, so a grid is cached per (pickup cell,
+        day, day of week, hour) and scored in one batch on a miss. The returned array is read only.
+        '''
+        self._check_model()
+        pickup_cell = int(grid.cell_ids([pickup_lat], [pickup_lon])[0])
+        key = (tuple(grid.params()), pickup_cell, int(day), int(day_of_week), int(hour))
+        values = self.grid_cache.get(key)
+        if values is None:
+            pickup_lat, pickup_lon = grid.cell_centers(pickup_cell)
+            dropoff_lat, dropoff_lon = grid.cell_centers(np.arange(grid.n_cells))
+            X = self.predictor.trips_features(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, day, day_of_week, hour)
+            # synthetic trips, not counted as served traffic by the drift monitor
+            values = self.predictor.predict_features(X, monitor=False).reshape(grid.n_lat, grid.n_lon)
+            values.flags.writeable = False
+            self.grid_cache.put(key, values)
+        return values
+
+@lru_cache(maxsize=None)
+def _load_cached_predictor(model_fpath, pl_fpath):
+    return CachedTripPredictor(model_fpath, pl_fpath)
+
+def load_cached_predictor(model_fpath='models/best_estimator.joblib', pl_fpath='models/preprocessing_affine.npz'):
+    # one cache per process and path pair, a request made during a preload waits for it
+    with _load_lock:
+        return _load_cached_predictor(model_fpath, pl_fpath)
+
+def _preload(model_fpath, pl_fpath):
+    load_cached_predictor(model_fpath, pl_fpath).predictor.predict_trip(**WARMUP_TRIP, monitor=False)
+
+@lru_cache(maxsize=None)
+def preload_cached_predictor(model_fpath='models/best_estimator.joblib', pl_fpath='models/preprocessing_affine.npz'):
+    '''
+    Load (and warm up) the predictor in a background thread, once per process and path pair
+
+    returns the thread, load_cached_predictor blocks until it is done
+    '''
+    thread = threading.Thread(target=_preload, args=(model_fpath, pl_fpath), name='preload-predictor', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,233 @@
+'''
+Module for compiling a fitted HistGradientBoostingRegressor into flat node arrays (model --> .npz)
+
+All trees are concatenated into contiguous arrays (feature, threshold, missing_left, left,
+right, value) with global node indices, leaves point to themselves. The vectorized
+evaluator moves all (row, tree) pairs down one level per step and drops the pairs that
+reached a leaf. Batches of a few rows are walked in plain python over lists instead, numpy
+call overhead dominates there. Prediction is the same sum as model.predict (baseline, then
+the trees in order) without input validation and per tree predictor dispatch, which
+dominate small batches (the app scores one trip at a time). model.predict (compiled,
+multi-threaded) stays faster for large batches, see the bench command.
+
+Can be run as a script (To be run from main directory only)
+    python src/models/flat_trees.py export    (models/best_estimator.joblib --> models/best_estimator_flat.npz)
+    python src/models/flat_trees.py bench     (batch sizes 1 to 1M, flat vs model.predict)
+'''
+import numpy as np
+
+
+# (rows x trees) node indices evaluated at once, bounds the temporary memory
+DEFAULT_BLOCK_NODES = 1 << 20
+# batches up to this many rows are walked in python
+PYTHON_MAX_ROWS = 4
+
+class FlatTreeEnsemble:
+    '''
+    Sum of regression trees stored as flat node arrays
+
+    feature, threshold, missing_left, left, right, value: np.ndarray
+        - per node split feature, threshold (go left if x <= threshold), side of NaNs,
+          children (global indices, leaves point to themselves) and leaf value
+    roots: np.ndarray
+        - global index of the root of each tree
+    baseline: float
+        - constant added to the sum of the trees
+    '''
+    def __init__(self, feature, threshold, missing_left, left, right, value, roots, baseline, max_depth):
+        self.feature = np.asarray(feature, dtype=np.intp)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.missing_left = np.asarray(missing_left, dtype=bool)
+        self.left = np.asarray(left, dtype=np.intp)
+        self.right = np.asarray(right, dtype=np.intp)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.roots = np.asarray(roots, dtype=np.intp)
+        self.is_leaf = self.left == np.arange(len(self.left))
+        # left and right child of node i at 2 * i and 2 * i + 1
+        self.children = np.stack([self.left, self.right], axis=1).ravel()
+        self.baseline = float(baseline)
+        self.max_depth = int(max_depth)
+        self._lists = None
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        '''
+        Flatten a fitted single output HistGradientBoostingRegressor (numerical features only)
+        '''
+        arrays = {name:[] for name in ('feature', 'threshold', 'missing_left', 'left', 'right', 'value')}
+        roots, max_depth, offset = [], 0, 0
+        for predictors in model._predictors:
+            if len(predictors) != 1:
+                raise ValueError('Only single output models can be flattened')
+            nodes = predictors[0].nodes
+            if 'is_categorical' in nodes.dtype.names and nodes['is_categorical'].any():
+                raise ValueError('Trees with categorical splits can not be flattened')
+            is_leaf = nodes['is_leaf'].astype(bool)
+            own = offset + np.arange(len(nodes))
+            arrays['feature'].append(np.where(is_leaf, 0, nodes['feature_idx']))
+            arrays['threshold'].append(nodes['num_threshold'])
+            arrays['missing_left'].append(nodes['missing_go_to_left'].astype(bool))
+            arrays['left'].append(np.where(is_leaf, own, offset + nodes['left'].astype(np.intp)))
+            arrays['right'].append(np.where(is_leaf, own, offset + nodes['right'].astype(np.intp)))
+            arrays['value'].append(np.where(is_leaf, nodes['value'], 0))
+            roots.append(offset)
+            max_depth = max(max_depth, int(nodes['depth'].max()))
+            offset += len(nodes)
+        arrays = {name:np.concatenate(values) for name, values in arrays.items()}
+        baseline = np.ravel(model._baseline_prediction)[0]
+        return cls(roots=roots, baseline=baseline, max_depth=max_depth, **arrays)
+
+    def _tree_values(self, X):
+        # (n_rows, n_trees) leaf values, only the (row, tree) pairs not at a leaf yet are moved down
+        n_rows, n_features = X.shape
+        X_flat = X.ravel()
+        check_nan = np.isnan(X_flat).any()
+        values = np.empty(n_rows * self.n_trees)
+        # flat (row, tree) pair index and the row offset in X_flat of each active pair
+        pair = np.arange(n_rows * self.n_trees)
+        row_offset = (pair // self.n_trees) * n_features
+        node = np.tile(self.roots, n_rows)
+        for _ in range(self.max_depth + 1):
+            leaf = self.is_leaf[node]
+            if leaf.any():
+                values[pair[leaf]] = self.value[node[leaf]]
+                active = ~leaf
+                pair, row_offset, node = pair[active], row_offset[active], node[active]
+                if not len(node):
+                    break
+            x = X_flat[row_offset + self.feature[node]]
+            go_right = ~(x <= self.threshold[node])
+            if check_nan:
+                go_right &= ~(np.isnan(x) & self.missing_left[node])
+            node = self.children[2 * node + go_right]
+        return values.reshape(n_rows, self.n_trees)
+
+    def _predict_python(self, X):
+        # one row at a time over python lists, faster than numpy calls for a few rows
+        if self._lists is None:
+            self._lists = [a.tolist() for a in (self.feature, self.threshold, self.missing_left,
+                self.children, self.is_leaf, self.value, self.roots)]
+        feature, threshold, missing_left, children, is_leaf, value, roots = self._lists
+        out = np.empty(len(X))
+        for i, row in enumerate(X.tolist()):
+            raw = self.baseline
+            for node in roots:
+                while not is_leaf[node]:
+                    x = row[feature[node]]
+                    # x != x for NaN
+                    go_left = x <= threshold[node] or (x != x and missing_left[node])
+                    node = children[2 * node + (not go_left)]
+                raw += value[node]
+            out[i] = raw
+        return out
+
+    def predict(self, X, block_nodes=DEFAULT_BLOCK_NODES):
+        '''
+        Sum of the trees for each row of X (n_rows, n_features), same values as model.predict
+        '''
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[None, :]
+        if len(X) <= PYTHON_MAX_ROWS:
+            return self._predict_python(X)
+        out = np.empty(len(X))
+        block_rows = max(1, block_nodes // self.n_trees)
+        for start in range(0, len(X), block_rows):
+            values = self._tree_values(X[start:start + block_rows])
+            # same summation order as sklearn: baseline, then tree by tree
+            raw = np.full(len(values), self.baseline)
+            for j in range(self.n_trees):
+                raw += values[:, j]
+            out[start:start + len(values)] = raw
+        return out
+
+    def save(self, fpath):
+        np.savez(fpath, feature=self.feature, threshold=self.threshold, missing_left=self.missing_left,
+            left=self.left, right=self.right, value=self.value, roots=self.roots,
+            baseline=self.baseline, max_depth=self.max_depth)
+
+    @classmethod
+    def load(cls, fpath):
+        with np.load(fpath) as arrays:
+            return cls(**{name:arrays[name] for name in arrays.files})
+
+def check_exactness(model, flat, X):
+    '''
+    Raise AssertionError if flat.predict(X) is not exactly model.predict(X)
+    '''
+    import warnings
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='X does not have valid feature names')
+        expected = model.predict(np.asarray(X, dtype=np.float64))
+    actual = flat.predict(X)
+    if not np.array_equal(expected, actual):
+        raise AssertionError(f'Flat trees differ from model.predict (max abs diff {np.max(np.abs(expected - actual))})')
+
+def benchmark(model, flat, X, batch_sizes=(1, 10, 100, 1_000, 10_000, 100_000, 1_000_000), max_seconds=1.0):
+    '''
+    Mean seconds per call of model.predict and flat.predict for each batch size
+
+    Batches are taken from X (tiled if X is smaller), each size is repeated until max_seconds.
+    '''
+    import time
+    import warnings
+
+    def time_calls(func, batch):
+        n_calls, start = 0, time.perf_counter()
+        while n_calls == 0 or time.perf_counter() - start < max_seconds:
+            func(batch)
+            n_calls += 1
+        return (time.perf_counter() - start) / n_calls
+
+    results = []
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='X does not have valid feature names')
+        for batch_size in batch_sizes:
+            batch = np.resize(X, (batch_size, X.shape[1]))
+            results.append((batch_size, time_calls(model.predict, batch), time_calls(flat.predict, batch)))
+    return results
+
+def main():
+    import argparse
+    import os
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from joblib import load
+    from src.data.read import read_processed_test_data
+
+    parser = argparse.ArgumentParser(description='Flatten the trained model into node arrays')
+    parser.add_argument('command', choices=['export', 'bench'])
+    parser.add_argument('--model', default='models/best_estimator.joblib')
+    parser.add_argument('--output', default='models/best_estimator_flat.npz')
+    parser.add_argument('--check-rows', type=int, default=100_000)
+    parser.add_argument('--max-batch', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    print('Loading model....')
+    model = load(args.model)
+    flat = FlatTreeEnsemble.from_sklearn(model)
+    print(f'{flat.n_trees} trees, {len(flat.value)} nodes, max depth {flat.max_depth}')
+
+    print('Reading processed test data....')
+    X = read_processed_test_data().to_numpy(dtype=np.float64)
+
+    print('Checking predictions against model.predict....')
+    check_exactness(model, flat, X[:args.check_rows])
+
+    if args.command == 'export':
+        print(f'Saving flat trees to {args.output}....')
+        flat.save(args.output)
+    else:
+        batch_sizes = [size for size in (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000) if size <= args.max_batch]
+        print(f"{'batch':>9} {'model.predict':>15} {'flat':>12} {'speedup':>8}")
+        for batch_size, model_seconds, flat_seconds in benchmark(model, flat, X, batch_sizes):
+            print(f'{batch_size:>9} {model_seconds * 1e3:>12.3f} ms {flat_seconds * 1e3:>9.3f} ms {model_seconds / flat_seconds:>7.1f}x')
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
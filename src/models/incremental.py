@@ -0,0 +1,198 @@
+'''
+Module for updating the trained model with a new partition of trips (new interim --> model)
+
+Instead of refitting the preprocessing pl and the model on the full history:
+
+1. The StandardScaler statistics are updated with the new partition (partial_fit keeps
+   running sums, the median imputer fill values are kept).
+2. The split thresholds of the existing trees are mapped to the new scaling. The scaling is
+   monotonic per feature, so the existing trees make the same decisions on the rescaled data.
+3. New boosting stages are fitted on the residuals of the existing model over the new
+   partition plus a replay sample of the history (so the model doesn't forget older months),
+   and appended to the model.
+
+HistGradientBoostingRegressor(warm_start=True) is not used for 3: fit() rebins the new data
+with a new bin mapper but computes the predictions of the existing trees on it with their
+old bin thresholds, so the new stages would be fitted on wrong residuals. The stages are
+fitted as a separate model and their trees (which split on raw thresholds) are appended.
+
+The cost scales with the new partition and the replay sample, not with the history.
+
+The old splits are only bit-exact on features scaled by CompiledPreprocessing (the .npz, used
+by the predictor and features_train.py). The sklearn pl rounds differently, features scaled by
+it (get_features with the .joblib) can fall on the other side of a moved threshold: on 50k
+rows 76 predictions changed, by up to 0.036 in log(trip_duration).
+
+The processed data and the samples were scaled by the old pl: train.py refuses them (the
+fingerprint stored with them no longer matches, see compiled.check_fingerprint) until they
+are rebuilt.
+
+Steps 2 and 3 edit private attributes of the fitted HistGradientBoostingRegressor (_predictors,
+_baseline_prediction and the nodes of the TreePredictor), which sklearn can change in any
+release. Use the scikit-learn version pinned in requirements.txt, check_internals raises a
+RuntimeError on a model without them instead of corrupting it.
+'''
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.model_selection import train_test_split
+
+from ..features.builder import TripFeatureBuilder
+from ..features.compiled import compile_preprocessing_pl
+from ..features.features import kept_trips
+
+
+DEFAULT_REPLAY_SIZE = 200_000
+DEFAULT_N_ITER = 50
+# interim columns used to build the features and the target
+INTERIM_COLS = ['pickup_datetime', 'pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude', 'trip_duration']
+
+def trip_features(df, cols):
+    '''
+    Raw (unscaled) features cols and log(trip_duration) of interim trips, zero and missing distance
+    trips dropped as in features_train.py
+    '''
+    features_df = TripFeatureBuilder(cols=cols).transform_df(df)
+    keep = kept_trips(features_df['trip_distance'])
+    return features_df[keep], np.log(df['trip_duration'].to_numpy(dtype=np.float64)[keep])
+
+def replay_sample(fpath, n_rows, columns=INTERIM_COLS, n_groups=20, random_state=0):
+    '''
+    About n_rows random rows of a parquet file, read from up to n_groups random row groups
+    (only those row groups are read from disk)
+    '''
+    rng = np.random.default_rng(random_state)
+    parquet_file = pq.ParquetFile(fpath)
+    groups = rng.permutation(parquet_file.num_row_groups)[:n_groups]
+    per_group = -(-n_rows // len(groups))
+    samples = []
+    for group in groups:
+        df = parquet_file.read_row_group(int(group), columns=columns).to_pandas()
+        samples.append(df.sample(min(per_group, len(df)), random_state=int(rng.integers(2**31))))
+    return pd.concat(samples, ignore_index=True)
+
+def update_scaler(preprocessing_pl, features_df):
+    '''
+    Add features_df to the running mean/variance of the StandardScaler of a pl from
+    create_preprocessing_pl (in place), returns the pl
+    '''
+    column_transformer = preprocessing_pl.named_steps['column_transformer']
+    _, num_pipeline, cols = [t for t in column_transformer.transformers_ if t[0] != 'remainder'][0]
+    imputed = num_pipeline.named_steps['median_imputer'].transform(features_df[cols].astype(np.float64))
+    num_pipeline.named_steps['standard_scaler'].partial_fit(imputed)
+    return preprocessing_pl
+
+def _raw_thresholds(thresholds, scale, offset):
+    # largest raw x with x * scale + offset <= threshold (as computed by CompiledPreprocessing.transform)
+    raw = (thresholds - offset) / scale
+    for _ in range(64):
+        over = raw * scale + offset > thresholds
+        if not over.any():
+            break
+        raw = np.where(over, np.nextafter(raw, -np.inf), raw)
+    for _ in range(64):
+        up = np.nextafter(raw, np.inf)
+        under = up * scale + offset <= thresholds
+        if not under.any():
+            break
+        raw = np.where(under, up, raw)
+    return raw
+
+def check_internals(model):
+    '''
+    Raise RuntimeError if model doesn't have the private attributes the update edits
+    (HistGradientBoostingRegressor of another scikit-learn version than the pinned one)
+    '''
+    import sklearn
+
+    predictors = getattr(model, '_predictors', None)
+    nodes = getattr(predictors[0][0], 'nodes', None) if predictors else None
+    if (not hasattr(model, '_baseline_prediction') or nodes is None
+            or not {'is_leaf', 'feature_idx', 'num_threshold'}.issubset(nodes.dtype.names or ())):
+        raise RuntimeError(f'Incremental update is not supported with scikit-learn {sklearn.__version__}: the '
+                           'HistGradientBoostingRegressor internals it edits have changed, install the version '
+                           'from requirements.txt or retrain with src/models/train.py')
+
+def rescale_thresholds(model, old, new):
+    '''
+    Map the split thresholds of a fitted HistGradientBoostingRegressor from the scaling of
+    CompiledPreprocessing old to the one of new (in place), returns the model
+
+    The scaling is monotonic, so a threshold is moved to the scaled value (under new) of the
+    largest raw value that went left (under old), splits stay the same up to float rounding.
+    '''
+    for predictors in model._predictors:
+        for predictor in predictors:
+            nodes = predictor.nodes
+            split = ~nodes['is_leaf'].astype(bool)
+            feature = nodes['feature_idx'][split]
+            raw = _raw_thresholds(nodes['num_threshold'][split], old.scale[feature], old.offset[feature])
+            nodes['num_threshold'][split] = raw * new.scale[feature] + new.offset[feature]
+    return model
+
+def append_stages(model, stages):
+    '''
+    Append the trees of stages (a model fitted on the residuals of model) to model (in place)
+    '''
+    model._predictors.extend(stages._predictors)
+    model._baseline_prediction = model._baseline_prediction + stages._baseline_prediction
+    # n_iter_ is the number of predictors
+    model.max_iter = max(model.max_iter, model.n_iter_)
+    return model
+
+def _rmse(y_true, y_pred):
+    return float(np.sqrt(np.mean((y_true - y_pred)**2)))
+
+def incremental_update(model, preprocessing_pl, new_df, replay_df=None, n_iter=DEFAULT_N_ITER,
+        val_fraction=0.1, random_state=0):
+    '''
+    Update a fitted preprocessing pl and model with new interim trips (both in place)
+
+    model: HistGradientBoostingRegressor
+        - model from train.py (fitted on log(trip_duration) of the processed features)
+    preprocessing_pl: sklearn Pipeline
+        - pl from create_preprocessing_pl
+    new_df, replay_df: pd.DataFrame
+        - interim trips of the new partition and a sample of the history (see replay_sample)
+    n_iter: int
+        - maximum number of boosting stages added (early stopping is on above 10000 rows)
+
+    returns (model, compiled preprocessing, report), report has the validation rmse of
+    log(trip_duration) before and after on held out rows of new_df and replay_df
+    '''
+    check_internals(model)
+    old = compile_preprocessing_pl(preprocessing_pl)
+    new_features, y_new = trip_features(new_df, old.cols)
+    update_scaler(preprocessing_pl, new_features)
+    new = compile_preprocessing_pl(preprocessing_pl)
+    rescale_thresholds(model, old, new)
+
+    parts = [(new_features, y_new, np.ones(len(y_new), dtype=bool))]
+    if replay_df is not None and len(replay_df):
+        replay_features, y_replay = trip_features(replay_df, old.cols)
+        parts.append((replay_features, y_replay, np.zeros(len(y_replay), dtype=bool)))
+    X = pd.DataFrame(new.transform(pd.concat([p[0] for p in parts])), columns=new.cols)
+    y = np.concatenate([p[1] for p in parts])
+    is_new = np.concatenate([p[2] for p in parts])
+
+    X_train, X_val, y_train, y_val, _, is_new_val = train_test_split(X, y, is_new, test_size=val_fraction,
+        random_state=random_state)
+    pred_val = model.predict(X_val)
+    stages = HistGradientBoostingRegressor(max_iter=n_iter, learning_rate=model.learning_rate,
+        max_leaf_nodes=model.max_leaf_nodes, max_depth=model.max_depth, min_samples_leaf=model.min_samples_leaf,
+        l2_regularization=model.l2_regularization, random_state=random_state)
+    stages.fit(X_train, y_train - model.predict(X_train))
+    pred_val_after = pred_val + stages.predict(X_val)
+    append_stages(model, stages)
+
+    report = {
+        'new_rows': int(is_new.sum()),
+        'replay_rows': int((~is_new).sum()),
+        'stages_added': int(stages.n_iter_),
+        'rmse_before': _rmse(y_val, pred_val),
+        'rmse_after': _rmse(y_val, pred_val_after),
+        'rmse_new_before': _rmse(y_val[is_new_val], pred_val[is_new_val]),
+        'rmse_new_after': _rmse(y_val[is_new_val], pred_val_after[is_new_val]),
+    }
+    return model, new, report
@@ -0,0 +1,143 @@
+'''
+Module for load testing the prediction service (see service.py)
+
+Sends single-trip requests from concurrent clients and reports requests/sec and latency.
+With --compare it starts the service in a subprocess with row-at-a-time scoring (max batch
+size 1) and again with micro-batching, and runs the same load against both.
+
+Can be run as a script (To be run from main directory only)
+'''
+import json
+import threading
+import time
+import urllib.request
+
+import numpy as np
+
+
+def random_trip_payloads(n_trips, seed=0):
+    # JSON bodies of random single trips inside the NYC bounding box
+    import os
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from src.data.preprocess import NYC_MIN_LON, NYC_MAX_LON, NYC_MIN_LAT, NYC_MAX_LAT
+
+    rng = np.random.default_rng(seed)
+    payloads = []
+    for _ in range(n_trips):
+        pickup_datetime = f'2016-{rng.integers(1, 7):02d}-{rng.integers(1, 29):02d} {rng.integers(0, 24):02d}:{rng.integers(0, 60):02d}:00'
+        payloads.append(json.dumps({
+            'pickup_datetime': pickup_datetime,
+            'pickup_latitude': rng.uniform(NYC_MIN_LAT, NYC_MAX_LAT),
+            'pickup_longitude': rng.uniform(NYC_MIN_LON, NYC_MAX_LON),
+            'dropoff_latitude': rng.uniform(NYC_MIN_LAT, NYC_MAX_LAT),
+            'dropoff_longitude': rng.uniform(NYC_MIN_LON, NYC_MAX_LON),
+        }).encode())
+    return payloads
+
+def run_load(url, payloads, concurrency=32, duration=10.0):
+    '''
+    Send payloads round robin from concurrency threads for duration seconds
+
+    returns dict with requests/sec and latency percentiles (ms)
+    '''
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    stop_at = time.perf_counter() + duration
+
+    def client(i):
+        j = i
+        while time.perf_counter() < stop_at:
+            request = urllib.request.Request(url + '/predict', data=payloads[j % len(payloads)],
+                headers={'Content-Type': 'application/json'})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                latencies[i].append(time.perf_counter() - start)
+            except OSError:
+                errors[i] += 1
+            j += concurrency
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    all_latencies = np.concatenate([np.array(l) for l in latencies]) * 1e3
+    results = {
+        'requests': len(all_latencies),
+        'errors': sum(errors),
+        'requests_per_sec': len(all_latencies) / elapsed,
+    }
+    for q in (50, 95, 99):
+        results[f'latency_p{q}_ms'] = float(np.percentile(all_latencies, q)) if len(all_latencies) else None
+    return results
+
+def _print_results(name, results):
+    print(f"{name:<16} {results['requests_per_sec']:>10,.0f} req/sec  "
+          f"p50 {results['latency_p50_ms']:.1f} ms  p99 {results['latency_p99_ms']:.1f} ms  "
+          f"errors {results['errors']}")
+
+def _wait_until_healthy(url, process, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('service exited before becoming healthy')
+        try:
+            with urllib.request.urlopen(url + '/health'):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'service at {url} not healthy after {timeout} s')
+
+def main():
+    import argparse
+    import os
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+
+    parser = argparse.ArgumentParser(description='Load test the prediction service')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--compare', action='store_true',
+        help='start the service with and without micro-batching instead of using --url')
+    parser.add_argument('--max-batch-size', type=int, default=None)
+    args = parser.parse_args()
+
+    payloads = random_trip_payloads(1000)
+
+    if not args.compare:
+        print(f'Sending requests to {args.url} from {args.concurrency} clients for {args.duration} s....')
+        _print_results(args.url, run_load(args.url, payloads, args.concurrency, args.duration))
+        print('Done')
+        return
+
+    import subprocess
+    from src.models.service import DEFAULT_MAX_BATCH_SIZE
+
+    port = 8765
+    url = f'http://127.0.0.1:{port}'
+    for name, max_batch_size in [('row-at-a-time', 1), ('micro-batching', args.max_batch_size or DEFAULT_MAX_BATCH_SIZE)]:
+        print(f'Starting service with max batch size {max_batch_size}....')
+        service = subprocess.Popen(
+            [sys.executable, 'src/models/service.py', '--port', str(port), '--max-batch-size', str(max_batch_size)],
+            stdout=subprocess.DEVNULL)
+        try:
+            _wait_until_healthy(url, service)
+            print(f'Running {name} for {args.duration} s....')
+            _print_results(name, run_load(url, payloads, args.concurrency, args.duration))
+            with urllib.request.urlopen(url + '/metrics') as response:
+                print(f"mean batch size {json.load(response)['mean_batch_size']:.1f}")
+        finally:
+            service.terminate()
+            service.wait()
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+'''
+Module for out-of-core training on processed data larger than RAM (processed --> model)
+
+1. Stream the processed data once, keep a reservoir sample and count the rows.
+2. Compute per feature quantile bin edges (at most 255 bins) from the sample.
+3. Stream the data again and write the bin codes as uint8 to a memory mapped file on disk,
+   8x smaller than float64 features.
+4. Fit HistGradientBoostingRegressor stages block by block (in a random order every epoch)
+   on the binned codes: each stage learns the residuals of the previous stages on its block,
+   so only one block is ever converted to floats. The running predictions are kept on disk,
+   every stage is applied once to every block.
+
+Can be run as a script to train a model (To be run from main directory only)
+'''
+import os
+
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.ensemble import HistGradientBoostingRegressor
+
+
+MAX_BINS = 255
+DEFAULT_SAMPLE_SIZE = 200_000
+DEFAULT_BLOCK_SIZE = 1_000_000
+
+class ReservoirSampler:
+    '''
+    Uniform sample of fixed size over rows seen chunk by chunk (algorithm R, vectorized per chunk)
+    '''
+    def __init__(self, n_features, size=DEFAULT_SAMPLE_SIZE, random_state=0):
+        self.size = size
+        self.sample = np.empty((size, n_features))
+        self.n_seen = 0
+        self._rng = np.random.default_rng(random_state)
+
+    def update(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        n_fill = min(max(self.size - self.n_seen, 0), len(X))
+        self.sample[self.n_seen:self.n_seen + n_fill] = X[:n_fill]
+        rest = X[n_fill:]
+        if len(rest):
+            # row with global index i replaces a random slot with probability size / (i + 1)
+            seen = self.n_seen + n_fill + np.arange(len(rest))
+            slots = (self._rng.random(len(rest)) * (seen + 1)).astype(np.int64)
+            accept = slots < self.size
+            self.sample[slots[accept]] = rest[accept]
+        self.n_seen += len(X)
+        return self
+
+    def get_sample(self):
+        return self.sample[:min(self.n_seen, self.size)]
+
+def quantile_bin_edges(sample, max_bins=MAX_BINS):
+    '''
+    Per feature interior bin edges at the quantiles of sample (fewer for low cardinality features)
+    '''
+    quantiles = np.linspace(0, 1, max_bins + 1)[1:-1]
+    edges = []
+    for j in range(sample.shape[1]):
+        values = np.unique(sample[:, j])
+        if len(values) <= max_bins:
+            # one bin per distinct value
+            edges.append((values[:-1] + values[1:]) / 2)
+        else:
+            edges.append(np.unique(np.quantile(sample[:, j], quantiles)))
+    return edges
+
+def bin_features(X, bin_edges, out=None):
+    '''
+    uint8 bin codes of X (n_rows, n_features) for the given per feature edges
+    '''
+    X = np.asarray(X)
+    if out is None:
+        out = np.empty(X.shape, dtype=np.uint8)
+    for j, edges in enumerate(bin_edges):
+        out[:, j] = np.searchsorted(edges, X[:, j], side='right')
+    return out
+
+class BinnedBoostingRegressor(BaseEstimator, RegressorMixin):
+    '''
+    Boosted HistGradientBoostingRegressor stages fitted block by block on uint8 bin codes
+
+    predict() takes raw (processed) features and bins them with bin_edges, so the fitted
+    model can be scored by make_predictions like best_estimator.joblib (but not flattened by
+    FlatTreeEnsemble, its stages are not one HistGradientBoostingRegressor).
+
+    bin_edges: list
+        - per feature edges from quantile_bin_edges
+    block_size: int
+        - rows per stage, bounds the memory of fitting
+    iter_per_block: int
+        - boosting iterations of each stage
+    n_epochs: int
+        - passes over all blocks
+    '''
+    def __init__(self, bin_edges=None, block_size=DEFAULT_BLOCK_SIZE, iter_per_block=20, n_epochs=1,
+            learning_rate=0.1, max_leaf_nodes=300, random_state=None):
+        self.bin_edges = bin_edges
+        self.block_size = block_size
+        self.iter_per_block = iter_per_block
+        self.n_epochs = n_epochs
+        self.learning_rate = learning_rate
+        self.max_leaf_nodes = max_leaf_nodes
+        self.random_state = random_state
+
+    def _predict_codes(self, codes):
+        X = codes.astype(np.float32)
+        y_pred = np.full(len(codes), self.baseline_)
+        for stage in self.stages_:
+            y_pred += stage.predict(X)
+        return y_pred
+
+    def fit_binned(self, codes, y, on_block=None, pred_fpath=None):
+        '''
+        Fit on bin codes (e.g. a np.memmap from prebin_to_memmap) one block at a time
+
+        Every epoch visits the blocks in a random order. The running prediction of every row is
+        kept (in memory, or in a memory mapped file at pred_fpath), so visiting a block only
+        applies the stages fitted since its last visit.
+
+        on_block: callable
+            - optional callback(epoch, block_start, stage) for progress reporting
+        pred_fpath: str
+            - optional .npy file for the running predictions (8 bytes per row)
+        '''
+        n_rows = len(codes)
+        starts = np.arange(0, n_rows, self.block_size)
+        # mean over blocks so that y is never loaded in full
+        self.baseline_ = float(sum(np.sum(y[start:start + self.block_size], dtype=np.float64)
+            for start in starts) / n_rows)
+        if pred_fpath is None:
+            y_pred = np.full(n_rows, self.baseline_)
+        else:
+            y_pred = np.lib.format.open_memmap(pred_fpath, mode='w+', dtype=np.float64, shape=(n_rows,))
+            y_pred[:] = self.baseline_
+        # number of stages already in the running prediction of every block
+        n_applied = np.zeros(len(starts), dtype=np.int64)
+        rng = np.random.default_rng(self.random_state)
+        self.stages_ = []
+        for epoch in range(self.n_epochs):
+            for block in rng.permutation(len(starts)):
+                start = starts[block]
+                block_codes = np.asarray(codes[start:start + self.block_size])
+                block_X = block_codes.astype(np.float32)
+                block_pred = np.asarray(y_pred[start:start + self.block_size])
+                for stage in self.stages_[n_applied[block]:]:
+                    block_pred += stage.predict(block_X)
+                residuals = np.asarray(y[start:start + self.block_size], dtype=np.float64) - block_pred
+                stage = HistGradientBoostingRegressor(
+                    max_iter=self.iter_per_block,
+                    learning_rate=self.learning_rate,
+                    max_leaf_nodes=self.max_leaf_nodes,
+                    early_stopping=False,
+                    random_state=self.random_state,
+                )
+                stage.fit(block_X, residuals)
+                self.stages_.append(stage)
+                y_pred[start:start + self.block_size] = block_pred + stage.predict(block_X)
+                n_applied[block] = len(self.stages_)
+                if on_block:
+                    on_block(epoch, start, stage)
+        if pred_fpath is not None:
+            y_pred.flush()
+        return self
+
+    def fit(self, X, y):
+        # in memory convenience version of fit_binned
+        return self.fit_binned(bin_features(X, self.bin_edges), np.asarray(y))
+
+    def predict(self, X):
+        return self._predict_codes(bin_features(X, self.bin_edges))
+
+def sketch_processed_data(chunks_factory, feature_cols, sample_size=DEFAULT_SAMPLE_SIZE):
+    # pass 1: row count and reservoir sample of the features
+    sampler = ReservoirSampler(len(feature_cols), sample_size)
+    for chunk in chunks_factory():
+        sampler.update(chunk[feature_cols].to_numpy())
+    return sampler.n_seen, sampler.get_sample()
+
+def prebin_to_memmap(chunks_factory, feature_cols, target_col, bin_edges, n_rows, codes_fpath, y_fpath):
+    '''
+    pass 2: write uint8 codes (n_rows, n_features) and float32 targets to memory mapped files
+    '''
+    codes = np.lib.format.open_memmap(codes_fpath, mode='w+', dtype=np.uint8, shape=(n_rows, len(feature_cols)))
+    y = np.lib.format.open_memmap(y_fpath, mode='w+', dtype=np.float32, shape=(n_rows,))
+    start = 0
+    for chunk in chunks_factory():
+        stop = start + len(chunk)
+        bin_features(chunk[feature_cols].to_numpy(), bin_edges, out=codes[start:stop])
+        y[start:stop] = chunk[target_col].to_numpy()
+        start = stop
+    codes.flush()
+    y.flush()
+    return codes, y
+
+def main():
+    import argparse
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    import pyarrow.parquet as pq
+    from joblib import dump
+    from src.data.storage import read_parquet_chunks
+    from src.features.features import INTERIM_ROW_COL
+    # imported by module path (not __main__) so that the dumped model can be loaded elsewhere
+    from src.models.out_of_core import BinnedBoostingRegressor
+
+    parser = argparse.ArgumentParser(description='Train on processed data in chunks (out-of-core)')
+    parser.add_argument('--processed', default='data/processed/train.parquet')
+    parser.add_argument('--chunksize', type=int, default=500_000)
+    parser.add_argument('--sample-size', type=int, default=DEFAULT_SAMPLE_SIZE)
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--iter-per-block', type=int, default=20)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--binned-dir', default='data/processed')
+    # not models/best_estimator.joblib, the app and the compiled predictor expect a HistGradientBoostingRegressor
+    parser.add_argument('--output', default='models/out_of_core_estimator.joblib')
+    args = parser.parse_args()
+
+    target_col = 'log_trip_duration'
+    # the columns features_train.py wrote (with the spatial ones if it ran with --spatial), in order
+    feature_cols = [col for col in pq.read_schema(args.processed).names if col not in (target_col, INTERIM_ROW_COL)]
+    chunks = lambda: read_parquet_chunks(args.processed, args.chunksize)
+
+    print('Sketching processed data....')
+    n_rows, sample = sketch_processed_data(chunks, feature_cols, args.sample_size)
+    bin_edges = quantile_bin_edges(sample)
+
+    print(f'Binning {n_rows} rows to {args.binned_dir}....')
+    codes, y = prebin_to_memmap(chunks, feature_cols, target_col, bin_edges, n_rows,
+        os.path.join(args.binned_dir, 'train_binned_X.npy'), os.path.join(args.binned_dir, 'train_binned_y.npy'))
+
+    print('Training model....')
+    # last block is held out for validation
+    n_train = max(n_rows - min(args.block_size, n_rows // 10), 1)
+    regressor = BinnedBoostingRegressor(bin_edges, args.block_size, args.iter_per_block, args.epochs, random_state=0)
+    regressor.fit_binned(codes[:n_train], y[:n_train],
+        on_block=lambda epoch, start, _: print(f'epoch {epoch} rows {start}-{min(start + args.block_size, n_train)} done'),
+        pred_fpath=os.path.join(args.binned_dir, 'train_binned_pred.npy'))
+
+    y_val = np.asarray(y[n_train:], dtype=np.float64)
+    if len(y_val):
+        rmse_val = np.sqrt(np.mean((regressor._predict_codes(np.asarray(codes[n_train:])) - y_val)**2))
+        print('Validation error:')
+        print(f'Root mean squared error of log(trip_duration) = {rmse_val}')
+
+    print('Saving model....')
+    dump(regressor, args.output)
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
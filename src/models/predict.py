@@ -24,6 +24,8 @@ def main():
     import sys
     sys.path.append(os.path.abspath(os.getcwd()))
     from src.data.read import read_processed_test_data
+    from src.instrument import span
+    from src.drift import observe_predictions
     
     # Read processed test data
     print('Downloading processed test data....')
@@ -32,7 +34,10 @@ def main():
     # Feed to model to make predictions
     print('Making predictions....')
     loaded_model = load('models/best_estimator.joblib')
-    predictions = make_predictions(loaded_model, test)
+    with span('predict.make_predictions', len(test)):
+        predictions = make_predictions(loaded_model, test)
+    # counted by the drift monitor if it is enabled (see drift.py)
+    observe_predictions(predictions)
 
     # Save results to model_predictions
     print('Saving results....')
@@ -0,0 +1,201 @@
+'''
+Module for low latency predictions of single trips (used by the streamlit app)
+
+The preprocessing pipeline and model are loaded once per process. A trip is scored from
+plain floats: the features are written into a preallocated numpy row and the compiled
+imputer/scaler (features.compiled) is applied in place, no DataFrame is built.
+'''
+import math
+import threading
+import warnings
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from joblib import load
+
+from ..features.compiled import CompiledPreprocessing, compile_preprocessing_pl
+from ..features.features import SPATIAL_COLS
+from ..features.spatial import ODPriorTable
+from .flat_trees import FlatTreeEnsemble
+from .predict import make_predictions
+from ..instrument import instrumented
+from ..drift import get_monitor, observe_features, observe_predictions
+
+
+# Radius of earth in kilometers, same as features.distance
+EARTH_RADIUS_KM = 6371
+# batches up to this many rows are scored with the flat trees, larger ones with model.predict
+FLAT_MAX_ROWS = 16
+# trips_features arguments as TripFeatureBuilder input columns
+TRIP_COLS = ['pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude',
+    'pickup_datetime_date', 'pickup_datetime_day_of_week', 'pickup_datetime_hour']
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    # scalar version of features.distance.haversine, math is faster than numpy for one row
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2)**2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2)**2
+    return 2 * math.asin(math.sqrt(a)) * EARTH_RADIUS_KM
+
+class TripDurationPredictor:
+    '''
+    Score trips with a fitted preprocessing pl and model without going through pandas
+
+    model: sklearn regressor
+        - loaded model from models dir (predicts log(trip_duration))
+    preprocessing_pl: sklearn Pipeline or CompiledPreprocessing
+        - fitted pipeline from create_preprocessing_pl, compiled on load if needed
+    od_table: ODPriorTable
+        - zone-to-zone priors (features_train.py --spatial), needed if the pl has SPATIAL_COLS
+
+    A HistGradientBoostingRegressor is also flattened (flat_trees.py) for small batches.
+    '''
+    def __init__(self, model, preprocessing_pl, od_table=None):
+        self.model = model
+        self.flat_model = model if isinstance(model, FlatTreeEnsemble) else None
+        if self.flat_model is None and hasattr(model, '_predictors'):
+            try:
+                self.flat_model = FlatTreeEnsemble.from_sklearn(model)
+            except ValueError:
+                # e.g. categorical splits, model.predict is used for all batches
+                pass
+        if not isinstance(preprocessing_pl, CompiledPreprocessing):
+            preprocessing_pl = compile_preprocessing_pl(preprocessing_pl)
+        self.preprocessing = preprocessing_pl
+        self.cols = preprocessing_pl.cols
+        if od_table is None and set(SPATIAL_COLS) & set(self.cols):
+            raise ValueError(f'od_table is needed to build {SPATIAL_COLS}')
+        self.od_table = od_table
+        self._local = threading.local()
+
+    @classmethod
+    def from_files(cls, model_fpath='models/best_estimator.joblib', pl_fpath='models/preprocessing_pl.joblib',
+            od_fpath='models/od_prior.npz'):
+        # pl_fpath can be the sklearn pl (.joblib) or the compiled version (.npz)
+        # model_fpath can be the sklearn model (.joblib) or the flat trees (.npz)
+        # od_fpath is only loaded if the pl has SPATIAL_COLS
+        model = FlatTreeEnsemble.load(model_fpath) if str(model_fpath).endswith('.npz') else load(model_fpath)
+        preprocessing_pl = CompiledPreprocessing.load(pl_fpath) if str(pl_fpath).endswith('.npz') else load(pl_fpath)
+        preprocessing_pl = preprocessing_pl if isinstance(preprocessing_pl, CompiledPreprocessing) else \
+            compile_preprocessing_pl(preprocessing_pl)
+        od_table = ODPriorTable.load(od_fpath) if set(SPATIAL_COLS) & set(preprocessing_pl.cols) else None
+        return cls(model, preprocessing_pl, od_table)
+
+    def _row(self):
+        # one preallocated row per thread (streamlit serves sessions from several threads)
+        row = getattr(self._local, 'row', None)
+        if row is None:
+            row = self._local.row = np.empty((1, len(self.cols)))
+        return row
+
+    def transform(self, X):
+        '''
+        Apply the fitted imputer and scaler in place to X (n_rows, n_cols) in self.cols order
+        '''
+        return self.preprocessing.transform(X, out=X)
+
+    def _predict(self, X, monitor=True):
+        if self.flat_model is not None and len(X) <= FLAT_MAX_ROWS:
+            y_pred = make_predictions(self.flat_model, X)
+        else:
+            with warnings.catch_warnings():
+                # the model was fitted on a DataFrame, the column order is guaranteed by self.cols
+                warnings.filterwarnings('ignore', message='X does not have valid feature names')
+                y_pred = make_predictions(self.model, X)
+        if monitor:
+            observe_predictions(y_pred)
+        return y_pred
+
+    @instrumented()
+    def predict_features(self, X, monitor=True):
+        '''
+        Predict durations in seconds from raw (unscaled) features in self.cols order
+
+        monitor: bool
+            - False for synthetic trips (e.g. heatmap grids) that are not counted by drift.py
+        '''
+        X = np.array(X, dtype=np.float64, ndmin=2)
+        if monitor:
+            observe_features(X, self.cols)
+        return self._predict(self.transform(X), monitor)
+
+    def trip_features(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, day, day_of_week, hour, out=None):
+        '''
+        Raw (unscaled) features of one trip in self.cols order, written into out if given
+
+        day: day of month, day_of_week: 0 is Monday, hour: 0-23
+        '''
+        values = {
+            'trip_distance': _haversine_km(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon),
+            'pickup_datetime_date': day,
+            'pickup_datetime_day_of_week': day_of_week,
+            'pickup_datetime_hour': hour,
+            'pickup_latitude': pickup_lat,
+            'pickup_longitude': pickup_lon,
+            'dropoff_latitude': dropoff_lat,
+            'dropoff_longitude': dropoff_lon,
+        }
+        if self.od_table is not None:
+            grid = self.od_table.grid
+            pickup_cell, dropoff_cell = grid.cell_ids([pickup_lat, dropoff_lat], [pickup_lon, dropoff_lon])
+            values['pickup_cell'], values['dropoff_cell'] = pickup_cell, dropoff_cell
+            values['od_log_duration_prior'] = self.od_table.lookup([pickup_cell], [dropoff_cell], [hour])[0]
+        if out is None:
+            out = np.empty(len(self.cols))
+        for i, col in enumerate(self.cols):
+            out[i] = values[col]
+        return out
+
+    def trips_features(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, day, day_of_week, hour):
+        '''
+        Raw (unscaled) features of many trips in self.cols order, shape (n_trips, n_cols)
+
+        Arguments as in trip_features, as arrays or scalars broadcast against each other
+        (e.g. one pickup and a grid of dropoffs). Built by TripFeatureBuilder (the features of
+        the training data) in float64.
+        '''
+        args = np.broadcast_arrays(*[np.asarray(value, dtype=np.float64).ravel()
+            for value in (pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, day, day_of_week, hour)])
+        # imported here so that single trip scoring doesn't import sklearn
+        from ..features.builder import TripFeatureBuilder
+        trips = pd.DataFrame(dict(zip(TRIP_COLS, args)), copy=False)
+        builder = TripFeatureBuilder(cols=self.cols, od_table=self.od_table)
+        return builder.transform(trips, out=np.empty((len(trips), len(self.cols))))
+
+    @instrumented(rows=1)
+    def predict_trip(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, day, day_of_week, hour, monitor=True):
+        '''
+        Predict the duration in seconds of one trip (arguments as in trip_features)
+
+        monitor: bool
+            - False for synthetic trips (e.g. the warmup trip) that are not counted by drift.py
+        '''
+        row = self._row()
+        self.trip_features(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, day, day_of_week, hour, out=row[0])
+        if monitor:
+            observe_features(row, self.cols)
+        return float(self._predict(self.transform(row), monitor)[0])
+
+    def observe_trips(self, trips, predictions):
+        '''
+        Count trips answered without the model (e.g. cache hits) as served by drift.py
+
+        trips: list
+            - (pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, day, day_of_week, hour) tuples
+        predictions: list
+            - their durations in seconds
+        '''
+        if get_monitor() is None:
+            # features are only built when the monitor is on
+            return
+        X = np.empty((len(trips), len(self.cols)))
+        for row, trip in zip(X, trips):
+            self.trip_features(*trip, out=row)
+        observe_features(X, self.cols)
+        observe_predictions(predictions)
+
+@lru_cache(maxsize=None)
+def load_predictor(model_fpath='models/best_estimator.joblib', pl_fpath='models/preprocessing_pl.joblib'):
+    # artifacts are loaded once per process and path pair
+    return TripDurationPredictor.from_files(model_fpath, pl_fpath)
@@ -0,0 +1,280 @@
+'''
+Module for hyperparameter search with k-fold cross validation (processed --> model)
+
+Trials (one candidate on one fold) run in a process pool. Each worker limits its OpenMP
+threads so that n_jobs * threads_per_job does not oversubscribe the cores. Every finished
+trial is appended to a JSON lines file, rerunning with the same file skips the trials that
+are already in it, so an interrupted search resumes where it stopped. The first line of the
+file records the number of folds and a fingerprint of the data, a file written for other
+folds or other data is refused (or restarted with restart=True).
+
+Can be run as a script to search and save the best model (To be run from main directory only)
+'''
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.metrics import mean_squared_error
+from sklearn.model_selection import KFold, ParameterGrid, ParameterSampler
+
+
+DEFAULT_PARAM_GRID = {
+    'max_leaf_nodes': [31, 100, 300],
+    'learning_rate': [0.05, 0.1, 0.2],
+    'min_samples_leaf': [20, 100],
+    'l2_regularization': [0.0, 1.0],
+}
+DEFAULT_RESULTS_FPATH = 'models/search_results.jsonl'
+RANDOM_STATE = 42
+
+# data shared with the workers, set by _init_worker
+_worker_data = {}
+
+def grid_candidates(param_grid):
+    return list(ParameterGrid(param_grid))
+
+def random_candidates(param_grid, n_iter, random_state=RANDOM_STATE):
+    return list(ParameterSampler(param_grid, n_iter, random_state=random_state))
+
+def trial_key(params, fold, n_folds, n_samples):
+    # identifies a trial in the results file
+    return json.dumps({'params': params, 'fold': fold, 'n_folds': n_folds, 'n_samples': n_samples}, sort_keys=True)
+
+def data_fingerprint(X, y):
+    # sha256 of the shapes and bytes of the arrays the trials are run on
+    digest = hashlib.sha256()
+    for array in (X, y):
+        array = np.ascontiguousarray(array)
+        digest.update(f'{array.dtype}{array.shape}'.encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+def read_results(fpath):
+    '''
+    (header, finished trials by trial key) of a results file, the header is None for a
+    missing or empty file, lines cut off by an interruption are ignored
+    '''
+    header, results = None, {}
+    if not os.path.exists(fpath):
+        return header, results
+    with open(fpath) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if 'header' in record:
+                header = record['header']
+            elif 'n_folds' in record:
+                results[trial_key(record['params'], record['fold'], record['n_folds'], record['n_samples'])] = record
+    return header, results
+
+def _init_worker(X_fpath, y_fpath, threads_per_job):
+    from threadpoolctl import threadpool_limits
+    # HGB uses OpenMP, limit it per worker so that the pool doesn't oversubscribe the cores
+    _worker_data['limits'] = threadpool_limits(limits=threads_per_job)
+    # memory mapped so that all workers share the same pages
+    _worker_data['X'] = np.load(X_fpath, mmap_mode='r')
+    _worker_data['y'] = np.load(y_fpath, mmap_mode='r')
+
+def _fold_indices(n_rows, n_folds, fold):
+    kfold = KFold(n_splits=n_folds, shuffle=True, random_state=RANDOM_STATE)
+    return list(kfold.split(np.empty((n_rows, 1))))[fold]
+
+def _run_trial(params, fold, n_folds, n_samples):
+    X, y = _worker_data['X'], _worker_data['y']
+    train_idx, val_idx = _fold_indices(len(X), n_folds, fold)
+    if n_samples and n_samples < len(train_idx):
+        # successive halving budget: the first n_samples of the (shuffled) training fold
+        train_idx = train_idx[:n_samples]
+
+    regressor = HistGradientBoostingRegressor(random_state=RANDOM_STATE, **params)
+    start = time.perf_counter()
+    regressor.fit(X[train_idx], y[train_idx])
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    y_pred_val = regressor.predict(X[val_idx])
+    predict_time = time.perf_counter() - start
+
+    return {
+        'params': params,
+        'fold': fold,
+        'n_folds': n_folds,
+        'n_samples': n_samples,
+        'rmse_val': float(np.sqrt(mean_squared_error(y[val_idx], y_pred_val))),
+        'n_iter': int(regressor.n_iter_),
+        'fit_time': fit_time,
+        'predict_time': predict_time,
+    }
+
+def mean_scores(results, candidates, n_folds, n_samples):
+    # mean validation RMSE per candidate over its finished folds at budget n_samples
+    scores = []
+    for params in candidates:
+        rmses = [results[trial_key(params, fold, n_folds, n_samples)]['rmse_val']
+            for fold in range(n_folds) if trial_key(params, fold, n_folds, n_samples) in results]
+        scores.append(np.mean(rmses) if len(rmses) == n_folds else np.inf)
+    return np.array(scores)
+
+class SearchRunner:
+    '''
+    Run trials in a process pool, skipping and recording them in the results file
+
+    X, y: np.ndarray
+        - processed features and target, dumped once to .npy files next to the results file
+    n_jobs: int
+        - worker processes
+    threads_per_job: int
+        - OpenMP threads per worker, defaults to cores // n_jobs
+    restart: bool
+        - discard a results file written for other folds or other data instead of raising ValueError
+    '''
+    def __init__(self, X, y, n_folds=5, results_fpath=DEFAULT_RESULTS_FPATH, n_jobs=None, threads_per_job=None,
+            restart=False):
+        n_cores = os.cpu_count() or 1
+        self.n_folds = n_folds
+        self.results_fpath = results_fpath
+        self.n_jobs = n_jobs or max(1, n_cores // (threads_per_job or 1))
+        self.threads_per_job = threads_per_job or max(1, n_cores // self.n_jobs)
+
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        y = np.ascontiguousarray(y, dtype=np.float64)
+        header = {'n_folds': n_folds, 'data': data_fingerprint(X, y)}
+        previous_header, self.results = read_results(results_fpath)
+        if previous_header != header and (previous_header is not None or self.results):
+            if not restart:
+                raise ValueError(f'{results_fpath} was written for {previous_header}, not {header} '
+                    '(other folds or data), use another results file or restart')
+            self.results = {}
+        if previous_header != header or not os.path.exists(results_fpath):
+            with open(results_fpath, 'w') as f:
+                f.write(json.dumps({'header': header}) + '\n')
+
+        data_dir = os.path.dirname(os.path.abspath(results_fpath))
+        self.X_fpath = os.path.join(data_dir, 'search_X.npy')
+        self.y_fpath = os.path.join(data_dir, 'search_y.npy')
+        np.save(self.X_fpath, X)
+        np.save(self.y_fpath, y)
+
+    def run(self, candidates, n_samples=None):
+        '''
+        Cross validate every candidate at budget n_samples (None for the full training folds)
+
+        returns mean validation RMSE per candidate
+        '''
+        todo = [(params, fold) for params in candidates for fold in range(self.n_folds)
+            if trial_key(params, fold, self.n_folds, n_samples) not in self.results]
+        n_done = len(candidates) * self.n_folds - len(todo)
+        print(f'{len(todo)} trials to run ({n_done} already in {self.results_fpath}), '
+              f'{self.n_jobs} jobs x {self.threads_per_job} threads....')
+
+        if todo:
+            with ProcessPoolExecutor(self.n_jobs, initializer=_init_worker,
+                    initargs=(self.X_fpath, self.y_fpath, self.threads_per_job)) as executor, \
+                    open(self.results_fpath, 'a') as results_file:
+                futures = [executor.submit(_run_trial, params, fold, self.n_folds, n_samples) for params, fold in todo]
+                for future in as_completed(futures):
+                    record = future.result()
+                    # written as soon as the trial finishes so that an interrupted search can resume
+                    results_file.write(json.dumps(record) + '\n')
+                    results_file.flush()
+                    self.results[trial_key(record['params'], record['fold'], record['n_folds'], record['n_samples'])] = record
+                    print(f"fold {record['fold']} {record['params']} RMSE {record['rmse_val']:.4f} ({record['fit_time']:.1f} s)")
+
+        return mean_scores(self.results, candidates, self.n_folds, n_samples)
+
+    def cleanup(self):
+        for fpath in (self.X_fpath, self.y_fpath):
+            if os.path.exists(fpath):
+                os.remove(fpath)
+
+def successive_halving(runner, candidates, n_rows, min_samples=10_000, factor=3):
+    '''
+    Evaluate all candidates on min_samples rows, keep the best 1/factor and multiply the rows
+    by factor until one candidate (or the full training folds) is left
+
+    returns the surviving candidates and their scores at the last budget
+    '''
+    n_train = n_rows - n_rows // runner.n_folds
+    n_samples = min(min_samples, n_train)
+    while True:
+        budget = None if n_samples >= n_train else n_samples
+        scores = runner.run(candidates, budget)
+        if len(candidates) == 1 or budget is None:
+            return candidates, scores
+        n_keep = max(1, len(candidates) // factor)
+        best = np.argsort(scores)[:n_keep]
+        candidates = [candidates[i] for i in best]
+        n_samples *= factor
+
+def main():
+    import argparse
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from sklearn.model_selection import train_test_split
+    from joblib import dump
+    from src.data.read import read_processed_data
+    from src.data.storage import read_parquet_metadata
+    from src.features import check_fingerprint
+    from src.features.features import INTERIM_ROW_COL
+    from src.models.train import evaluate_regressor_skl
+
+    parser = argparse.ArgumentParser(description='Hyperparameter search for HistGradientBoostingRegressor')
+    parser.add_argument('--strategy', choices=['grid', 'random', 'halving'], default='halving')
+    parser.add_argument('--n-iter', type=int, default=10, help='candidates for random search')
+    parser.add_argument('--cv', type=int, default=5)
+    parser.add_argument('--n-jobs', type=int, default=None)
+    parser.add_argument('--threads-per-job', type=int, default=None)
+    parser.add_argument('--min-samples', type=int, default=10_000, help='first budget for halving')
+    parser.add_argument('--results', default=DEFAULT_RESULTS_FPATH)
+    parser.add_argument('--restart', action='store_true',
+        help='discard a results file written for another --cv or other processed data')
+    parser.add_argument('--preprocessing-affine', default='models/preprocessing_affine.npz',
+        help='compiled preprocessing the processed data must have been written with')
+    args = parser.parse_args()
+
+    print('Reading processed data....')
+    check_fingerprint(read_parquet_metadata('data/processed/train.parquet').get('preprocessing'), args.preprocessing_affine)
+    df = read_processed_data()
+    X = df.drop(['log_trip_duration', INTERIM_ROW_COL], axis=1, errors='ignore')
+    y = df['log_trip_duration']
+
+    if args.strategy == 'random':
+        candidates = random_candidates(DEFAULT_PARAM_GRID, args.n_iter)
+    else:
+        candidates = grid_candidates(DEFAULT_PARAM_GRID)
+
+    print(f'Searching {len(candidates)} candidates ({args.strategy}, {args.cv} folds)....')
+    runner = SearchRunner(X.to_numpy(), y.to_numpy(), args.cv, args.results, args.n_jobs, args.threads_per_job,
+        args.restart)
+    try:
+        if args.strategy == 'halving':
+            candidates, scores = successive_halving(runner, candidates, len(X), args.min_samples)
+        else:
+            scores = runner.run(candidates)
+    finally:
+        runner.cleanup()
+    best_params = candidates[int(np.argmin(scores))]
+    print(f'Best params {best_params} with mean validation RMSE {np.min(scores):.4f}')
+
+    print('Training model....')
+    X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.1)
+    training_results = evaluate_regressor_skl(
+        HistGradientBoostingRegressor(**best_params),
+        X_train,
+        y_train,
+        X_val,
+        y_val
+    )
+
+    print('Saving model....')
+    dump(training_results[0], 'models/best_estimator.joblib')
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+'''
+Module for serving predictions over HTTP/JSON with micro-batching
+
+Concurrent requests are queued and scored together, so the model predicts on matrices
+instead of one row at a time.
+
+    POST /predict   {"pickup_datetime": "2016-03-14 17:24:55", "pickup_latitude": 40.8075, ...}
+                    or a list of such trips, returns {"trip_duration": [seconds, ...]}
+    GET  /metrics   throughput, batch size and latency statistics
+    GET  /drift     drift scores of the scored trips against the training data (see drift.py)
+    GET  /health
+
+Can be run as a script to start the service (To be run from main directory only)
+'''
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+DEFAULT_MAX_BATCH_SIZE = 256
+DEFAULT_MAX_WAIT_MS = 5
+LATENCY_WINDOW = 10_000
+TRIP_FIELDS = ['pickup_datetime', 'pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude']
+
+class ServiceMetrics:
+    '''
+    Counters and a window of recent request latencies (thread safe)
+    '''
+    def __init__(self, window=LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.trips = 0
+        self.batches = 0
+        self.batched_trips = 0
+        self.max_batch = 0
+        self.errors = 0
+
+    def record_request(self, n_trips, latency):
+        with self._lock:
+            self.requests += 1
+            self.trips += n_trips
+            self._latencies.append(latency)
+
+    def record_batch(self, n_trips):
+        with self._lock:
+            self.batches += 1
+            self.batched_trips += n_trips
+            self.max_batch = max(self.max_batch, n_trips)
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def summary(self):
+        with self._lock:
+            uptime = time.perf_counter() - self.started
+            latencies_ms = np.array(self._latencies) * 1e3
+            summary = {
+                'uptime_sec': uptime,
+                'requests': self.requests,
+                'trips': self.trips,
+                'errors': self.errors,
+                'batches': self.batches,
+                'mean_batch_size': self.batched_trips / self.batches if self.batches else 0.0,
+                'max_batch_size': self.max_batch,
+                'requests_per_sec': self.requests / uptime,
+                'trips_per_sec': self.trips / uptime,
+            }
+        for q in (50, 95, 99):
+            summary[f'latency_p{q}_ms'] = float(np.percentile(latencies_ms, q)) if len(latencies_ms) else None
+        return summary
+
+class MicroBatcher:
+    '''
+    Group feature rows submitted from many threads into batches for predict_fn
+
+    predict_fn: callable
+        - maps an (n_rows, n_features) array to n_rows predictions
+    max_batch_size: int
+        - a batch is scored as soon as it has this many rows
+    max_wait_ms: float
+        - or once the first queued request has waited this long
+    '''
+    def __init__(self, predict_fn, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS, metrics=None):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+        self.metrics = metrics or ServiceMetrics()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, rows):
+        # returns a Future resolving to the predictions for rows
+        future = Future()
+        rows = np.asarray(rows, dtype=np.float64)
+        self._queue.put((rows.reshape(1, -1) if rows.ndim == 1 else rows, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        n_rows = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while n_rows < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            n_rows += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                X = np.concatenate([rows for rows, _ in batch])
+                y = self.predict_fn(X)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.metrics.record_batch(len(X))
+            start = 0
+            for rows, future in batch:
+                future.set_result(y[start:start + len(rows)])
+                start += len(rows)
+
+def trips_to_features(predictor, trips):
+    '''
+    Raw feature matrix for a list of trip dicts (see TRIP_FIELDS)
+    '''
+    X = np.empty((len(trips), len(predictor.cols)))
+    for i, trip in enumerate(trips):
+        if not isinstance(trip, dict):
+            raise ValueError(f'trip {i} is not a JSON object')
+        missing = [field for field in TRIP_FIELDS if field not in trip]
+        if missing:
+            raise ValueError(f'trip {i} is missing {missing}')
+        pickup_datetime = datetime.fromisoformat(trip['pickup_datetime'])
+        predictor.trip_features(
+            float(trip['pickup_latitude']),
+            float(trip['pickup_longitude']),
+            float(trip['dropoff_latitude']),
+            float(trip['dropoff_longitude']),
+            pickup_datetime.day,
+            pickup_datetime.weekday(),
+            pickup_datetime.hour,
+            out=X[i],
+        )
+    return X
+
+def make_handler(predictor, batcher, request_timeout=30, drift_scores=None):
+    metrics = batcher.metrics
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, metrics.summary())
+            elif self.path == '/drift' and drift_scores is not None:
+                scores = drift_scores()
+                if scores is None:
+                    self._send_json(404, {'error': 'drift monitoring is not enabled'})
+                else:
+                    self._send_json(200, scores)
+            elif self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error': f'unknown path {self.path}'})
+                return
+            start = time.perf_counter()
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                trips = payload if isinstance(payload, list) else [payload]
+                X = trips_to_features(predictor, trips)
+            except (ValueError, TypeError, KeyError) as e:
+                metrics.record_error()
+                self._send_json(400, {'error': str(e)})
+                return
+            if not trips:
+                self._send_json(200, {'trip_duration': []})
+                return
+            try:
+                y = batcher.submit(X).result(timeout=request_timeout)
+            except Exception as e:
+                metrics.record_error()
+                self._send_json(500, {'error': str(e)})
+                return
+            metrics.record_request(len(trips), time.perf_counter() - start)
+            self._send_json(200, {'trip_duration': y.tolist()})
+
+        def log_message(self, format, *args):
+            # per request access logs would dominate the cost of a prediction
+            pass
+
+    return PredictionHandler
+
+class _PredictionServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections under concurrent load
+    request_queue_size = 1024
+
+def make_server(predictor, host='127.0.0.1', port=8000, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS,
+        drift_scores=None):
+    '''
+    Create (but don't start) a threaded HTTP server scoring with predictor
+
+    predictor: TripDurationPredictor
+    port: int
+        - 0 picks a free port, see server.server_address
+    drift_scores: callable
+        - served on GET /drift (e.g. src.drift.drift_scores)
+    '''
+    batcher = MicroBatcher(predictor.predict_features, max_batch_size, max_wait_ms)
+    server = _PredictionServer((host, port), make_handler(predictor, batcher, drift_scores=drift_scores))
+    server.batcher = batcher
+    return server
+
+def main():
+    import argparse
+    import os
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from src.models.predictor import load_predictor
+    from src import drift
+
+    parser = argparse.ArgumentParser(description='Serve trip duration predictions over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument('--max-wait-ms', type=float, default=DEFAULT_MAX_WAIT_MS)
+    parser.add_argument('--model', default='models/best_estimator.joblib')
+    parser.add_argument('--preprocessing-pl', default='models/preprocessing_pl.joblib')
+    parser.add_argument('--drift-reference', default=None, help='monitor drift against this profile (see drift.py)')
+    args = parser.parse_args()
+
+    if args.drift_reference:
+        drift.enable(args.drift_reference)
+
+    print('Loading model and preprocessing pipeline....')
+    predictor = load_predictor(args.model, args.preprocessing_pl)
+
+    server = make_server(predictor, args.host, args.port, args.max_batch_size, args.max_wait_ms, drift.drift_scores)
+    print(f'Serving on http://{args.host}:{server.server_address[1]} '
+          f'(max batch size {args.max_batch_size}, max wait {args.max_wait_ms} ms)....')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
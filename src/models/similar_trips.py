@@ -0,0 +1,369 @@
+'''
+Module for finding the most similar past trips of a query trip (interim --> models/similar_trips/)
+
+Trips are points (pickup x/y, dropoff x/y in km on a local projection, hour of day) and the
+distance between two trips is the euclidean distance of their pickups and dropoffs plus
+hour_km km per hour apart (circular, 23h and 0h are 1 hour apart). The index buckets the
+trips by (pickup cell, dropoff cell) on grids of a few cell sizes (levels), a query scans
+the buckets within r cells of its pickup and dropoff cells, from the finest level to the
+coarsest, and stops once its k-th neighbour is closer than the edge of the scanned buckets
+(no closer trip can be outside of them).
+
+The arrays are saved as .npy files and memory mapped on first use, so loading the index is
+instant and the pages are shared between processes. KNNDurationEstimator predicts the median
+duration of the k nearest trips, which can be blended into the model predictions.
+
+Can be run as a script (To be run from main directory only)
+    python src/models/similar_trips.py build      (data/interim/train.parquet --> models/similar_trips/)
+    python src/models/similar_trips.py query 40.7589 -73.9851 40.6413 -73.7781 17 -k 10
+    python src/models/similar_trips.py evaluate   (kNN vs model vs blends on the last weeks of interim data)
+'''
+import json
+import math
+import os
+from functools import lru_cache
+
+import numpy as np
+
+
+DEFAULT_INDEX_DIR = 'models/similar_trips'
+# cell sizes of the bucket levels, fine cells for dense areas and coarse ones for sparse areas
+DEFAULT_CELL_KM = (0.5, 2.0, 8.0)
+# a trip one hour apart is as far as a trip with its pickup hour_km km away
+DEFAULT_HOUR_KM = 0.5
+DEFAULT_K = 20
+# radii (in cells) scanned on each level before moving to the next one (then to a scan of all trips)
+DEFAULT_RADII = (1, 2)
+# queries scored together, bounds the candidate arrays
+DEFAULT_QUERY_BLOCK = 256
+KM_PER_DEGREE_LAT = 111.2
+TRIP_ARRAYS = ['points', 'hours', 'durations', 'ids']
+
+class SimilarTripsIndex:
+    '''
+    Grid bucketed k nearest neighbour index over past trips
+
+    min_lat, min_lon: float
+        - origin of the local projection and of the grids
+    height_km, width_km: float
+        - extent of the grids
+    cell_km: list
+        - cell size of each level, the trips are stored sorted by the buckets of the first one
+    hour_km: float
+        - distance of one hour of pickup time difference
+    arrays: dict
+        - trip arrays (TRIP_ARRAYS) and buckets of each level (see build), None to memory map
+          them from dirpath on first use
+    '''
+    def __init__(self, min_lat, min_lon, height_km, width_km, cell_km=DEFAULT_CELL_KM, hour_km=DEFAULT_HOUR_KM,
+            arrays=None, dirpath=None):
+        self.min_lat, self.min_lon = float(min_lat), float(min_lon)
+        self.height_km, self.width_km = float(height_km), float(width_km)
+        self.cell_km = [float(size) for size in cell_km]
+        self.hour_km = float(hour_km)
+        # km per degree of longitude in the middle of the grid
+        self.km_per_degree_lon = KM_PER_DEGREE_LAT * math.cos(math.radians(self.min_lat + self.height_km / KM_PER_DEGREE_LAT / 2))
+        self.dirpath = dirpath
+        self._arrays = arrays
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            names = TRIP_ARRAYS + [f'{name}_{level}' for level in range(len(self.cell_km))
+                for name in ('bucket_keys', 'bucket_offsets', 'rows') if name != 'rows' or level > 0]
+            self._arrays = {name:np.load(os.path.join(self.dirpath, f'{name}.npy'), mmap_mode='r') for name in names}
+        return self._arrays
+
+    def __len__(self):
+        return len(self.arrays['durations'])
+
+    def params(self):
+        return {'min_lat': self.min_lat, 'min_lon': self.min_lon, 'height_km': self.height_km,
+            'width_km': self.width_km, 'cell_km': self.cell_km, 'hour_km': self.hour_km}
+
+    def grid_shape(self, level):
+        return (int(math.ceil(self.height_km / self.cell_km[level])), int(math.ceil(self.width_km / self.cell_km[level])))
+
+    def project(self, lat, lon):
+        # (y, x) km from the grid origin
+        y = (np.asarray(lat, dtype=np.float64) - self.min_lat) * KM_PER_DEGREE_LAT
+        x = (np.asarray(lon, dtype=np.float64) - self.min_lon) * self.km_per_degree_lon
+        return y, x
+
+    def _points(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
+        return np.stack([*self.project(pickup_lat, pickup_lon), *self.project(dropoff_lat, dropoff_lon)], axis=1)
+
+    def _cells(self, points, level):
+        # (n, 4) pickup y/x and dropoff y/x cell indices, points outside of the grid are snapped to the edge
+        n_y, n_x = self.grid_shape(level)
+        cells = np.floor(points / self.cell_km[level]).astype(np.int64)
+        return np.clip(cells, 0, np.array([n_y, n_x, n_y, n_x]) - 1)
+
+    def _bucket_keys(self, cells, level):
+        # (pickup cell, dropoff cell) key of cell indices (..., 4)
+        n_y, n_x = self.grid_shape(level)
+        return ((cells[..., 0] * n_x + cells[..., 1]) * n_y + cells[..., 2]) * n_x + cells[..., 3]
+
+    @classmethod
+    def build(cls, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, hours, durations, ids=None,
+            min_lat=40.0, max_lat=41.6, min_lon=-74.4, max_lon=-73.4, cell_km=DEFAULT_CELL_KM, hour_km=DEFAULT_HOUR_KM):
+        '''
+        Index of the given trips (bounding box defaults to NYC_MIN_LAT..NYC_MAX_LON of preprocess.py)
+        '''
+        height_km = (max_lat - min_lat) * KM_PER_DEGREE_LAT
+        index = cls(min_lat, min_lon, height_km, 1, cell_km, hour_km)
+        index.width_km = (max_lon - min_lon) * index.km_per_degree_lon
+
+        # cells are computed from the stored (float32) points, so that every trip is in the bucket of its stored point
+        points = index._points(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon).astype(np.float32)
+        order = np.argsort(index._bucket_keys(index._cells(points, 0), 0), kind='stable')
+        ids = np.arange(len(points)) if ids is None else np.asarray(ids)
+        arrays = {
+            'points': points[order],
+            'hours': np.asarray(hours, dtype=np.uint8)[order],
+            'durations': np.asarray(durations, dtype=np.float32)[order],
+            'ids': ids[order].astype('S') if ids.dtype == object else ids[order],
+        }
+        for level in range(len(index.cell_km)):
+            keys = index._bucket_keys(index._cells(arrays['points'], level), level)
+            # rows of the trips sorted by the buckets of this level (the trips are already sorted for level 0)
+            rows = np.argsort(keys, kind='stable') if level else np.arange(len(keys))
+            bucket_keys, bucket_starts = np.unique(keys[rows], return_index=True)
+            arrays[f'bucket_keys_{level}'] = bucket_keys
+            arrays[f'bucket_offsets_{level}'] = np.append(bucket_starts, len(keys)).astype(np.int64)
+            if level:
+                arrays[f'rows_{level}'] = rows.astype(np.int32 if len(rows) < 2**31 else np.int64)
+        index._arrays = arrays
+        return index
+
+    def save(self, dirpath):
+        os.makedirs(dirpath, exist_ok=True)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(dirpath, f'{name}.npy'), np.ascontiguousarray(array))
+        with open(os.path.join(dirpath, 'params.json'), 'w') as f:
+            json.dump(self.params(), f, indent=2)
+
+    @classmethod
+    def load(cls, dirpath):
+        # only the parameters are read, the arrays are memory mapped on first use
+        with open(os.path.join(dirpath, 'params.json')) as f:
+            params = json.load(f)
+        return cls(**params, dirpath=dirpath)
+
+    def _distances(self, query_points, query_hours, rows):
+        points = self.arrays['points'][rows]
+        d2 = np.sum((points - query_points.astype(np.float32))**2, axis=1, dtype=np.float64)
+        hour_diff = np.abs(self.arrays['hours'][rows].astype(np.int64) - query_hours)
+        hour_diff = np.minimum(hour_diff, 24 - hour_diff) * self.hour_km
+        return np.sqrt(d2 + hour_diff * hour_diff)
+
+    def _candidates(self, points, level, radius):
+        # (query number, row) of every trip in the buckets of level within radius cells of each query
+        steps = np.arange(-radius, radius + 1)
+        offsets = np.stack(np.meshgrid(steps, steps, steps, steps, indexing='ij'), axis=-1).reshape(-1, 4)
+        n_y, n_x = self.grid_shape(level)
+        cells = self._cells(points, level)[:, None, :] + offsets[None, :, :]
+        valid = np.all((cells >= 0) & (cells < np.array([n_y, n_x, n_y, n_x])), axis=2)
+        keys = self._bucket_keys(cells, level)
+
+        bucket_keys, bucket_offsets = self.arrays[f'bucket_keys_{level}'], self.arrays[f'bucket_offsets_{level}']
+        pos = np.minimum(np.searchsorted(bucket_keys, keys), len(bucket_keys) - 1)
+        found = valid & (bucket_keys[pos] == keys)
+        query_idx = np.broadcast_to(np.arange(len(points))[:, None], keys.shape)[found]
+        starts, stops = bucket_offsets[pos[found]], bucket_offsets[pos[found] + 1]
+        lengths = stops - starts
+        # positions start..stop of each found bucket, concatenated
+        positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        rows = self.arrays[f'rows_{level}'][positions].astype(np.int64) if level else positions
+        return np.repeat(query_idx, lengths), rows
+
+    def _margins(self, points, level, radius):
+        # distance from each point to the outside of the buckets within radius cells of its cells
+        cell_km = self.cell_km[level]
+        cells = self._cells(points, level)
+        low, high = (cells - radius) * cell_km, (cells + radius + 1) * cell_km
+        return np.minimum(points - low, high - points).min(axis=1)
+
+    def _query_block(self, points, hours, k, radii):
+        n_queries = len(points)
+        neighbours = np.full((n_queries, k), -1, dtype=np.int64)
+        distances = np.full((n_queries, k), np.inf)
+        todo = np.arange(n_queries)
+        for level in range(len(self.cell_km)):
+            for radius in radii:
+                if not len(todo):
+                    return neighbours, distances
+                query_idx, rows = self._candidates(points[todo], level, radius)
+                dist = self._distances(points[todo][query_idx], hours[todo][query_idx], rows)
+                # candidates are grouped by query, the k nearest of each group are selected (no full sort)
+                bounds = np.searchsorted(query_idx, np.arange(len(todo) + 1))
+                for j, i in enumerate(todo):
+                    group_dist = dist[bounds[j]:bounds[j + 1]]
+                    nearest = np.argpartition(group_dist, k - 1)[:k] if len(group_dist) > k else np.arange(len(group_dist))
+                    nearest = nearest[np.argsort(group_dist[nearest], kind='stable')]
+                    neighbours[i, :len(nearest)] = rows[bounds[j] + nearest]
+                    distances[i, :len(nearest)] = group_dist[nearest]
+                # exact once the k-th neighbour is closer than any trip outside of the scanned buckets
+                todo = todo[distances[todo, -1] > self._margins(points[todo], level, radius)]
+
+        for i in todo:
+            # very sparse areas: scan all trips
+            dist = self._distances(points[i], hours[i], slice(None))
+            nearest = np.argpartition(dist, k - 1)[:k] if len(dist) > k else np.arange(len(dist))
+            nearest = nearest[np.argsort(dist[nearest], kind='stable')]
+            neighbours[i, :len(nearest)], distances[i, :len(nearest)] = nearest, dist[nearest]
+        return neighbours, distances
+
+    def query(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, hours, k=DEFAULT_K,
+            radii=DEFAULT_RADII, block_size=DEFAULT_QUERY_BLOCK):
+        '''
+        (n_queries, k) rows of the k nearest trips and their distances, nearest first
+
+        Arguments are arrays (or scalars) of the query trips, rows index the trip arrays
+        (row -1 / distance inf when the index has fewer than k trips).
+        '''
+        points = self._points(np.atleast_1d(pickup_lat), np.atleast_1d(pickup_lon),
+            np.atleast_1d(dropoff_lat), np.atleast_1d(dropoff_lon))
+        hours = np.broadcast_to(np.asarray(hours, dtype=np.int64), len(points))
+        neighbours = np.empty((len(points), k), dtype=np.int64)
+        distances = np.empty((len(points), k))
+        for start in range(0, len(points), block_size):
+            block = slice(start, start + block_size)
+            neighbours[block], distances[block] = self._query_block(points[block], hours[block], k, radii)
+        return neighbours, distances
+
+    def similar_trips(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, hour, k=DEFAULT_K):
+        '''
+        DataFrame of the k most similar past trips of one query trip, nearest first
+        '''
+        import pandas as pd
+
+        rows, distances = self.query(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, hour, k)
+        rows, distances = rows[0][rows[0] >= 0], distances[0][rows[0] >= 0]
+        ids = self.arrays['ids'][rows]
+        points = self.arrays['points'][rows].astype(np.float64)
+        return pd.DataFrame({
+            'id': ids.astype(str) if ids.dtype.kind == 'S' else ids,
+            'pickup_latitude': self.min_lat + points[:, 0] / KM_PER_DEGREE_LAT,
+            'pickup_longitude': self.min_lon + points[:, 1] / self.km_per_degree_lon,
+            'dropoff_latitude': self.min_lat + points[:, 2] / KM_PER_DEGREE_LAT,
+            'dropoff_longitude': self.min_lon + points[:, 3] / self.km_per_degree_lon,
+            'hour': self.arrays['hours'][rows],
+            'trip_duration': self.arrays['durations'][rows],
+            'distance_km': distances,
+        })
+
+class KNNDurationEstimator:
+    '''
+    Median trip_duration (seconds) of the k most similar past trips
+    '''
+    def __init__(self, index, k=DEFAULT_K):
+        self.index = index
+        self.k = k
+
+    def predict(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, hours):
+        rows, _ = self.index.query(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, hours, self.k)
+        durations = np.where(rows >= 0, self.index.arrays['durations'][np.maximum(rows, 0)], np.nan)
+        return np.nanmedian(durations, axis=1)
+
+    def predict_df(self, df):
+        # df with the raw/interim pickup and dropoff columns and pickup_datetime
+        return self.predict(df['pickup_latitude'], df['pickup_longitude'], df['dropoff_latitude'],
+            df['dropoff_longitude'], df['pickup_datetime'].dt.hour.to_numpy())
+
+def blend_predictions(model_pred, knn_pred, weight):
+    '''
+    Geometric blend of the model and kNN durations (the model is fitted on log(trip_duration)),
+    weight is the share of the kNN estimate, the model is used where the kNN estimate is missing
+    '''
+    knn_pred = np.where(np.isnan(knn_pred), model_pred, knn_pred)
+    return np.exp((1 - weight) * np.log(model_pred) + weight * np.log(knn_pred))
+
+@lru_cache(maxsize=None)
+def load_similar_trips_index(dirpath=DEFAULT_INDEX_DIR):
+    # one index per process, its arrays are mapped on the first query
+    return SimilarTripsIndex.load(dirpath)
+
+def _rmsle(y_true, y_pred):
+    return float(np.sqrt(np.mean((np.log1p(y_pred) - np.log1p(y_true))**2)))
+
+def main():
+    import argparse
+    import sys
+    import time
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from src.data.preprocess import NYC_MIN_LON, NYC_MAX_LON, NYC_MIN_LAT, NYC_MAX_LAT
+    from src.data.read import read_interim_data
+    from src.instrument import span
+
+    parser = argparse.ArgumentParser(description='Similar past trips index and kNN duration estimates')
+    parser.add_argument('command', choices=['build', 'query', 'evaluate'])
+    parser.add_argument('trip', nargs='*', type=float, help='query: pickup_lat pickup_lon dropoff_lat dropoff_lon hour')
+    parser.add_argument('--interim', default='data/interim/train.parquet')
+    parser.add_argument('--index', default=DEFAULT_INDEX_DIR)
+    parser.add_argument('-k', type=int, default=DEFAULT_K)
+    parser.add_argument('--cell-km', type=float, nargs='+', default=DEFAULT_CELL_KM, help='cell size of each level')
+    parser.add_argument('--hour-km', type=float, default=DEFAULT_HOUR_KM)
+    parser.add_argument('--holdout-days', type=int, default=14, help='evaluate: last days of the interim data held out')
+    parser.add_argument('--eval-rows', type=int, default=20_000, help='evaluate: holdout trips scored')
+    parser.add_argument('--model', default='models/best_estimator.joblib')
+    parser.add_argument('--preprocessing', default='models/preprocessing_affine.npz')
+    args = parser.parse_args()
+
+    def build_index(df):
+        return SimilarTripsIndex.build(df['pickup_latitude'], df['pickup_longitude'], df['dropoff_latitude'],
+            df['dropoff_longitude'], df['pickup_datetime'].dt.hour.to_numpy(), df['trip_duration'], df['id'],
+            NYC_MIN_LAT, NYC_MAX_LAT, NYC_MIN_LON, NYC_MAX_LON, args.cell_km, args.hour_km)
+
+    cols = ['id', 'pickup_datetime', 'pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude', 'trip_duration']
+    if args.command == 'build':
+        print('Reading interim data....')
+        df = read_interim_data(args.interim, columns=cols)
+        print('Building similar trips index....')
+        with span('similar_trips.build', len(df)):
+            index = build_index(df)
+        print(f"Saving {len(index)} trips in {len(index.arrays['bucket_keys_0'])} buckets to {args.index}....")
+        index.save(args.index)
+
+    elif args.command == 'query':
+        if len(args.trip) != 5:
+            parser.error('query takes pickup_lat pickup_lon dropoff_lat dropoff_lon hour')
+        index = load_similar_trips_index(args.index)
+        start = time.perf_counter()
+        trips = index.similar_trips(*args.trip[:4], int(args.trip[4]), args.k)
+        print(f'{args.k} most similar trips ({(time.perf_counter() - start) * 1e3:.1f} ms, first query maps the index):')
+        print(trips.to_string(index=False))
+        print(f"kNN median duration: {trips['trip_duration'].median():.0f} sec")
+
+    else:
+        from joblib import load
+        from src.features import CompiledPreprocessing, TripFeatureBuilder
+        from src.models.predict import make_predictions
+
+        print('Reading interim data....')
+        df = read_interim_data(args.interim, columns=cols)
+        cutoff = df['pickup_datetime'].max() - np.timedelta64(args.holdout_days, 'D')
+        history, holdout = df[df['pickup_datetime'] <= cutoff], df[df['pickup_datetime'] > cutoff]
+        holdout = holdout.sample(min(args.eval_rows, len(holdout)), random_state=0)
+        print(f'Building index on {len(history)} trips up to {cutoff}, scoring {len(holdout)} later trips....')
+        estimator = KNNDurationEstimator(build_index(history), args.k)
+        start = time.perf_counter()
+        with span('similar_trips.knn_predict', len(holdout)):
+            knn_pred = estimator.predict_df(holdout)
+        print(f'kNN queries: {(time.perf_counter() - start) / len(holdout) * 1e3:.3f} ms per trip (batched)')
+
+        y_true = holdout['trip_duration'].to_numpy(dtype=np.float64)
+        print(f'RMSLE kNN (k={args.k}): {_rmsle(y_true, knn_pred):.4f}')
+        if os.path.exists(args.model):
+            preprocessing = CompiledPreprocessing.load(args.preprocessing)
+            X = preprocessing.transform(TripFeatureBuilder(cols=preprocessing.cols).transform(holdout))
+            model_pred = make_predictions(load(args.model), X)
+            # the model may have been trained on the holdout trips, the comparison favours it
+            print(f'RMSLE model: {_rmsle(y_true, model_pred):.4f}')
+            for weight in (0.1, 0.25, 0.5):
+                print(f'RMSLE blend (kNN weight {weight}): {_rmsle(y_true, blend_predictions(model_pred, knn_pred, weight)):.4f}')
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
@@ -31,29 +31,125 @@ def evaluate_regressor_skl(regressor, X_train, y_train, X_val, y_val):
 
     return regressor, y_pred_train, y_pred_val
 
+def train_incremental(args):
+    # update the saved preprocessing pl and model with a new partition of interim trips (see incremental.py)
+    from joblib import load
+    from src.data.read import read_interim_data, read_raw_data
+    from src.data.preprocess import nyc_outlier_filter
+    from src.data.storage import month_filter
+    from src.instrument import span
+    from src.models.incremental import INTERIM_COLS, incremental_update, replay_sample
+
+    print(f'Reading new trips from {args.incremental}....')
+    if args.incremental.endswith('.csv'):
+        new_df = nyc_outlier_filter().fit_transform(read_raw_data(args.incremental))
+    else:
+        filters = month_filter(args.months) if args.months else None
+        new_df = read_interim_data(args.incremental, columns=INTERIM_COLS, filters=filters)
+
+    print(f'Sampling {args.replay_size} replay trips from {args.history}....')
+    replay_df = replay_sample(args.history, args.replay_size) if args.replay_size else None
+
+    print('Loading model and preprocessing pipeline....')
+    model = load(args.model)
+    preprocessing_pl = load(args.preprocessing)
+
+    print('Updating scaler statistics and boosting on new trips....')
+    with span('train.incremental_update', len(new_df)):
+        model, compiled_pl, report = incremental_update(model, preprocessing_pl, new_df, replay_df, args.n_iter)
+    for key, value in report.items():
+        print(f'{key}: {value}')
+
+    if report['rmse_after'] > report['rmse_before'] and not args.force:
+        print('Validation error got worse, model not saved (use --force to save anyway)')
+        return
+
+    print('Saving model and preprocessing pipeline....')
+    dump(model, args.model)
+    dump(preprocessing_pl, args.preprocessing)
+    compiled_pl.save(args.preprocessing_affine)
+    # train.py refuses them until they are rebuilt with the updated pl
+    print('data/processed/train.parquet and the samples are now stale, rerun src/features/features_train.py '
+          'and src/features/sampling.py before training from scratch')
+
 def main():
+    import argparse
     import os
     import sys
     sys.path.append(os.path.abspath(os.getcwd()))
     from src.data.read import read_processed_data
-    
+    from src.instrument import span
+
+    parser = argparse.ArgumentParser(description='Train the model (processed --> model)')
+    parser.add_argument('--incremental', default=None, metavar='NEW',
+        help='interim .parquet (or raw .csv) of new trips: update the saved model instead of training from scratch')
+    parser.add_argument('--months', type=int, nargs='*', default=None, help='incremental: only these months of NEW')
+    parser.add_argument('--history', default='data/interim/train.parquet', help='incremental: trips the replay sample is drawn from')
+    parser.add_argument('--replay-size', type=int, default=200_000)
+    parser.add_argument('--n-iter', type=int, default=50, help='incremental: maximum boosting stages added')
+    parser.add_argument('--model', default='models/best_estimator.joblib')
+    parser.add_argument('--preprocessing', default='models/preprocessing_pl.joblib')
+    parser.add_argument('--preprocessing-affine', default='models/preprocessing_affine.npz')
+    parser.add_argument('--force', action='store_true', help='incremental: save even if the validation error got worse')
+    parser.add_argument('--sample', type=float, default=None, metavar='FRACTION',
+        help='experiment on a stratified sample (src/features/sampling.py) with the time holdout as validation, '
+             'the model is not saved')
+    parser.add_argument('--samples-dir', default='data/samples')
+    parser.add_argument('--drift-profile', default='data/processed/drift_profile.npz',
+        help='profile of the training data from features_train.py')
+    parser.add_argument('--drift-reference', default='models/drift_reference.npz',
+        help='saved as the drift profile with the prediction bins of the validation predictions')
+    args = parser.parse_args()
+
+    if args.incremental:
+        train_incremental(args)
+        print('Done')
+        return
+
+    if args.sample:
+        import json
+        from src.features import check_fingerprint
+        from src.features.sampling import holdout_fpath, load_sample, sample_fpath
+        print(f'Reading sample {args.sample:g} and holdout from {args.samples_dir}....')
+        with open(os.path.join(args.samples_dir, 'manifest.json')) as f:
+            check_fingerprint(json.load(f).get('preprocessing'), args.preprocessing_affine, args.samples_dir)
+        X_train, y_train = load_sample(sample_fpath(args.sample, args.samples_dir))
+        X_val, y_val = load_sample(holdout_fpath(args.samples_dir))
+        print('Training model....')
+        with span('train.evaluate_regressor_skl', len(X_train), sample=args.sample):
+            evaluate_regressor_skl(HistGradientBoostingRegressor(max_leaf_nodes=300), X_train, y_train, X_val, y_val)
+        print('Done')
+        return
+
     print('Reading processed data....')
+    from src.data.storage import read_parquet_metadata
+    from src.features import check_fingerprint
+    from src.features.features import INTERIM_ROW_COL
+    check_fingerprint(read_parquet_metadata('data/processed/train.parquet').get('preprocessing'), args.preprocessing_affine)
     df = read_processed_data()
-    X = df.drop(['log_trip_duration'], axis=1)
+    X = df.drop(['log_trip_duration', INTERIM_ROW_COL], axis=1, errors='ignore')
     y = df['log_trip_duration'] 
     X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.1)
 
     print('Training model....')
-    training_results = evaluate_regressor_skl(
-        HistGradientBoostingRegressor(max_leaf_nodes=300),
-        X_train,
-        y_train,
-        X_val,
-        y_val
-    )
+    with span('train.evaluate_regressor_skl', len(X_train)):
+        training_results = evaluate_regressor_skl(
+            HistGradientBoostingRegressor(max_leaf_nodes=300),
+            X_train,
+            y_train,
+            X_val,
+            y_val
+        )
 
     print('Saving model....')
-    dump(training_results[0], 'models/best_estimator.joblib')
+    dump(training_results[0], args.model)
+
+    if os.path.exists(args.drift_profile):
+        from src.drift import DriftProfile
+        print('Saving drift reference....')
+        reference = DriftProfile.load(args.drift_profile)
+        reference.set_predictions(training_results[2])
+        reference.save(args.drift_reference)
 
     print('Done')
 
@@ -0,0 +1,348 @@
+'''
+Module for running the stage scripts as a DAG (raw --> interim --> processed --> model --> predictions)
+
+Each stage declares its script, input and output files and its parameters. The code it
+depends on is the script and every module of src it imports, directly or through other
+modules (found by parsing the import statements, see code_dependencies). A stage is skipped
+when its outputs exist and the sha256 of its inputs, code and parameters match the last successful run (kept in data/pipeline_state.json). Stages
+whose upstream stages are done run in parallel, e.g. test featurization alongside training.
+
+Can be run as a script to bring the outputs up to date (To be run from main directory only)
+'''
+import ast
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+DEFAULT_STATE_FPATH = 'data/pipeline_state.json'
+
+def _lazy_exports(init_fpath):
+    # name -> submodule map of a package that imports its submodules lazily (_EXPORTS in __init__.py)
+    with open(init_fpath) as f:
+        tree = ast.parse(f.read(), init_fpath)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(t, 'id', None) == '_EXPORTS' for t in node.targets):
+            return ast.literal_eval(node.value)
+    return {}
+
+def _module_files(parts, names, root):
+    # files of `from src.a import names` (names=None for `import src.a`): src/a.py, or the
+    # package __init__.py and the submodules the names come from (all of them if unknown)
+    base = os.path.join(root, *parts)
+    if os.path.isfile(base + '.py'):
+        return [base + '.py']
+    init_fpath = os.path.join(base, '__init__.py')
+    if not os.path.isfile(init_fpath):
+        return []
+    files = [init_fpath]
+    exports = _lazy_exports(init_fpath)
+    for name in names or []:
+        if os.path.isfile(os.path.join(base, name + '.py')):
+            files.append(os.path.join(base, name + '.py'))
+        elif name in exports:
+            files.append(os.path.join(base, exports[name] + '.py'))
+        elif os.path.isdir(os.path.join(base, name)):
+            files.extend(_module_files(parts + [name], None, root))
+        else:
+            return sorted(glob.glob(os.path.join(base, '*.py')))
+    return files
+
+def _imported_files(fpath, root):
+    # files of src imported anywhere in fpath (also inside functions)
+    package = os.path.relpath(os.path.dirname(fpath), root).split(os.sep)
+    with open(fpath) as f:
+        tree = ast.parse(f.read(), fpath)
+    files = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports = [(alias.name.split('.'), None) for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            module = node.module.split('.') if node.module else []
+            if node.level:
+                parts = package[:len(package) - node.level + 1] + module
+            elif module[0] == 'src':
+                parts = module
+            else:
+                # scripts import their sibling modules as top level modules
+                parts = package + module
+            imports = [(parts, [alias.name for alias in node.names])]
+        else:
+            continue
+        for parts, names in imports:
+            if parts[0] == 'src':
+                files.extend(_module_files(parts, names, root))
+    return files
+
+def code_dependencies(script, root='.'):
+    '''
+    Sorted paths (relative to root) of script and of the modules of src it imports, recursively
+    '''
+    todo, seen = [os.path.join(root, script)], set()
+    while todo:
+        fpath = os.path.normpath(todo.pop())
+        if fpath in seen or not os.path.isfile(fpath):
+            continue
+        seen.add(fpath)
+        todo.extend(_imported_files(fpath, root))
+    return sorted(os.path.relpath(f, root) for f in seen)
+
+class Stage:
+    '''
+    One script of the pipeline
+
+    script: str
+        - path of the script (run as python script args from the main directory)
+    inputs, outputs: list
+        - files read and written by the script
+    code: list
+        - glob patterns of code files the script depends on without importing them (the script
+          and the modules it imports are always included)
+    args: list
+        - command line arguments, part of the stage parameters
+    '''
+    def __init__(self, name, script, inputs, outputs, code=(), args=()):
+        self.name = name
+        self.script = script
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.code = list(code)
+        self.args = list(args)
+
+    def code_files(self, root='.'):
+        fpaths = set(code_dependencies(self.script, root))
+        for pattern in self.code:
+            fpaths.update(os.path.relpath(f, root) for f in glob.glob(os.path.join(root, pattern)))
+        return sorted(fpaths)
+
+STAGES = [
+    Stage('preprocess', 'src/data/preprocess.py',
+        inputs=['data/raw/train.csv'],
+        outputs=['data/interim/train.parquet']),
+    Stage('summary_cube', 'src/visualization/cube.py',
+        inputs=['data/interim/train.parquet'],
+        outputs=['data/interim/summary_cube.npz']),
+    Stage('figures', 'src/visualization/exploratory.py',
+        inputs=['data/interim/summary_cube.npz'],
+        outputs=['reports/figures/trips_vs_datetime.jpg', 'reports/figures/duration_vs_datetime.jpg',
+            'reports/figures/outliers.jpg']),
+    Stage('similar_trips', 'src/models/similar_trips.py',
+        inputs=['data/interim/train.parquet'],
+        outputs=['models/similar_trips/params.json'],
+        args=['build']),
+    Stage('features_train', 'src/features/features_train.py',
+        inputs=['data/interim/train.parquet'],
+        outputs=['data/processed/train.parquet', 'data/processed/drift_profile.npz', 'models/preprocessing_pl.joblib',
+            'models/preprocessing_affine.npz']),
+    Stage('samples', 'src/features/sampling.py',
+        inputs=['data/interim/train.parquet', 'data/processed/train.parquet'],
+        outputs=['data/samples/manifest.json', 'data/samples/holdout.npz', 'data/samples/report.json']),
+    Stage('features_predict', 'src/features/features_predict.py',
+        inputs=['data/raw/test.csv', 'models/preprocessing_affine.npz'],
+        outputs=['data/processed/test.parquet']),
+    Stage('train', 'src/models/train.py',
+        inputs=['data/processed/train.parquet', 'data/processed/drift_profile.npz'],
+        outputs=['models/best_estimator.joblib', 'models/drift_reference.npz']),
+    Stage('predict', 'src/models/predict.py',
+        inputs=['data/processed/test.parquet', 'models/best_estimator.joblib'],
+        outputs=['models/predictions.pkl']),
+]
+
+class Pipeline:
+    '''
+    Run stages in dependency order, skipping the ones that are up to date
+
+    stages: list
+        - Stage objects, a stage depends on the stages that output one of its inputs
+    state_fpath: str
+        - JSON file with the fingerprints of the last successful runs and cached file hashes
+    root: str
+        - main directory, paths are relative to it
+    '''
+    def __init__(self, stages=STAGES, state_fpath=DEFAULT_STATE_FPATH, root='.'):
+        self.stages = {stage.name:stage for stage in stages}
+        self.state_fpath = state_fpath
+        self.root = root
+        self._lock = threading.Lock()
+        self.state = {'stages': {}, 'files': {}}
+        if os.path.exists(self._path(state_fpath)):
+            with open(self._path(state_fpath)) as f:
+                self.state = json.load(f)
+
+        producers = {output:stage.name for stage in stages for output in stage.outputs}
+        self.upstream = {stage.name:sorted({producers[f] for f in stage.inputs if f in producers} - {stage.name})
+            for stage in stages}
+
+    def _path(self, fpath):
+        return os.path.join(self.root, fpath)
+
+    def _save_state(self):
+        fpath = self._path(self.state_fpath)
+        os.makedirs(os.path.dirname(fpath) or '.', exist_ok=True)
+        with open(fpath + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(fpath + '.tmp', fpath)
+
+    def file_hash(self, fpath):
+        # sha256 of a file, reused from the state while its size and mtime are unchanged
+        stat = os.stat(self._path(fpath))
+        signature = [stat.st_size, stat.st_mtime_ns]
+        with self._lock:
+            cached = self.state['files'].get(fpath)
+        if cached and cached['signature'] == signature:
+            return cached['sha256']
+        digest = hashlib.sha256()
+        with open(self._path(fpath), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        with self._lock:
+            self.state['files'][fpath] = {'signature': signature, 'sha256': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def fingerprint(self, name):
+        # hash of the stage inputs, code and parameters, None if an input is missing
+        stage = self.stages[name]
+        if not all(os.path.exists(self._path(f)) for f in stage.inputs):
+            return None
+        record = {
+            'inputs': {f:self.file_hash(f) for f in stage.inputs},
+            'code': {f:self.file_hash(f) for f in stage.code_files(self.root)},
+            'args': stage.args,
+        }
+        return hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+    def is_up_to_date(self, name):
+        stage = self.stages[name]
+        if not all(os.path.exists(self._path(f)) for f in stage.outputs):
+            return False
+        with self._lock:
+            last_run = self.state['stages'].get(name)
+        return last_run is not None and last_run['fingerprint'] == self.fingerprint(name)
+
+    def select(self, targets=None):
+        # targets and everything upstream of them (all stages by default)
+        if not targets:
+            return set(self.stages)
+        selected, todo = set(), list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in self.stages:
+                raise ValueError(f'Unknown stage {name}, expected one of {list(self.stages)}')
+            if name not in selected:
+                selected.add(name)
+                todo.extend(self.upstream[name])
+        return selected
+
+    def run_stage(self, name, force=False):
+        '''
+        Run one stage unless it is up to date, returns True if it was run
+        '''
+        stage = self.stages[name]
+        if not force and self.is_up_to_date(name):
+            print(f'[{name}] up to date, skipped')
+            return False
+        fingerprint = self.fingerprint(name)
+        if fingerprint is None:
+            missing = [f for f in stage.inputs if not os.path.exists(self._path(f))]
+            raise FileNotFoundError(f'[{name}] missing inputs {missing}')
+
+        print(f'[{name}] running {stage.script} {" ".join(stage.args)}')
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, stage.script] + stage.args, cwd=self.root,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        # output is printed once the stage is done so that parallel stages don't interleave
+        for line in completed.stdout.splitlines():
+            print(f'[{name}] {line}')
+        if completed.returncode != 0:
+            raise RuntimeError(f'[{name}] failed with exit code {completed.returncode}')
+
+        with self._lock:
+            self.state['stages'][name] = {'fingerprint': fingerprint, 'duration': time.perf_counter() - start}
+            self._save_state()
+        print(f'[{name}] done in {time.perf_counter() - start:.1f} s')
+        return True
+
+    def plan(self, targets=None, force=()):
+        # stages that would run, in dependency order (a stage runs if anything upstream of it runs)
+        selected = self.select(targets)
+        order = self._order(selected)
+        to_run = set()
+        for name in order:
+            if name in force or any(up in to_run for up in self.upstream[name]) or not self.is_up_to_date(name):
+                to_run.add(name)
+        return [name for name in order if name in to_run]
+
+    def _order(self, selected):
+        order, done = [], set()
+        while len(order) < len(selected):
+            ready = [name for name in self.stages if name in selected and name not in done
+                and all(up in done or up not in selected for up in self.upstream[name])]
+            if not ready:
+                raise ValueError('Stages have a dependency cycle')
+            order.extend(ready)
+            done.update(ready)
+        return order
+
+    def run(self, targets=None, force=(), max_workers=None):
+        '''
+        Run the selected stages, each as soon as its upstream stages are done
+
+        targets: list
+            - stage names to bring up to date (with their upstream stages), all by default
+        force: list
+            - stage names to run even if they are up to date
+        returns the names of the stages that were run
+        '''
+        selected = self.select(targets)
+        # raises on a dependency cycle, which would otherwise never get a stage ready
+        self._order(selected)
+        pending, running, done, ran = set(selected), {}, set(), []
+        with ThreadPoolExecutor(max_workers or len(selected)) as executor:
+            while pending or running:
+                for name in [n for n in self.stages if n in pending]:
+                    if all(up in done or up not in selected for up in self.upstream[name]):
+                        pending.remove(name)
+                        running[executor.submit(self.run_stage, name, name in force)] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        if future.result():
+                            ran.append(name)
+                    except Exception:
+                        # let the running stages finish, don't start new ones
+                        pending.clear()
+                        wait(running)
+                        raise
+                    done.add(name)
+        return ran
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the pipeline stages that are out of date')
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date (default all)')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to run even if up to date')
+    parser.add_argument('--jobs', type=int, default=None, help='stages run in parallel')
+    parser.add_argument('--dry-run', action='store_true', help='only print the stages that would run')
+    parser.add_argument('--state', default=DEFAULT_STATE_FPATH)
+    args = parser.parse_args()
+
+    pipeline = Pipeline(state_fpath=args.state)
+    if args.dry_run:
+        print('Stages to run: ' + (', '.join(pipeline.plan(args.targets, args.force)) or 'none'))
+        return
+
+    ran = pipeline.run(args.targets, args.force, args.jobs)
+    print(f'Ran {len(ran)} stage(s): {", ".join(ran) or "none"}')
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
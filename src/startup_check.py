@@ -0,0 +1,94 @@
+'''
+Module for checking the cold start of the app against time budgets (imports, first prediction)
+
+Every measure runs in a fresh interpreter, so nothing is already imported or cached:
+    - import of src.features (must not import sklearn or the training code)
+    - import of the modules the app imports at start (src.data.preprocess, src.models.cache)
+    - first prediction: loading the model and scoring one trip
+
+Can be run as a script (To be run from main directory only), exits with 1 if a budget is exceeded
+    python src/startup_check.py --import-budget 1.5 --prediction-budget 3
+'''
+import json
+import subprocess
+import sys
+
+
+# code run in the fresh interpreter, prints a json dict with the seconds taken and the heavy modules imported
+_MEASURE = '''
+import json, sys, time
+start = time.perf_counter()
+{code}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': sorted(m for m in {heavy!r} if m in sys.modules)}}))
+'''
+
+# modules that must not be imported before a prediction is requested
+HEAVY_MODULES = ('sklearn', 'joblib', 'scipy')
+
+CHECKS = {
+    'import src.features': 'import src.features',
+    'import app modules': 'import src.data.preprocess, src.models.cache',
+    'first prediction': (
+        'from src.models.cache import load_cached_predictor, WARMUP_TRIP\n'
+        'load_cached_predictor({model_fpath!r}, {pl_fpath!r}).predict_trip(**WARMUP_TRIP)'
+    ),
+}
+
+def measure(code, heavy=HEAVY_MODULES, cwd='.'):
+    '''
+    (seconds, heavy modules imported) of running code in a fresh interpreter
+    '''
+    script = _MEASURE.format(code=code, heavy=tuple(heavy))
+    output = subprocess.run([sys.executable, '-c', script], cwd=cwd, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return result['seconds'], result['heavy']
+
+def check_startup(import_budget, prediction_budget, model_fpath='models/best_estimator.joblib',
+        pl_fpath='models/preprocessing_affine.npz', repeat=3, cwd='.'):
+    '''
+    List of (check, best seconds, budget, problem or None) for each of CHECKS,
+    a check that fails to run has NaN seconds and its error as problem
+    '''
+    results = []
+    for name, code in CHECKS.items():
+        code = code.format(model_fpath=model_fpath, pl_fpath=pl_fpath)
+        budget = prediction_budget if name == 'first prediction' else import_budget
+        try:
+            runs = [measure(code, cwd=cwd) for _ in range(repeat)]
+        except subprocess.CalledProcessError as e:
+            # the check itself failed (missing model, import error), reported with the child's error
+            stderr = e.stderr.strip().splitlines()
+            results.append((name, float('nan'), budget, f'failed: {stderr[-1] if stderr else e}'))
+            continue
+        seconds = min(seconds for seconds, _ in runs)
+        problem = None
+        if name != 'first prediction' and runs[0][1]:
+            problem = f'imports {", ".join(runs[0][1])}'
+        elif seconds > budget:
+            problem = f'over budget by {seconds - budget:.3f} s'
+        results.append((name, seconds, budget, problem))
+    return results
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Check import time and first prediction latency against budgets')
+    parser.add_argument('--import-budget', type=float, default=1.5, help='seconds, per import check')
+    parser.add_argument('--prediction-budget', type=float, default=3.0, help='seconds, model load and first trip')
+    parser.add_argument('--model', default='models/best_estimator.joblib')
+    parser.add_argument('--preprocessing', default='models/preprocessing_affine.npz')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('Measuring cold start....')
+    results = check_startup(args.import_budget, args.prediction_budget, args.model, args.preprocessing, args.repeat)
+    for name, seconds, budget, problem in results:
+        print(f"{name:<20} {seconds:>7.3f} s (budget {budget:.3f} s) {'FAIL: ' + problem if problem else 'ok'}")
+
+    print('Done')
+    if any(problem for *_, problem in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+'''
+Module for a pre-aggregated summary cube of the trips (interim --> summary cube)
+
+SummaryCube keeps, per (month, day, day_of_week, hour, vendor_id) group, the trip count, the
+sum and sum of squares of trip_duration and a histogram of log(trip_duration) (quantiles).
+It also keeps exact count/sum/sum of squares/min/max of every numeric column and a uniform
+row sample (bottom-k of random priorities) for the distribution plots. All of them are sums
+or mergeable, so the cube is built in one pass over chunks and new data (e.g. a new month)
+is added with update() without going over the old data again. Adding the same rows twice
+counts them twice.
+
+The figures of exploratory.py are rendered from the cube.
+
+Can be run as a script to build or update data/interim/summary_cube.npz from interim data
+(To be run from main directory only)
+'''
+import numpy as np
+import pandas as pd
+
+
+KEY_COLS = ['month', 'day', 'day_of_week', 'hour', 'vendor_id']
+# sizes of the key fields in the packed int64 group code (vendor_id < 256)
+KEY_SIZES = [13, 32, 7, 24, 256]
+# log(trip_duration) histogram bins: 0 (1 sec) to 12 (~45 hours)
+LOG_DURATION_EDGES = np.linspace(0, 12, 121)
+DEFAULT_SAMPLE_SIZE = 100_000
+STAT_COLS = ['count', 'sum', 'sumsq', 'min', 'max']
+
+def _encode(keys):
+    # pack the key columns (list of int arrays) into one int64 code
+    code = np.zeros(len(keys[0]), dtype=np.int64)
+    for values, size in zip(keys, KEY_SIZES):
+        code = code * size + np.asarray(values, dtype=np.int64)
+    return code
+
+def _decode(code):
+    keys = []
+    for size in reversed(KEY_SIZES):
+        code, values = np.divmod(code, size)
+        keys.append(values)
+    return dict(zip(KEY_COLS, reversed(keys)))
+
+def _histogram_quantile(counts, edges, q):
+    # q quantile of each row of a histogram (linear interpolation inside the bin)
+    cum = np.cumsum(counts, axis=1)
+    target = cum[:, -1] * q
+    idx = np.argmax(cum >= target[:, None], axis=1)
+    rows = np.arange(len(counts))
+    before = np.where(idx > 0, cum[rows, np.maximum(idx - 1, 0)], 0)
+    in_bin = np.maximum(counts[rows, idx], 1)
+    width = edges[1:] - edges[:-1]
+    return edges[idx] + (target - before) / in_bin * width[idx]
+
+class SummaryCube:
+    '''
+    Trip counts, trip_duration moments and histograms by (month, day, day_of_week, hour, vendor_id)
+
+    sample_size: int
+        - rows kept in the uniform sample used for quantiles of the numeric columns
+    edges: np.ndarray
+        - log(trip_duration) histogram bin edges
+    '''
+    def __init__(self, sample_size=DEFAULT_SAMPLE_SIZE, edges=LOG_DURATION_EDGES, seed=None):
+        self.sample_size = sample_size
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.rng = np.random.default_rng(seed)
+        self.codes = np.empty(0, dtype=np.int64)
+        self.count = np.empty(0, dtype=np.int64)
+        self.sum = np.empty(0, dtype=np.float64)
+        self.sumsq = np.empty(0, dtype=np.float64)
+        self.hist = np.empty((0, len(self.edges) - 1), dtype=np.uint32)
+        # exact stats (STAT_COLS) of every numeric column, one row per column
+        self.col_stats = pd.DataFrame(columns=STAT_COLS, dtype=np.float64)
+        # sampled rows with their random priority, the sample_size smallest priorities are kept
+        self.sample = pd.DataFrame()
+        self.priority = np.empty(0)
+
+    @property
+    def n_rows(self):
+        return int(self.count.sum())
+
+    def _merge_groups(self, codes, count, sum_, sumsq, hist):
+        codes = np.concatenate([self.codes, codes])
+        self.codes, inverse = np.unique(codes, return_inverse=True)
+        n_groups = len(self.codes)
+        self.count = np.bincount(inverse, np.concatenate([self.count, count]), n_groups).astype(np.int64)
+        self.sum = np.bincount(inverse, np.concatenate([self.sum, sum_]), n_groups)
+        self.sumsq = np.bincount(inverse, np.concatenate([self.sumsq, sumsq]), n_groups)
+        merged = np.zeros((n_groups, self.hist.shape[1]), dtype=np.uint32)
+        np.add.at(merged, inverse, np.concatenate([self.hist, hist]))
+        self.hist = merged
+
+    def _merge_col_stats(self, col_stats):
+        if not len(self.col_stats):
+            self.col_stats = col_stats
+            return
+        old, new = self.col_stats.align(col_stats, join='outer', axis=0)
+        merged = old[['count', 'sum', 'sumsq']].fillna(0) + new[['count', 'sum', 'sumsq']].fillna(0)
+        merged['min'] = np.fmin(old['min'], new['min'])
+        merged['max'] = np.fmax(old['max'], new['max'])
+        self.col_stats = merged[STAT_COLS]
+
+    def _merge_sample(self, sample, priority):
+        sample = pd.concat([self.sample, sample], ignore_index=True)
+        priority = np.concatenate([self.priority, priority])
+        keep = np.sort(np.argsort(priority, kind='stable')[:self.sample_size])
+        self.sample = sample.iloc[keep].reset_index(drop=True)
+        self.priority = priority[keep]
+
+    def update(self, df):
+        '''
+        Add the trips of df (pickup_datetime, vendor_id, trip_duration and any numeric columns)
+        '''
+        pickup = df['pickup_datetime'].dt
+        codes = _encode([pickup.month, pickup.day, pickup.day_of_week, pickup.hour, df['vendor_id']])
+        duration = df['trip_duration'].to_numpy(dtype=np.float64)
+        group_codes, inverse = np.unique(codes, return_inverse=True)
+        n_groups, n_bins = len(group_codes), len(self.edges) - 1
+
+        bins = np.searchsorted(self.edges, np.log(np.maximum(duration, 1)), side='right') - 1
+        np.clip(bins, 0, n_bins - 1, out=bins)
+        hist = np.bincount(inverse * n_bins + bins, minlength=n_groups * n_bins).reshape(n_groups, n_bins)
+        self._merge_groups(
+            group_codes,
+            np.bincount(inverse, minlength=n_groups),
+            np.bincount(inverse, duration, n_groups),
+            np.bincount(inverse, duration * duration, n_groups),
+            hist.astype(np.uint32),
+        )
+
+        numeric = df.select_dtypes('number').astype(np.float64)
+        values = numeric.to_numpy()
+        self._merge_col_stats(pd.DataFrame({
+            'count': np.sum(~np.isnan(values), axis=0),
+            'sum': np.nansum(values, axis=0),
+            'sumsq': np.nansum(values * values, axis=0),
+            'min': np.nanmin(values, axis=0),
+            'max': np.nanmax(values, axis=0),
+        }, index=numeric.columns))
+        self._merge_sample(numeric, self.rng.random(len(numeric)))
+        return self
+
+    def merge(self, other):
+        '''
+        Add the groups, stats and sample of another cube (same edges)
+        '''
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Cubes with different histogram edges can not be merged')
+        self._merge_groups(other.codes, other.count, other.sum, other.sumsq, other.hist)
+        self._merge_col_stats(other.col_stats)
+        self._merge_sample(other.sample, other.priority)
+        return self
+
+    def groups(self):
+        '''
+        DataFrame with the key columns, count, sum and sumsq of every group
+        '''
+        df = pd.DataFrame(_decode(self.codes))
+        df['count'], df['sum'], df['sumsq'] = self.count, self.sum, self.sumsq
+        return df
+
+    def aggregate(self, by, quantiles=()):
+        '''
+        Trip count, mean trip_duration and its 95% confidence interval half width (normal
+        approximation) by the key columns in by, plus approximate trip_duration quantiles
+        '''
+        by = [by] if isinstance(by, str) else list(by)
+        keys = pd.DataFrame(_decode(self.codes))[by]
+        group_idx = keys.groupby(by, sort=True).ngroup().to_numpy()
+        n_groups = group_idx.max() + 1 if len(group_idx) else 0
+        df = keys.drop_duplicates().sort_values(by).reset_index(drop=True)
+        count = np.bincount(group_idx, self.count, n_groups)
+        mean = np.bincount(group_idx, self.sum, n_groups) / count
+        var = np.maximum(np.bincount(group_idx, self.sumsq, n_groups) / count - mean * mean, 0)
+        df['count'] = count.astype(np.int64)
+        df['mean_duration'] = mean
+        df['ci95_duration'] = 1.96 * np.sqrt(var / count)
+        if len(quantiles):
+            hist = np.zeros((n_groups, self.hist.shape[1]))
+            np.add.at(hist, group_idx, self.hist)
+            for q in quantiles:
+                df[f'q{q:g}_duration'] = np.exp(_histogram_quantile(hist, self.edges, q))
+        return df
+
+    def describe(self, cols=None):
+        '''
+        Like DataFrame.describe: exact count, mean, std, min and max, quartiles from the sample
+        '''
+        cols = list(cols) if cols else list(self.col_stats.index)
+        stats = self.col_stats.loc[cols]
+        mean = stats['sum'] / stats['count']
+        std = np.sqrt(np.maximum(stats['sumsq'] / stats['count'] - mean * mean, 0) * stats['count'] / (stats['count'] - 1))
+        quartiles = self.sample[cols].quantile([0.25, 0.5, 0.75])
+        quartiles.index = ['25%', '50%', '75%']
+        described = pd.concat([stats[['count']].T, mean.to_frame('mean').T, std.to_frame('std').T,
+            stats[['min']].T, quartiles, stats[['max']].T])
+        return described[cols]
+
+    def box_stats(self, col, whis=1.5, max_fliers=1_000):
+        '''
+        Boxplot stats of col (for Axes.bxp), quartiles and whiskers from the sample,
+        the exact min and max are always drawn as fliers when outside of the whiskers
+        '''
+        values = self.sample[col].dropna().to_numpy()
+        q1, med, q3 = np.quantile(values, [0.25, 0.5, 0.75])
+        low, high = q1 - whis * (q3 - q1), q3 + whis * (q3 - q1)
+        inside = values[(values >= low) & (values <= high)]
+        whislo, whishi = inside.min(), inside.max()
+        fliers = values[(values < whislo) | (values > whishi)]
+        if len(fliers) > max_fliers:
+            fliers = self.rng.choice(fliers, max_fliers, replace=False)
+        extremes = [v for v in self.col_stats.loc[col, ['min', 'max']] if v < whislo or v > whishi]
+        return {'label': col, 'med': med, 'q1': q1, 'q3': q3, 'whislo': whislo, 'whishi': whishi,
+            'fliers': np.concatenate([fliers, extremes])}
+
+    def save(self, fpath):
+        sample_cols = list(self.sample.columns)
+        np.savez_compressed(fpath, sample_size=self.sample_size, edges=self.edges, codes=self.codes,
+            count=self.count, sum=self.sum, sumsq=self.sumsq, hist=self.hist,
+            stat_cols=np.array(self.col_stats.index, dtype=str), col_stats=self.col_stats.to_numpy(),
+            sample_cols=np.array(sample_cols, dtype=str), sample=self.sample.to_numpy(dtype=np.float64),
+            priority=self.priority)
+
+    @classmethod
+    def load(cls, fpath, seed=None):
+        with np.load(fpath) as arrays:
+            cube = cls(int(arrays['sample_size']), arrays['edges'], seed)
+            cube.codes, cube.count, cube.sum = arrays['codes'], arrays['count'], arrays['sum']
+            cube.sumsq, cube.hist = arrays['sumsq'], arrays['hist']
+            cube.col_stats = pd.DataFrame(arrays['col_stats'], index=arrays['stat_cols'].tolist(), columns=STAT_COLS)
+            cube.sample = pd.DataFrame(arrays['sample'], columns=arrays['sample_cols'].tolist())
+            cube.priority = arrays['priority']
+        return cube
+
+def as_cube(data):
+    # data if it is already a cube, else a cube of the DataFrame
+    return data if isinstance(data, SummaryCube) else SummaryCube().update(data)
+
+def main():
+    import argparse
+    import os
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from src.data.storage import read_parquet_chunks
+    from src.instrument import span
+
+    parser = argparse.ArgumentParser(description='Build the summary cube of the interim data')
+    parser.add_argument('--interim', default='data/interim/train.parquet')
+    parser.add_argument('--output', default='data/interim/summary_cube.npz')
+    parser.add_argument('--update', action='store_true',
+        help='add --interim (e.g. a new month) to the existing cube instead of rebuilding it')
+    parser.add_argument('--chunksize', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    if args.update and os.path.exists(args.output):
+        print(f'Loading {args.output}....')
+        cube = SummaryCube.load(args.output)
+    else:
+        cube = SummaryCube()
+
+    print('Aggregating interim data....')
+    n_rows = cube.n_rows
+    with span('cube.update', input=args.interim) as record:
+        for chunk in read_parquet_chunks(args.interim, args.chunksize):
+            cube.update(chunk)
+        record['rows'] = cube.n_rows - n_rows
+
+    print(f'Saving {len(cube.codes)} groups ({cube.n_rows} trips) to {args.output}....')
+    cube.save(args.output)
+
+    print('Done')
+
+if __name__ == '__main__':
+    main()
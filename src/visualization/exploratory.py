@@ -1,6 +1,10 @@
 '''
 Module for visualizing data
 
+The trip count and duration figures are rendered from a SummaryCube (cube.py), a DataFrame
+passed instead is aggregated into one first. The outlier figure is drawn from a SummaryCube
+(boxes from its sample) or from all the rows of any DataFrame.
+
 Can be run as a script to generate visualizations (To be run from main directory only)
 '''
 import matplotlib.pyplot as plt
@@ -16,10 +20,20 @@ def corr_heatmap(df, cols:list=None):
     mask = np.triu(np.ones_like(corr_matrix))
     return sns.heatmap(corr_matrix, annot=True, mask=mask)
 
-def outlier_viz(df, cols:list=None):
+def _as_cube(data):
+    # imported here (not at module level) so that the script and the package share one cube module
+    from src.visualization.cube import as_cube
+    return as_cube(data)
+
+def outlier_viz(data, cols:list=None):
+    # data: DataFrame (boxplots of all the rows) or SummaryCube (boxes from the cube sample, min/max are exact)
+    from src.visualization.cube import SummaryCube
+    if not isinstance(data, SummaryCube):
+        return _outlier_viz_df(data, cols)
+    cube = data
     if not cols:
-        cols = list(df.select_dtypes('number').columns)
-    print(df[cols].describe())
+        cols = list(cube.col_stats.index)
+    print(cube.describe(cols))
 
     # create a square of subplots
     if np.sqrt(len(cols)) % 1 == 0:
@@ -30,87 +44,115 @@ def outlier_viz(df, cols:list=None):
     
     # plot boxplot for each num feat
     fig, ax = plt.subplots(square_size, square_size, figsize=(square_size*5,square_size*5))
-    if square_size == 1:
-        sns.boxplot(data=df, x=cols[0], ax=ax)
-        plt.suptitle('Outliers visualization')
-        # plt.show()
-    else:
-        ax = ax.flatten()
-        # current_plot = 0
-        for i in range(len(cols)):
-            sns.boxplot(data=df, x=cols[i], ax=ax[i])
-        plt.suptitle('Outliers visualization')
-        # plt.show()
+    ax = np.atleast_1d(ax).flatten()
+    for i in range(len(cols)):
+        ax[i].bxp([cube.box_stats(cols[i])], vert=False, showfliers=True, patch_artist=True,
+            boxprops={'facecolor':sns.color_palette()[0]}, flierprops={'marker':'d', 'markersize':3})
+        ax[i].set_xlabel(cols[i])
+        ax[i].set_yticks([])
+    plt.suptitle('Outliers visualization')
     return fig
 
-def plot_trips_vs_datetime(df):
-    # of NYC taxi trips by selected datetime features (Jan-Jun 2016)
-    fig = plt.figure(figsize=(16,10))
-    plt.suptitle('# of NYC taxi trips by selected datetime features (Jan-Jun 2016)', size=15)
+def _outlier_viz_df(df, cols:list=None):
+    # boxplot of each numeric column of df
+    if not cols:
+        cols = list(df.select_dtypes('number').columns)
+    print(df[cols].describe())
 
-    plt.subplot(221)
-    sns.countplot(data=df, x= df['pickup_datetime'].dt.month, hue='vendor_id')
-    plt.xlabel('Month')
-    plt.ylabel('Trips count')
+    # create a square of subplots
+    if np.sqrt(len(cols)) % 1 == 0:
+        square_size = int(np.sqrt(len(cols)))
+    else:
+        square_size = int(np.sqrt(len(cols)) + 1)
+    assert square_size**2 >= len(cols), 'outlier_viz: wrong square size logic'
 
-    plt.subplot(222)
-    sns.countplot(data=df, x= df['pickup_datetime'].dt.day_of_week, hue='vendor_id')
-    plt.xlabel('Day of week')
-    plt.ylabel('Trips count')
+    fig, ax = plt.subplots(square_size, square_size, figsize=(square_size*5,square_size*5))
+    ax = np.atleast_1d(ax).flatten()
+    for i in range(len(cols)):
+        sns.boxplot(data=df, x=cols[i], ax=ax[i])
+    plt.suptitle('Outliers visualization')
+    return fig
 
-    plt.subplot(223)
-    sns.countplot(data=df, x= df['pickup_datetime'].dt.day, hue='vendor_id')
-    plt.xlabel('Day of month')
-    plt.ylabel('Trips count')
+def _grouped_bars(ax, df, x, y, err=None, hue='vendor_id'):
+    # bars of y by x side by side for each hue value (like sns.barplot on aggregated data)
+    x_values = np.sort(df[x].unique())
+    hue_values = np.sort(df[hue].unique())
+    width = 0.8 / len(hue_values)
+    for i, (hue_value, color) in enumerate(zip(hue_values, sns.color_palette())):
+        hue_df = df[df[hue] == hue_value].set_index(x).reindex(x_values)
+        positions = np.arange(len(x_values)) - 0.4 + (i + 0.5) * width
+        ax.bar(positions, hue_df[y], width, color=color, label=hue_value,
+            yerr=hue_df[err] if err else None, ecolor='0.26')
+    ax.set_xticks(np.arange(len(x_values)))
+    ax.set_xticklabels(x_values)
+    ax.legend(title=hue)
+
+# x column and label of each subplot of the datetime figures
+DATETIME_PLOTS = [('month', 'Month'), ('day_of_week', 'Day of week'), ('day', 'Day of month'), ('hour', 'Hour of day')]
+
+def plot_trips_vs_datetime(data):
+    # of NYC taxi trips by selected datetime features (Jan-Jun 2016), data: DataFrame or SummaryCube
+    cube = _as_cube(data)
+    fig = plt.figure(figsize=(16,10))
+    plt.suptitle('# of NYC taxi trips by selected datetime features (Jan-Jun 2016)', size=15)
 
-    plt.subplot(224)
-    sns.countplot(data=df, x= df['pickup_datetime'].dt.hour, hue='vendor_id')
-    plt.xlabel('Hour of day')
-    plt.ylabel('Trips count')
+    for i, (x, label) in enumerate(DATETIME_PLOTS):
+        ax = plt.subplot(221 + i)
+        _grouped_bars(ax, cube.aggregate([x, 'vendor_id']), x, 'count')
+        plt.xlabel(label)
+        plt.ylabel('Trips count')
 
     return fig
 
-def plot_duration_vs_datetime(df):
-    # NYC taxi average trip duration by selected datetime features (Jan-Jun 2016)
+def plot_duration_vs_datetime(data):
+    # NYC taxi average trip duration by selected datetime features (Jan-Jun 2016), data: DataFrame or SummaryCube
+    # error bars are 95% confidence intervals of the mean (normal approximation instead of bootstrap)
+    cube = _as_cube(data)
     fig = plt.figure(figsize=(16,10))
     plt.suptitle('NYC taxi average trip duration by selected datetime features (Jan-Jun 2016)', size=15)
 
-    plt.subplot(221)
-    sns.barplot(data=df, x= df['pickup_datetime'].dt.month, y='trip_duration', hue='vendor_id')
-    plt.xlabel('Month')
-    plt.ylabel('Average duration (sec)')
-
-    plt.subplot(222)
-    sns.barplot(data=df, x= df['pickup_datetime'].dt.day_of_week, y='trip_duration', hue='vendor_id')
-    plt.xlabel('Day of week')
-    plt.ylabel('Average duration (sec)')
-
-    plt.subplot(223)
-    sns.barplot(data=df, x= df['pickup_datetime'].dt.day, y='trip_duration', hue='vendor_id')
-    plt.xlabel('Day of month')
-    plt.ylabel('Average duration (sec)')
-
-    plt.subplot(224)
-    sns.barplot(data=df, x= df['pickup_datetime'].dt.hour, y='trip_duration', hue='vendor_id')
-    plt.xlabel('Hour of day')
-    plt.ylabel('Average duration (sec)')
+    for i, (x, label) in enumerate(DATETIME_PLOTS):
+        ax = plt.subplot(221 + i)
+        _grouped_bars(ax, cube.aggregate([x, 'vendor_id']), x, 'mean_duration', err='ci95_duration')
+        plt.xlabel(label)
+        plt.ylabel('Average duration (sec)')
 
     return fig
 
 def main():
+    import argparse
     import os
     import sys
     sys.path.append(os.path.abspath(os.getcwd()))
-    from src.data.read import read_interim_data
-
-    print('Reading interim data....')
-    df = read_interim_data()
+    from src.data.storage import read_parquet_chunks
+    from src.instrument import span
+    from src.visualization.cube import SummaryCube
+
+    parser = argparse.ArgumentParser(description='Render the exploratory figures from the summary cube')
+    parser.add_argument('--cube', default='data/interim/summary_cube.npz')
+    parser.add_argument('--interim', default='data/interim/train.parquet', help='aggregated if --cube does not exist')
+    args = parser.parse_args()
+
+    if os.path.exists(args.cube):
+        print(f'Loading summary cube {args.cube}....')
+        cube = SummaryCube.load(args.cube)
+    else:
+        print('Aggregating interim data....')
+        cube = SummaryCube()
+        for chunk in read_parquet_chunks(args.interim, columns=['pickup_datetime', 'vendor_id', 'trip_duration']):
+            cube.update(chunk)
 
     print('Creating trips vs datetime viz....')
-    plot_trips_vs_datetime(df).savefig('reports/figures/trips_vs_datetime.jpg')
+    with span('exploratory.trips_vs_datetime'):
+        plot_trips_vs_datetime(cube).savefig('reports/figures/trips_vs_datetime.jpg')
 
     print('Creating duration vs datetime viz....')
-    plot_duration_vs_datetime(df).savefig('reports/figures/duration_vs_datetime.jpg')
+    with span('exploratory.duration_vs_datetime'):
+        plot_duration_vs_datetime(cube).savefig('reports/figures/duration_vs_datetime.jpg')
+
+    print('Creating outliers viz....')
+    with span('exploratory.outliers'):
+        outlier_viz(cube).savefig('reports/figures/outliers.jpg')
 
     print('DONE')
 
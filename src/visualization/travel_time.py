@@ -0,0 +1,121 @@
+'''
+Module for travel time heatmaps (model --> figure)
+
+The durations from one pickup to the center of every cell of a grid of dropoffs
+(CachedTripPredictor.predict_dropoff_grid, scored in one batch and cached per pickup cell)
+are drawn as a heatmap with isochrone contours.
+
+Can be run as a script to measure the end-to-end render time (scoring, drawing and png
+encoding) against a budget (To be run from main directory only), exits with 1 if exceeded
+    python src/visualization/travel_time.py --budget 2 --output reports/figures/travel_time.png
+'''
+import io
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+# dropoff grid cells per degree of latitude/longitude (100 is ~1.1 km x 0.85 km in NYC)
+DEFAULT_CELLS_PER_DEGREE = 100
+ISOCHRONE_MINUTES = (10, 20, 30, 45, 60, 90)
+DEFAULT_RENDER_BUDGET = 2.0
+
+def dropoff_grid(min_lat, max_lat, min_lon, max_lon, cells_per_degree=DEFAULT_CELLS_PER_DEGREE):
+    # SpatialGrid of the dropoffs over a bounding box (e.g. NYC_MIN_LAT..NYC_MAX_LON in preprocess.py)
+    from src.features.spatial import SpatialGrid
+    return SpatialGrid.from_cells_per_degree(min_lat, max_lat, min_lon, max_lon, cells_per_degree)
+
+def plot_travel_time_heatmap(grid, seconds, pickup=None, levels=ISOCHRONE_MINUTES):
+    '''
+    Heatmap of the durations (minutes) with isochrones at levels minutes
+
+    grid: SpatialGrid
+        - grid of the dropoffs
+    seconds: np.ndarray
+        - (grid.n_lat, grid.n_lon) durations in seconds
+    pickup: tuple
+        - (lat, lon) marked on the map
+    '''
+    minutes = np.asarray(seconds) / 60
+    fig, ax = plt.subplots(figsize=(7, 9))
+    extent = [grid.min_lon, grid.max_lon, grid.min_lat, grid.max_lat]
+    # a degree of longitude is shorter than a degree of latitude by cos(latitude)
+    aspect = 1 / np.cos(np.radians((grid.min_lat + grid.max_lat) / 2))
+    image = ax.imshow(minutes, origin='lower', extent=extent, aspect=aspect, cmap='viridis_r',
+        vmax=np.quantile(minutes, 0.99))
+    lat, lon = grid.cell_centers(np.arange(grid.n_cells))
+    levels = [level for level in levels if minutes.min() < level < minutes.max()]
+    if levels:
+        contours = ax.contour(lon.reshape(minutes.shape), lat.reshape(minutes.shape), minutes, levels=levels,
+            colors='white', linewidths=0.8)
+        ax.clabel(contours, fmt='%d min', fontsize=7)
+    if pickup is not None:
+        ax.plot(pickup[1], pickup[0], marker='*', markersize=14, color='red', markeredgecolor='white')
+    fig.colorbar(image, ax=ax, shrink=0.6, label='Predicted trip duration (minutes)')
+    ax.set_xlabel('longitude')
+    ax.set_ylabel('latitude')
+    ax.set_title('Travel time from pickup')
+    fig.tight_layout()
+    return fig
+
+def render_travel_time_heatmap(cached_predictor, grid, pickup_lat, pickup_lon, day, day_of_week, hour, dpi=100):
+    '''
+    (png bytes, timings) of the heatmap from a pickup, timings has the seconds spent scoring
+    (0 when the grid is cached), drawing and encoding the png, and their total
+    '''
+    start = time.perf_counter()
+    seconds = cached_predictor.predict_dropoff_grid(pickup_lat, pickup_lon, day, day_of_week, hour, grid)
+    scored = time.perf_counter()
+    fig = plot_travel_time_heatmap(grid, seconds, pickup=(pickup_lat, pickup_lon))
+    drawn = time.perf_counter()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=dpi)
+    plt.close(fig)
+    encoded = time.perf_counter()
+    timings = {'score_s': scored - start, 'draw_s': drawn - scored, 'encode_s': encoded - drawn, 'total_s': encoded - start}
+    return buffer.getvalue(), timings
+
+def main():
+    import argparse
+    import os
+    import sys
+    sys.path.append(os.path.abspath(os.getcwd()))
+    from src.data.preprocess import NYC_MIN_LAT, NYC_MAX_LAT, NYC_MIN_LON, NYC_MAX_LON
+    from src.models.cache import load_cached_predictor, WARMUP_TRIP
+
+    parser = argparse.ArgumentParser(description='Measure the render time of a travel time heatmap against a budget')
+    parser.add_argument('--budget', type=float, default=DEFAULT_RENDER_BUDGET, help='seconds, uncached heatmap')
+    parser.add_argument('--cells-per-degree', type=int, default=DEFAULT_CELLS_PER_DEGREE)
+    parser.add_argument('--hours', type=int, nargs='*', default=[8, 12, 18], help='one uncached heatmap per hour')
+    parser.add_argument('--model', default='models/best_estimator.joblib')
+    parser.add_argument('--preprocessing', default='models/preprocessing_affine.npz')
+    parser.add_argument('--output', default=None, help='save the last heatmap as png')
+    args = parser.parse_args()
+
+    print('Loading model....')
+    cached_predictor = load_cached_predictor(args.model, args.preprocessing)
+    grid = dropoff_grid(NYC_MIN_LAT, NYC_MAX_LAT, NYC_MIN_LON, NYC_MAX_LON, args.cells_per_degree)
+    print(f'Rendering heatmaps of {grid.n_lat} x {grid.n_lon} dropoffs....')
+    pickup = (WARMUP_TRIP['pickup_lat'], WARMUP_TRIP['pickup_lon'], 1, 0)
+    over_budget = False
+    for hour in args.hours:
+        for cache in ('miss', 'hit'):
+            png, timings = render_travel_time_heatmap(cached_predictor, grid, *pickup, hour)
+            over = cache == 'miss' and timings['total_s'] > args.budget
+            over_budget |= over
+            print(f"hour {hour:>2} cache {cache:<4} score {timings['score_s']:.3f} s draw {timings['draw_s']:.3f} s "
+                  f"encode {timings['encode_s']:.3f} s total {timings['total_s']:.3f} s "
+                  f"(budget {args.budget:.3f} s) {'FAIL' if over else 'ok'}")
+
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(png)
+        print(f'Saved {args.output}')
+
+    print('Done')
+    if over_budget:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
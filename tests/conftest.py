@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the project as the scripts do, from the main directory
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
@@ -0,0 +1,81 @@
+'''
+CompiledPreprocessing against the sklearn preprocessing pl it was compiled from
+'''
+import numpy as np
+import pytest
+
+from src.benchmarks.synthetic import generate_trips
+from src.features import (
+    CompiledPreprocessing,
+    TripFeatureBuilder,
+    check_equivalence,
+    compile_preprocessing_pl,
+    create_preprocessing_pl,
+    features_cols,
+)
+
+
+@pytest.fixture(scope='module')
+def features_df():
+    return TripFeatureBuilder().transform_df(generate_trips(5_000, seed=0))
+
+@pytest.fixture(scope='module')
+def fitted(features_df):
+    preprocessing_pl = create_preprocessing_pl(features_df, features_cols())
+    return preprocessing_pl, compile_preprocessing_pl(preprocessing_pl)
+
+def with_nans(df, frac=0.1, seed=1):
+    # a copy of df with about frac of the values of every column set to NaN
+    df = df.astype(np.float64)
+    rng = np.random.default_rng(seed)
+    for col in df.columns:
+        df.loc[rng.random(len(df)) < frac, col] = np.nan
+    return df
+
+def test_equivalence(fitted, features_df):
+    check_equivalence(*fitted, features_df)
+
+def test_equivalence_nan(fitted, features_df):
+    df = with_nans(features_df)
+    check_equivalence(*fitted, df)
+    # NaNs are filled with the median of the training data
+    out = fitted[1].transform(df)
+    assert not np.isnan(out).any()
+
+@pytest.mark.parametrize('n_rows', [1, 2, 4, 16])
+def test_equivalence_small_batches(fitted, features_df, n_rows):
+    df = with_nans(features_df.iloc[:64], frac=0.2)
+    for start in range(0, len(df), n_rows):
+        check_equivalence(*fitted, df.iloc[start:start + n_rows])
+
+def test_transform_in_place(fitted, features_df):
+    compiled = fitted[1]
+    X = with_nans(features_df.iloc[:100])[compiled.cols].to_numpy()
+    expected = compiled.transform(X)
+    out = compiled.transform(X, out=X)
+    assert out is X
+    np.testing.assert_array_equal(out, expected)
+
+def test_save_load(fitted, features_df, tmp_path):
+    compiled = fitted[1]
+    fpath = tmp_path / 'preprocessing_affine.npz'
+    compiled.save(fpath)
+    loaded = CompiledPreprocessing.load(fpath)
+    assert loaded.cols == compiled.cols
+    assert loaded.fingerprint() == compiled.fingerprint()
+    np.testing.assert_array_equal(loaded.transform(features_df), compiled.transform(features_df))
+
+def test_check_equivalence_detects_difference(fitted, features_df):
+    preprocessing_pl, compiled = fitted
+    shifted = CompiledPreprocessing(compiled.cols, compiled.fill, compiled.scale, compiled.offset + 1e-3)
+    with pytest.raises(AssertionError):
+        check_equivalence(preprocessing_pl, shifted, features_df)
+
+def test_missing_pickup_datetime():
+    # NaT gives NaN datetime parts, as .dt.day/.dt.hour, not int64 min
+    trips = generate_trips(16, seed=0)
+    trips.loc[trips.index[3], 'pickup_datetime'] = None
+    out = TripFeatureBuilder().transform_df(trips)
+    for col in ['pickup_datetime_date', 'pickup_datetime_day_of_week', 'pickup_datetime_hour']:
+        assert np.isnan(out[col].iloc[3])
+        assert not np.isnan(out[col].drop(out.index[3])).any()
@@ -0,0 +1,65 @@
+'''
+FlatTreeEnsemble predictions against the HistGradientBoostingRegressor it was flattened from
+'''
+import numpy as np
+import pytest
+from sklearn.ensemble import HistGradientBoostingRegressor
+
+from src.benchmarks.synthetic import generate_trips
+from src.features import TripFeatureBuilder
+from src.models.flat_trees import PYTHON_MAX_ROWS, FlatTreeEnsemble, check_exactness
+
+
+@pytest.fixture(scope='module')
+def data():
+    trips = generate_trips(5_000, seed=0)
+    X = TripFeatureBuilder().transform(trips).astype(np.float64)
+    y = np.log(trips['trip_duration'].to_numpy(dtype=np.float64))
+    # NaNs in the training data give splits that send missing values left or right
+    X[np.random.default_rng(1).random(X.shape) < 0.05] = np.nan
+    return X, y
+
+@pytest.fixture(scope='module')
+def fitted(data):
+    model = HistGradientBoostingRegressor(max_iter=30, max_leaf_nodes=31, random_state=0).fit(*data)
+    return model, FlatTreeEnsemble.from_sklearn(model)
+
+def test_exactness(fitted, data):
+    check_exactness(*fitted, data[0])
+
+def test_exactness_nan(fitted, data):
+    X = data[0].copy()
+    X[np.random.default_rng(2).random(X.shape) < 0.3] = np.nan
+    check_exactness(*fitted, X)
+    # rows of only NaNs follow the missing value side of every split
+    check_exactness(*fitted, np.full((8, X.shape[1]), np.nan))
+
+@pytest.mark.parametrize('n_rows', [1, 2, 3, PYTHON_MAX_ROWS, PYTHON_MAX_ROWS + 1, 16])
+def test_exactness_small_batches(fitted, data, n_rows):
+    # up to PYTHON_MAX_ROWS rows are walked in python, larger batches are vectorized
+    X = data[0][:64]
+    for start in range(0, len(X), n_rows):
+        check_exactness(*fitted, X[start:start + n_rows])
+
+def test_exactness_blocks(fitted, data):
+    # blocks of a few rows per call of the vectorized evaluator
+    model, flat = fitted
+    X = data[0][:1000]
+    np.testing.assert_array_equal(flat.predict(X, block_nodes=7 * flat.n_trees), model.predict(X))
+
+def test_single_row(fitted, data):
+    model, flat = fitted
+    np.testing.assert_array_equal(flat.predict(data[0][0]), model.predict(data[0][:1]))
+
+def test_save_load(fitted, data, tmp_path):
+    model, flat = fitted
+    fpath = tmp_path / 'best_estimator_flat.npz'
+    flat.save(fpath)
+    check_exactness(model, FlatTreeEnsemble.load(fpath), data[0])
+
+def test_check_exactness_detects_difference(fitted, data):
+    model, flat = fitted
+    shifted = FlatTreeEnsemble(flat.feature, flat.threshold, flat.missing_left, flat.left, flat.right, flat.value,
+        flat.roots, flat.baseline + 1e-12, flat.max_depth)
+    with pytest.raises(AssertionError):
+        check_exactness(model, shifted, data[0][:100])
@@ -0,0 +1,36 @@
+'''
+Cold start of the app against the startup_check budgets
+'''
+import math
+import os
+
+import joblib
+import pytest
+
+from src.startup_check import check_startup
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+MODEL = os.path.join(ROOT, 'models', 'best_estimator.joblib')
+PREPROCESSING = os.path.join(ROOT, 'models', 'preprocessing_affine.npz')
+
+
+def test_startup_budgets():
+    if not (os.path.exists(MODEL) and os.path.exists(PREPROCESSING)):
+        pytest.skip('no trained model, run the pipeline first')
+    try:
+        joblib.load(MODEL)
+    except (ImportError, AttributeError):
+        pytest.skip('model pickled with another scikit-learn version than the installed one')
+    results = check_startup(1.5, 3.0, MODEL, PREPROCESSING, repeat=1, cwd=ROOT)
+    assert [name for name, *_ in results] == ['import src.features', 'import app modules', 'first prediction']
+    for name, seconds, budget, problem in results:
+        assert problem is None, f'{name}: {problem}'
+        assert seconds <= budget
+
+def test_failed_check_is_reported():
+    # a check that cannot run is a problem, not an exception
+    results = dict((name, rest) for name, *rest in check_startup(1.5, 3.0, os.path.join(ROOT, 'missing.joblib'),
+        PREPROCESSING, repeat=1, cwd=ROOT))
+    seconds, _, problem = results['first prediction']
+    assert math.isnan(seconds)
+    assert problem.startswith('failed: ') and 'missing.joblib' in problem